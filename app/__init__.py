@@ -8,14 +8,22 @@ from werkzeug.routing import BaseConverter, ValidationError
 from app.config import configs
 from app.monkeytype_config import MonkeytypeConfig
 from app.utils.antivirus import AntivirusClient
+from app.utils.counters import CounterReporter
+from app.utils.document_cache import DocumentCache
+from app.utils.scan_results import ScanResultConsumer
+from app.utils.spool import UploadSpool
 from app.utils.store import DocumentStore, ScanFilesDocumentStore
 
 document_store = DocumentStore()  # noqa: I001
 scan_files_document_store = ScanFilesDocumentStore()  # noqa: I001
 antivirus_client = AntivirusClient()  # noqa: I001
+upload_spool = UploadSpool()  # noqa: I001
+template_attach_cache = DocumentCache()  # noqa: I001
+scan_result_consumer = ScanResultConsumer(scan_files_document_store)  # noqa: I001
+counter_reporter = CounterReporter()  # noqa: I001
 
 from .download.views import download_blueprint  # noqa: I001
-from .upload.views import upload_blueprint  # noqa: I001
+from .upload.views import store_spooled_document, upload_blueprint  # noqa: I001
 from .healthcheck import healthcheck_blueprint  # noqa: I001
 from .xray_test import xray_blueprint  # noqa: I001
 
@@ -49,6 +57,19 @@ def create_app():
     document_store.init_app(application)
     scan_files_document_store.init_app(application)
     antivirus_client.init_app(application)
+    upload_spool.init_app(application)
+    if application.config["UPLOAD_ASYNC_ENABLED"]:
+        upload_spool.start(store_spooled_document)
+    template_attach_cache.init_app(application)
+    scan_result_consumer.init_app(application)
+
+    counter_reporter.init_app(application)
+    counter_reporter.register("documents.legacy_key_probe", document_store.legacy_key_probe.get_counts)
+    counter_reporter.register("scan_files.legacy_key_probe", scan_files_document_store.legacy_key_probe.get_counts)
+    counter_reporter.register("template_attach_cache", template_attach_cache.get_counts)
+    counter_reporter.start()
+    if scan_result_consumer.enabled:
+        scan_result_consumer.start()
 
     application.register_blueprint(download_blueprint)
     application.register_blueprint(upload_blueprint)
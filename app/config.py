@@ -1,4 +1,5 @@
 import os
+import tempfile
 from typing import Any
 
 from dotenv import load_dotenv
@@ -38,6 +39,124 @@ class Config(metaclass=MetaFlaskEnv):
 
     MAX_CONTENT_LENGTH = 10 * 1024 * 1024 + 1024
 
+    # Parse uploads incrementally and write them to S3 as they arrive, instead of reading
+    # the whole document in memory first. Form fields must be sent before the document.
+    UPLOAD_STREAMING_ENABLED = env.bool("UPLOAD_STREAMING_ENABLED", False)
+    UPLOAD_STREAM_CHUNK_SIZE = env.int("UPLOAD_STREAM_CHUNK_SIZE", 64 * 1024)
+    # S3 requires every part of a multipart upload but the last one to be at least 5 MiB
+    S3_MULTIPART_PART_SIZE = env.int("S3_MULTIPART_PART_SIZE", 5 * 1024 * 1024)
+    # Documents larger than this are stored with a multipart upload, sending up to
+    # S3_MULTIPART_CONCURRENCY parts in parallel and retrying each part on its own
+    S3_MULTIPART_THRESHOLD = env.int("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024)
+    S3_MULTIPART_CONCURRENCY = env.int("S3_MULTIPART_CONCURRENCY", 4)
+    S3_MULTIPART_PART_ATTEMPTS = env.int("S3_MULTIPART_PART_ATTEMPTS", 3)
+
+    # Limits for POST /services/<service_id>/documents/scan-verdicts
+    SCAN_VERDICT_BULK_MAX_DOCUMENTS = env.int("SCAN_VERDICT_BULK_MAX_DOCUMENTS", 100)
+    SCAN_VERDICT_BULK_CONCURRENCY = env.int("SCAN_VERDICT_BULK_CONCURRENCY", 10)
+
+    # Longest `wait` accepted by POST /services/<service_id>/documents/<document_id>/scan-verdict
+    SCAN_VERDICT_MAX_WAIT_SECONDS = env.int("SCAN_VERDICT_MAX_WAIT_SECONDS", 20)
+
+    # Retry-After sent with 428 responses while a document is being scanned, estimated from the last
+    # SCAN_LATENCY_WINDOW scans of documents of a similar size. The default is sent until
+    # SCAN_LATENCY_MIN_SAMPLES scans have been seen.
+    SCAN_RETRY_AFTER_DEFAULT_SECONDS = env.int("SCAN_RETRY_AFTER_DEFAULT_SECONDS", 5)
+    SCAN_RETRY_AFTER_MAX_SECONDS = env.int("SCAN_RETRY_AFTER_MAX_SECONDS", 60)
+    SCAN_LATENCY_WINDOW = env.int("SCAN_LATENCY_WINDOW", 200)
+    SCAN_LATENCY_MIN_SAMPLES = env.int("SCAN_LATENCY_MIN_SAMPLES", 10)
+
+    # Request the new and legacy keys of documents with unversioned download URLs at once, instead of
+    # only trying the legacy key once the new one is known to be missing
+    S3_LEGACY_KEY_PARALLEL_PROBE = env.bool("S3_LEGACY_KEY_PARALLEL_PROBE", False)
+
+    # Documents are streamed from S3 to the client in chunks of this size
+    DOWNLOAD_STREAM_CHUNK_SIZE = env.int("DOWNLOAD_STREAM_CHUNK_SIZE", 64 * 1024)
+
+    # Concurrent downloads of the same document, within a process, share one scan verdict lookup and,
+    # for documents up to DOWNLOAD_SINGLEFLIGHT_MAX_DOCUMENT_SIZE, one S3 request for the document
+    DOWNLOAD_SINGLEFLIGHT_ENABLED = env.bool("DOWNLOAD_SINGLEFLIGHT_ENABLED", False)
+    DOWNLOAD_SINGLEFLIGHT_MAX_DOCUMENT_SIZE = env.int("DOWNLOAD_SINGLEFLIGHT_MAX_DOCUMENT_SIZE", 2 * 1024 * 1024)
+
+    # Limits for POST /services/<service_id>/documents/batch
+    UPLOAD_BATCH_MAX_DOCUMENTS = env.int("UPLOAD_BATCH_MAX_DOCUMENTS", 10)
+    UPLOAD_BATCH_CONCURRENCY = env.int("UPLOAD_BATCH_CONCURRENCY", 4)
+
+    # Identical template_attach documents of a service share one stored and scanned copy of their
+    # content. Each reuse resets the content's LastModified, so it is never older than the documents
+    # pointing to it and any age-based expiry removes it after them. Content not reused for the max
+    # age is stored and scanned again. Not applied to streaming uploads.
+    TEMPLATE_ATTACH_DEDUPLICATION_ENABLED = env.bool("TEMPLATE_ATTACH_DEDUPLICATION_ENABLED", False)
+    TEMPLATE_ATTACH_DEDUPLICATION_MAX_AGE_SECONDS = env.int("TEMPLATE_ATTACH_DEDUPLICATION_MAX_AGE_SECONDS", 24 * 60 * 60)
+
+    # Redirect downloads of template_attach documents (SSE-S3, no customer key) to a short-lived
+    # presigned S3 URL once their scan verdict is checked, instead of streaming them through the app.
+    # The URL points to TEMPLATE_ATTACH_PRESIGNED_URL_BASE_URL instead of S3 when set, for a CDN.
+    TEMPLATE_ATTACH_PRESIGNED_REDIRECT_ENABLED = env.bool("TEMPLATE_ATTACH_PRESIGNED_REDIRECT_ENABLED", False)
+    TEMPLATE_ATTACH_PRESIGNED_URL_EXPIRY_SECONDS = env.int("TEMPLATE_ATTACH_PRESIGNED_URL_EXPIRY_SECONDS", 60)
+    TEMPLATE_ATTACH_PRESIGNED_URL_BASE_URL = os.getenv("TEMPLATE_ATTACH_PRESIGNED_URL_BASE_URL")
+
+    # Cache template_attach documents, downloaded by every recipient of a template, in memory (up to
+    # TEMPLATE_ATTACH_CACHE_MEMORY_MAX_BYTES, per process, for small documents) and on local disk (up to
+    # TEMPLATE_ATTACH_CACHE_DISK_MAX_BYTES, shared by the workers of a pod)
+    TEMPLATE_ATTACH_CACHE_ENABLED = env.bool("TEMPLATE_ATTACH_CACHE_ENABLED", False)
+    TEMPLATE_ATTACH_CACHE_DIR = os.getenv(
+        "TEMPLATE_ATTACH_CACHE_DIR", os.path.join(tempfile.gettempdir(), "document-download-cache")
+    )
+    TEMPLATE_ATTACH_CACHE_TTL_SECONDS = env.int("TEMPLATE_ATTACH_CACHE_TTL_SECONDS", 60 * 60)
+    TEMPLATE_ATTACH_CACHE_MAX_DOCUMENT_SIZE = env.int("TEMPLATE_ATTACH_CACHE_MAX_DOCUMENT_SIZE", 10 * 1024 * 1024)
+    TEMPLATE_ATTACH_CACHE_MEMORY_MAX_BYTES = env.int("TEMPLATE_ATTACH_CACHE_MEMORY_MAX_BYTES", 32 * 1024 * 1024)
+    TEMPLATE_ATTACH_CACHE_MEMORY_MAX_DOCUMENT_SIZE = env.int("TEMPLATE_ATTACH_CACHE_MEMORY_MAX_DOCUMENT_SIZE", 1024 * 1024)
+    TEMPLATE_ATTACH_CACHE_DISK_MAX_BYTES = env.int("TEMPLATE_ATTACH_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024)
+    # Check with a HEAD request that a cached document still exists before serving it, since deleting
+    # a document only removes it from the cache of the process handling the deletion. Without it,
+    # deleted documents can be served for up to TEMPLATE_ATTACH_CACHE_TTL_SECONDS.
+    TEMPLATE_ATTACH_CACHE_REVALIDATE = env.bool("TEMPLATE_ATTACH_CACHE_REVALIDATE", True)
+
+    # Create the scan file with a server-side S3 copy of the stored document, instead of
+    # uploading the document bytes a second time
+    SCAN_FILES_SERVER_SIDE_COPY = env.bool("SCAN_FILES_SERVER_SIDE_COPY", False)
+
+    # Acknowledge uploads with a 202 once the document is spooled to local disk, and store it in
+    # both buckets in the background. Progress is reported by GET .../documents/<document_id>/status.
+    # Not applied to streaming or batch uploads. Workers store what was left pending when they start,
+    # and finish what they are storing before they exit. UPLOAD_SPOOL_DIR should be on a volume that
+    # outlives the pod, for documents still pending when a pod is killed to be recovered. Storing a
+    # document is retried with exponential backoff before it is marked as failed. Records of stored
+    # and failed documents are removed after their TTL, checked every prune interval.
+    UPLOAD_ASYNC_ENABLED = env.bool("UPLOAD_ASYNC_ENABLED", False)
+    UPLOAD_ASYNC_WORKERS = env.int("UPLOAD_ASYNC_WORKERS", 4)
+    UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "document-download-spool"))
+    UPLOAD_SPOOL_RECORD_TTL_SECONDS = env.int("UPLOAD_SPOOL_RECORD_TTL_SECONDS", 24 * 60 * 60)
+    UPLOAD_SPOOL_PRUNE_INTERVAL_SECONDS = env.int("UPLOAD_SPOOL_PRUNE_INTERVAL_SECONDS", 60 * 60)
+    UPLOAD_SPOOL_STORE_ATTEMPTS = env.int("UPLOAD_SPOOL_STORE_ATTEMPTS", 5)
+    UPLOAD_SPOOL_RETRY_DELAY_SECONDS = env.float("UPLOAD_SPOOL_RETRY_DELAY_SECONDS", 1)
+
+    # Cache terminal scan verdicts (clean or malicious), so that repeat downloads skip reading the
+    # verdict from S3. The backend is one of "memory" (per process), "shared_memory" (shared by the
+    # workers of a pod through a memory-mapped file) or "redis" (shared by every pod).
+    SCAN_VERDICT_CACHE_ENABLED = env.bool("SCAN_VERDICT_CACHE_ENABLED", False)
+    SCAN_VERDICT_CACHE_BACKEND = os.getenv("SCAN_VERDICT_CACHE_BACKEND", "shared_memory")
+    SCAN_VERDICT_CACHE_PATH = os.getenv(
+        "SCAN_VERDICT_CACHE_PATH",
+        os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "document-download-verdicts"),
+    )
+    SCAN_VERDICT_CACHE_MAX_ENTRIES = env.int("SCAN_VERDICT_CACHE_MAX_ENTRIES", 64 * 1024)
+    SCAN_VERDICT_CACHE_TTL_SECONDS = env.int("SCAN_VERDICT_CACHE_TTL_SECONDS", 60 * 60)
+    SCAN_VERDICT_CACHE_REDIS_URL = os.getenv("SCAN_VERDICT_CACHE_REDIS_URL", os.getenv("REDIS_URL", "redis://localhost:6379"))
+    SCAN_VERDICT_CACHE_REDIS_TIMEOUT_SECONDS = env.float("SCAN_VERDICT_CACHE_REDIS_TIMEOUT_SECONDS", 0.5)
+
+    # Record scan verdicts from the GuardDuty scan result events delivered to this SQS queue, so that
+    # verdicts are in the verdict cache by the time they are checked. Needs the verdict cache enabled,
+    # with a backend shared by the consumers.
+    SCAN_RESULT_CONSUMER_ENABLED = env.bool("SCAN_RESULT_CONSUMER_ENABLED", False)
+    SCAN_RESULT_QUEUE_URL = os.getenv("SCAN_RESULT_QUEUE_URL")
+    SCAN_RESULT_QUEUE_WAIT_TIME_SECONDS = env.int("SCAN_RESULT_QUEUE_WAIT_TIME_SECONDS", 20)
+
+    # Log the counters of each process (legacy key lookups, template_attach cache hits...) this often,
+    # 0 to never log them. They are also returned by GET /_status/counters.
+    COUNTERS_LOG_INTERVAL_SECONDS = env.int("COUNTERS_LOG_INTERVAL_SECONDS", 5 * 60)
+
     HTTP_SCHEME = os.getenv("HTTP_SCHEME", "http")
     BACKEND_HOSTNAME = os.getenv("BACKEND_HOSTNAME", "localhost:7000")
 
@@ -54,6 +173,7 @@ class Config(metaclass=MetaFlaskEnv):
             "SECRET_KEY",
             "AUTH_TOKENS",
             "ANTIVIRUS_API_KEY",
+            "SCAN_VERDICT_CACHE_REDIS_URL",
         ]
 
     @classmethod
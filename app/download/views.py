@@ -1,30 +1,54 @@
+import io
+import itertools
+import math
+import time
+import unicodedata
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
 from flask import (
     Blueprint,
+    Response,
     abort,
     current_app,
     jsonify,
     make_response,
+    redirect,
     request,
     send_file,
 )
 from notifications_utils.base64_uuid import base64_to_bytes
+from werkzeug.datastructures import Headers
+from werkzeug.http import http_date
 
-from app import document_store, scan_files_document_store
+from app import document_store, scan_files_document_store, template_attach_cache
+from app.utils.authentication import requires_auth
+from app.utils.concurrency import Prefetch, SingleFlight, submit_in_context
 from app.utils.store import (
     DocumentStoreError,
     MaliciousContentError,
+    NotModifiedError,
+    RangeNotSatisfiableError,
     ScanFailedError,
     ScanInProgressError,
     ScanUnsupportedError,
 )
+from app.utils.streaming import StreamedBody
+from app.utils.urls import KEY_LAYOUT_PARAM
 
 download_blueprint = Blueprint("download", __name__, url_prefix="")
 
+# Downloads of the same document in flight in this process, see `get_whole_document`
+document_flights = SingleFlight()
+
 MALICIOUS_CONTENT_ERROR_CODE = 423
 SCAN_IN_PROGRESS_ERROR_CODE = 428
 SCAN_TIMEOUT_ERROR_CODE = 408
 SCAN_TIMEOUT_SECONDS = 11 * 60
 SCAN_FAILED_ERROR_CODE = 422
+# Delays between checks of the scan verdict while waiting for it, the last one repeating
+SCAN_VERDICT_WAIT_BACKOFF_SECONDS = (1, 2, 4, 8)
 
 
 @download_blueprint.route("/services/<uuid:service_id>/documents/<uuid:document_id>", methods=["GET"])
@@ -43,8 +67,82 @@ def download_document(service_id, document_id):
         except ValueError:
             return jsonify(error="Invalid decryption key"), 400
 
+    # The document is fetched while its scan verdict is checked, and discarded if the download is refused
+    with prefetch_document(service_id, document_id, key, sending_method, filename) as prefetch:
+        if sending_method != "template_attach":
+            try:
+                scan_files_document_store.check_scan_verdict(
+                    service_id, document_id, sending_method, key_layout=request.args.get(KEY_LAYOUT_PARAM)
+                )
+            except MaliciousContentError as e:
+                current_app.logger.info(
+                    "Malicious content detected, refused to download document: {}".format(e),
+                    extra={
+                        "service_id": service_id,
+                        "document_id": document_id,
+                    },
+                )
+                return jsonify(error="Document download blocked"), MALICIOUS_CONTENT_ERROR_CODE
+            except ScanInProgressError as e:
+                # return the document to the user in case the scan timed out
+                current_app.logger.info("Scan is in progress but we will return the link, error is: {}".format(e))
+            except ScanFailedError as e:
+                # GuardDuty failed to scan the document. Log an error but allow download.
+                current_app.logger.error("Failed to scan document: {}".format(e))
+            except ScanUnsupportedError as e:
+                # GuardDuty was unable to scan the document. Log a warning but allow download.
+                current_app.logger.warning("Scan unsupported for document: {}".format(e))
+            except DocumentStoreError as e:
+                current_app.logger.info(
+                    "Failed to get tags from document: {}".format(e),
+                    extra={
+                        "service_id": service_id,
+                        "document_id": document_id,
+                    },
+                )
+                abort(404)
+
+        try:
+            document = prefetch.result()
+        except NotModifiedError as e:
+            return not_modified_response(e)
+        except RangeNotSatisfiableError as e:
+            return range_not_satisfiable_response(e.size)
+        except DocumentStoreError as e:
+            current_app.logger.info(
+                "Failed to download document: {}".format(e),
+                extra={
+                    "service_id": service_id,
+                    "document_id": document_id,
+                },
+            )
+            return jsonify(error=str(e)), 400
+
+    return document_response(document, filename, extra={"service_id": service_id, "document_id": document_id})
+
+
+@download_blueprint.route("/d/<base64_uuid:service_id>/<base64_uuid:document_id>", methods=["GET"])
+def download_document_b64(service_id, document_id):
+    filename = request.args.get("filename")
+    sending_method = request.args.get("sending_method", "link")
+
+    # Key is optional for template_attach (uses SSE-S3), required for others (uses SSE-C)
+    if sending_method == "template_attach":
+        key = None
+    else:
+        if "key" not in request.args:
+            abort(404)
+        try:
+            key = base64_to_bytes(request.args["key"])
+        except ValueError:
+            abort(404)
+
+    # The document is fetched while its scan verdict is checked, and discarded if the download is refused
+    with prefetch_document(service_id, document_id, key, sending_method, filename) as prefetch:
         try:
-            check_scan_verdict(service_id, document_id, sending_method)
+            scan_files_document_store.check_scan_verdict(
+                service_id, document_id, sending_method, key_layout=request.args.get(KEY_LAYOUT_PARAM)
+            )
         except MaliciousContentError as e:
             current_app.logger.info(
                 "Malicious content detected, refused to download document: {}".format(e),
@@ -53,8 +151,9 @@ def download_document(service_id, document_id):
                     "document_id": document_id,
                 },
             )
-            return jsonify(error="Document download blocked"), MALICIOUS_CONTENT_ERROR_CODE
+            abort(404)
         except ScanInProgressError as e:
+            # at this point the email with the "link" type attachment has been sent
             # return the document to the user in case the scan timed out
             current_app.logger.info("Scan is in progress but we will return the link, error is: {}".format(e))
         except ScanFailedError as e:
@@ -73,105 +172,23 @@ def download_document(service_id, document_id):
             )
             abort(404)
 
-    try:
-        document = document_store.get(service_id, document_id, key, sending_method)
-    except DocumentStoreError as e:
-        current_app.logger.info(
-            "Failed to download document: {}".format(e),
-            extra={
-                "service_id": service_id,
-                "document_id": document_id,
-            },
-        )
-        return jsonify(error=str(e)), 400
-
-    response = make_response(
-        send_file(
-            document["body"],
-            mimetype=document["mimetype"],
-            # as_attachment can only be `True` if the filename is set
-            as_attachment=(filename is not None),
-            download_name=filename,
-        )
-    )
-    response.headers["Content-Length"] = document["size"]
-    response.headers["X-Robots-Tag"] = "noindex, nofollow"
-
-    return response
-
-
-@download_blueprint.route("/d/<base64_uuid:service_id>/<base64_uuid:document_id>", methods=["GET"])
-def download_document_b64(service_id, document_id):
-    filename = request.args.get("filename")
-    sending_method = request.args.get("sending_method", "link")
-
-    # Key is optional for template_attach (uses SSE-S3), required for others (uses SSE-C)
-    if sending_method == "template_attach":
-        key = None
-    else:
-        if "key" not in request.args:
-            abort(404)
         try:
-            key = base64_to_bytes(request.args["key"])
-        except ValueError:
+            document = prefetch.result()
+        except NotModifiedError as e:
+            return not_modified_response(e)
+        except RangeNotSatisfiableError as e:
+            return range_not_satisfiable_response(e.size)
+        except DocumentStoreError as e:
+            current_app.logger.info(
+                "Failed to download document: {}".format(e),
+                extra={
+                    "service_id": service_id,
+                    "document_id": document_id,
+                },
+            )
             abort(404)
 
-    try:
-        check_scan_verdict(service_id, document_id, sending_method)
-    except MaliciousContentError as e:
-        current_app.logger.info(
-            "Malicious content detected, refused to download document: {}".format(e),
-            extra={
-                "service_id": service_id,
-                "document_id": document_id,
-            },
-        )
-        abort(404)
-    except ScanInProgressError as e:
-        # at this point the email with the "link" type attachment has been sent
-        # return the document to the user in case the scan timed out
-        current_app.logger.info("Scan is in progress but we will return the link, error is: {}".format(e))
-    except ScanFailedError as e:
-        # GuardDuty failed to scan the document. Log an error but allow download.
-        current_app.logger.error("Failed to scan document: {}".format(e))
-    except ScanUnsupportedError as e:
-        # GuardDuty was unable to scan the document. Log a warning but allow download.
-        current_app.logger.warning("Scan unsupported for document: {}".format(e))
-    except DocumentStoreError as e:
-        current_app.logger.info(
-            "Failed to get tags from document: {}".format(e),
-            extra={
-                "service_id": service_id,
-                "document_id": document_id,
-            },
-        )
-        abort(404)
-
-    try:
-        document = document_store.get(service_id, document_id, key, sending_method)
-    except DocumentStoreError as e:
-        current_app.logger.info(
-            "Failed to download document: {}".format(e),
-            extra={
-                "service_id": service_id,
-                "document_id": document_id,
-            },
-        )
-        abort(404)
-
-    response = make_response(
-        send_file(
-            document["body"],
-            mimetype=document["mimetype"],
-            # as_attachment can only be `True` if the filename is set
-            as_attachment=(filename is not None),
-            download_name=filename,
-        )
-    )
-    response.headers["Content-Length"] = document["size"]
-    response.headers["X-Robots-Tag"] = "noindex, nofollow"
-
-    return response
+    return document_response(document, filename, extra={"service_id": service_id, "document_id": document_id})
 
 
 @download_blueprint.route("/services/<uuid:service_id>/documents/<uuid:document_id>", methods=["DELETE"])
@@ -221,6 +238,9 @@ def delete_document(service_id, document_id):
         current_app.logger.info(f"Deleting from scan_files_document_store with sending_method: {sending_method}")
         scan_files_document_store.delete(service_id, document_id, sending_method)
 
+        if sending_method == "template_attach" and template_attach_cache.enabled:
+            template_attach_cache.delete(f"{service_id}/{document_id}")
+
         current_app.logger.info(
             "Successfully deleted document",
             extra={
@@ -242,9 +262,87 @@ def delete_document(service_id, document_id):
 
 @download_blueprint.route("/services/<uuid:service_id>/documents/<uuid:document_id>/scan-verdict", methods=["POST"])
 def check_scan_verdict(service_id, document_id, sending_method=None):
+    """
+    With a `wait` of some seconds (up to SCAN_VERDICT_MAX_WAIT_SECONDS), holds the request until the
+    scan verdict is known rather than answering 428 straight away, so that clients need fewer polls.
+    """
     sending_method = request.form.get("sending_method", sending_method)
+    wait = request.values.get("wait", type=float)
+    if "wait" in request.values and (wait is None or not math.isfinite(wait)):
+        return jsonify(error="Invalid wait, expected a number of seconds"), 400
+    wait = min(max(wait or 0, 0), current_app.config["SCAN_VERDICT_MAX_WAIT_SECONDS"])
+    result, status_code = wait_for_scan_verdict(
+        service_id, document_id, sending_method, request.values.get(KEY_LAYOUT_PARAM), wait
+    )
+    if status_code == 404:
+        abort(404)
+    retry_after = result.pop("retry_after", None)
+    return jsonify(result), status_code, {"Retry-After": str(retry_after)} if retry_after else {}
+
+
+@download_blueprint.route("/services/<uuid:service_id>/documents/scan-verdicts", methods=["POST"])
+@requires_auth
+def check_scan_verdicts(service_id):
+    """
+    Bulk version of `check_scan_verdict`, for polling many documents at once. The JSON body lists the
+    documents as `{"documents": [{"document_id": ..., "sending_method": ..., "v": ...}, ...]}`, and
+    the response maps each document id to the result `check_scan_verdict` would give, along with its
+    status code. Verdicts are resolved concurrently. Only the API, which has a token, checks verdicts
+    in bulk, so the route requires authentication.
+    """
+    documents = (request.get_json(silent=True) or {}).get("documents")
+    if not isinstance(documents, list) or not documents:
+        return jsonify(error="Expected a list of documents"), 400
+
+    max_documents = current_app.config["SCAN_VERDICT_BULK_MAX_DOCUMENTS"]
+    if len(documents) > max_documents:
+        return jsonify(error=f"Too many documents, at most {max_documents} scan verdicts can be checked at once"), 400
+
+    checks = {}
+    for document in documents:
+        try:
+            document_id = uuid.UUID(document["document_id"])
+        except (TypeError, KeyError, ValueError, AttributeError):
+            return jsonify(error="Invalid document id"), 400
+        checks[document_id] = (document.get("sending_method"), document.get(KEY_LAYOUT_PARAM))
+
+    with ThreadPoolExecutor(max_workers=min(len(checks), current_app.config["SCAN_VERDICT_BULK_CONCURRENCY"])) as executor:
+        futures = {
+            document_id: submit_in_context(executor, get_scan_verdict, service_id, document_id, sending_method, key_layout)
+            for document_id, (sending_method, key_layout) in checks.items()
+        }
+
+    scan_verdicts = {}
+    for document_id, future in futures.items():
+        result, status_code = future.result()
+        scan_verdicts[str(document_id)] = {**result, "status_code": status_code}
+    return jsonify(status="ok", scan_verdicts=scan_verdicts), 200
+
+
+def wait_for_scan_verdict(service_id, document_id, sending_method, key_layout, wait):
+    """
+    Returns the result of `get_scan_verdict` once the scan is no longer in progress, or after `wait`
+    seconds. The verdict is checked again when this process finds it for another request, or else
+    after each delay of SCAN_VERDICT_WAIT_BACKOFF_SECONDS. Waiting blocks on an event, so under gevent
+    it only holds a greenlet.
+    """
+    deadline = time.monotonic() + wait
+    for attempt in itertools.count():
+        result, status_code = get_scan_verdict(service_id, document_id, sending_method, key_layout)
+        remaining = deadline - time.monotonic()
+        if status_code != SCAN_IN_PROGRESS_ERROR_CODE or remaining <= 0:
+            return result, status_code
+
+        delay = SCAN_VERDICT_WAIT_BACKOFF_SECONDS[min(attempt, len(SCAN_VERDICT_WAIT_BACKOFF_SECONDS) - 1)]
+        scan_files_document_store.wait_for_scan_verdict(service_id, document_id, sending_method, min(delay, remaining))
+
+
+def get_scan_verdict(service_id, document_id, sending_method, key_layout):
+    """
+    Returns the result of checking the scan verdict of a document, and its status code.
+    """
     try:
-        av_status = scan_files_document_store.check_scan_verdict(service_id, document_id, sending_method)
+        av_status = scan_files_document_store.check_scan_verdict(service_id, document_id, sending_method, key_layout=key_layout)
     except MaliciousContentError as e:
         current_app.logger.info(
             "Malicious content detected, refused to download document: {}".format(e),
@@ -253,9 +351,11 @@ def check_scan_verdict(service_id, document_id, sending_method=None):
                 "document_id": document_id,
             },
         )
-        return jsonify(error=str(e)), MALICIOUS_CONTENT_ERROR_CODE
+        return {"error": str(e)}, MALICIOUS_CONTENT_ERROR_CODE
     except ScanInProgressError as e:
-        age_data = scan_files_document_store.get_object_age_seconds(service_id, document_id, sending_method)
+        age_data = scan_files_document_store.get_object_age_seconds(
+            service_id, document_id, sending_method, key_layout=key_layout
+        )
         age_seconds = age_data["age_seconds"]
         current_app.logger.info(f"ScanInProgressError, age_data: {age_data}")
         if age_seconds > SCAN_TIMEOUT_SECONDS:
@@ -266,7 +366,7 @@ def check_scan_verdict(service_id, document_id, sending_method=None):
                     "document_id": document_id,
                 },
             )
-            return jsonify(scan_verdict="scan_timed_out"), SCAN_TIMEOUT_ERROR_CODE
+            return {"scan_verdict": "scan_timed_out"}, SCAN_TIMEOUT_ERROR_CODE
 
         current_app.logger.info(
             "Scan in progress, refused to download document: {}".format(e),
@@ -275,7 +375,7 @@ def check_scan_verdict(service_id, document_id, sending_method=None):
                 "document_id": document_id,
             },
         )
-        return jsonify(error=str(e)), SCAN_IN_PROGRESS_ERROR_CODE
+        return {"error": str(e), "retry_after": get_scan_retry_after(age_data)}, SCAN_IN_PROGRESS_ERROR_CODE
     except ScanUnsupportedError:
         current_app.logger.warning(
             "Scan unsupported for document",
@@ -284,7 +384,7 @@ def check_scan_verdict(service_id, document_id, sending_method=None):
                 "document_id": document_id,
             },
         )
-        return jsonify(scan_verdict="scan_unsupported"), SCAN_FAILED_ERROR_CODE
+        return {"scan_verdict": "scan_unsupported"}, SCAN_FAILED_ERROR_CODE
     except ScanFailedError as e:
         current_app.logger.error(
             "Scan failed for document: {}".format(e),
@@ -293,7 +393,7 @@ def check_scan_verdict(service_id, document_id, sending_method=None):
                 "document_id": document_id,
             },
         )
-        return jsonify(scan_verdict="scan_failed"), SCAN_FAILED_ERROR_CODE
+        return {"scan_verdict": "scan_failed"}, SCAN_FAILED_ERROR_CODE
     except DocumentStoreError as e:
         current_app.logger.info(
             "Failed to get tags from document: {}".format(e),
@@ -302,5 +402,227 @@ def check_scan_verdict(service_id, document_id, sending_method=None):
                 "document_id": document_id,
             },
         )
-        abort(404)
-    return jsonify(scan_verdict=av_status), 200
+        return {"error": "Document not found"}, 404
+    return {"scan_verdict": av_status}, 200
+
+
+def get_scan_retry_after(age_data):
+    """
+    Returns how many seconds a client should wait before checking again the verdict of a document
+    still being scanned: until similar documents are usually scanned, and no later than when the
+    scan would time out.
+    """
+    age_seconds = age_data["age_seconds"]
+    remaining = scan_files_document_store.scan_latency.estimate_remaining(age_data.get("size"), age_seconds)
+    if remaining is None:
+        remaining = current_app.config["SCAN_RETRY_AFTER_DEFAULT_SECONDS"]
+    remaining = min(remaining, current_app.config["SCAN_RETRY_AFTER_MAX_SECONDS"], SCAN_TIMEOUT_SECONDS + 1 - age_seconds)
+    return max(math.ceil(remaining), 1)
+
+
+def prefetch_document(service_id, document_id, key, sending_method, filename):
+    """
+    Starts getting the document in the background (see `Prefetch`). In presigned redirect mode,
+    template_attach documents aren't fetched: a presigned URL to download them from S3 is made instead.
+    """
+    if sending_method == "template_attach" and current_app.config["TEMPLATE_ATTACH_PRESIGNED_REDIRECT_ENABLED"]:
+        return Prefetch(get_presigned_redirect, service_id, document_id, sending_method, filename)
+
+    return Prefetch(
+        get_document,
+        service_id,
+        document_id,
+        key,
+        sending_method,
+        key_layout=request.args.get(KEY_LAYOUT_PARAM),
+        byte_range=get_requested_range(),
+        if_range=request.if_range,
+        conditions=get_request_conditions(),
+        discard=close_document,
+    )
+
+
+def get_presigned_redirect(service_id, document_id, sending_method, filename):
+    content_disposition = get_content_disposition(filename) if filename is not None else None
+    return {"redirect_url": document_store.get_presigned_url(service_id, document_id, sending_method, content_disposition)}
+
+
+def get_document(service_id, document_id, key, sending_method, key_layout=None, byte_range=None, if_range=None, conditions=None):
+    """
+    Gets the document, or only the requested byte range of it. The range is requested from S3 straight
+    away, and the whole document is only fetched if it turns out that the range was conditional on
+    another version of the document (`If-Range` header).
+    `conditions` are passed on to the store, to get nothing if the client already has the document.
+    Whole template_attach documents are served from the cache, when it is enabled.
+    """
+    conditions = conditions or {}
+    if not byte_range and not conditions:
+        if sending_method == "template_attach" and template_attach_cache.enabled:
+            return template_attach_cache.get(
+                f"{service_id}/{document_id}",
+                lambda: get_whole_document(service_id, document_id, key, sending_method, key_layout),
+                exists=(
+                    (lambda: document_store.document_exists(service_id, document_id, sending_method))
+                    if current_app.config["TEMPLATE_ATTACH_CACHE_REVALIDATE"]
+                    else None
+                ),
+            )
+        return get_whole_document(service_id, document_id, key, sending_method, key_layout)
+
+    document = document_store.get(
+        service_id, document_id, key, sending_method, key_layout=key_layout, byte_range=byte_range, **conditions
+    )
+    if byte_range and not if_range_matches(if_range, document):
+        close_document(document)
+        document = document_store.get(service_id, document_id, key, sending_method, key_layout=key_layout, **conditions)
+    return document
+
+
+def get_whole_document(service_id, document_id, key, sending_method, key_layout):
+    """
+    Gets the whole document. With singleflight enabled, concurrent downloads of the same document share
+    one S3 request, whose body is read and handed to each of them if it is small enough. Larger
+    documents are streamed, so each download other than the first one then gets its own.
+    """
+    if not current_app.config["DOWNLOAD_SINGLEFLIGHT_ENABLED"]:
+        return document_store.get(service_id, document_id, key, sending_method, key_layout=key_layout)
+
+    def get_shareable_document():
+        document = document_store.get(service_id, document_id, key, sending_method, key_layout=key_layout)
+        if document["size"] > current_app.config["DOWNLOAD_SINGLEFLIGHT_MAX_DOCUMENT_SIZE"]:
+            return document
+        try:
+            content = document["body"].read()
+        finally:
+            document["body"].close()
+        return {**document, "body": None, "content": content}
+
+    # The decryption key is part of the key, so that a download never gets a document fetched with another key
+    document, shared = document_flights.do((service_id, document_id, key, sending_method, key_layout), get_shareable_document)
+    if "content" in document:
+        document = dict(document)
+        document["body"] = io.BytesIO(document.pop("content"))
+        return document
+    if shared:
+        return document_store.get(service_id, document_id, key, sending_method, key_layout=key_layout)
+    return document
+
+
+def get_request_conditions():
+    """
+    Returns the `If-None-Match` and `If-Modified-Since` conditions of the request, as arguments of
+    `document_store.get`. `If-Modified-Since` is ignored when there is an `If-None-Match` header.
+    """
+    if "If-None-Match" in request.headers:
+        return {"if_none_match": request.headers["If-None-Match"]}
+    if request.if_modified_since is not None:
+        return {"if_modified_since": request.if_modified_since}
+    return {}
+
+
+def get_requested_range():
+    """
+    Returns the byte range requested with a `Range` header, as a header value to pass to S3, or None
+    for the whole document. Requests for several ranges get the whole document.
+    """
+    byte_range = request.range
+    if byte_range is None or byte_range.units != "bytes" or len(byte_range.ranges) != 1:
+        return None
+    return byte_range.to_header()
+
+
+def if_range_matches(if_range, document):
+    """
+    Whether the `If-Range` header, if any, names this version of the document, by its (strong) ETag or
+    its last modified date.
+    """
+    if if_range is None or (if_range.etag is None and if_range.date is None):
+        return True
+    if if_range.etag is not None:
+        etag = document.get("etag")
+        return etag is not None and not etag.startswith("W/") and etag.strip('"') == if_range.etag
+    return document.get("last_modified") == if_range.date
+
+
+def get_content_disposition(filename):
+    """
+    `Content-Disposition` header value to download a file as `filename`, as send_file sets it.
+    """
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+        # safe = RFC 5987 attr-char
+        names = {"filename": simple, "filename*": f"UTF-8''{quote(filename, safe='!#$&+-.^_`|~')}"}
+    else:
+        names = {"filename": filename}
+    headers = Headers()
+    headers.set("Content-Disposition", "attachment", **names)
+    return headers["Content-Disposition"]
+
+
+def document_response(document, filename, extra=None):
+    if "redirect_url" in document:
+        response = redirect(document["redirect_url"])
+        # The presigned URL expires shortly, so the redirect mustn't be cached
+        response.headers["Cache-Control"] = "no-store"
+        response.headers["X-Robots-Tag"] = "noindex, nofollow"
+        return response
+
+    if hasattr(document["body"], "iter_chunks"):
+        # S3 body: streamed in chunks of a set size, releasing the S3 connection if the client disconnects
+        response = Response(
+            StreamedBody(document["body"], current_app.config["DOWNLOAD_STREAM_CHUNK_SIZE"], extra=extra),
+            mimetype=document["mimetype"],
+            direct_passthrough=True,
+        )
+        response.cache_control.no_cache = True
+        if filename is not None:
+            response.headers["Content-Disposition"] = get_content_disposition(filename)
+    else:
+        # Cached document: in memory, or a file that the server can send with sendfile
+        response = make_response(
+            send_file(
+                document["body"],
+                mimetype=document["mimetype"],
+                # as_attachment can only be `True` if the filename is set
+                as_attachment=(filename is not None),
+                download_name=filename,
+                # Ranges are sent by S3 and handled above, the body is only the requested range
+                conditional=False,
+            )
+        )
+    # send_file only sets the Date header for conditional responses
+    response.headers["Date"] = http_date()
+    response.headers["Content-Length"] = document["size"]
+    response.headers["Accept-Ranges"] = "bytes"
+    if document.get("content_range"):
+        response.status_code = 206
+        response.headers["Content-Range"] = document["content_range"]
+    if document.get("etag"):
+        response.headers["ETag"] = document["etag"]
+    if document.get("last_modified"):
+        response.last_modified = document["last_modified"]
+    response.headers["X-Robots-Tag"] = "noindex, nofollow"
+
+    return response
+
+
+def not_modified_response(error):
+    response = make_response("", 304)
+    if error.etag:
+        response.headers["ETag"] = error.etag
+    response.headers["X-Robots-Tag"] = "noindex, nofollow"
+    return response
+
+
+def range_not_satisfiable_response(size):
+    response = make_response("", 416)
+    response.headers["Accept-Ranges"] = "bytes"
+    if size is not None:
+        response.headers["Content-Range"] = f"bytes */{size}"
+    return response
+
+
+def close_document(document):
+    document["body"].close()
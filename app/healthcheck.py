@@ -1,4 +1,8 @@
-from flask import Blueprint
+import os
+
+from flask import Blueprint, jsonify
+
+from app import counter_reporter
 
 healthcheck_blueprint = Blueprint("healthcheck", __name__, url_prefix="")
 
@@ -6,3 +10,11 @@ healthcheck_blueprint = Blueprint("healthcheck", __name__, url_prefix="")
 @healthcheck_blueprint.route("/_status")
 def status():
     return "ok", 200
+
+
+@healthcheck_blueprint.route("/_status/counters")
+def counters():
+    """
+    Counters of the worker process handling the request (each process keeps its own).
+    """
+    return jsonify(pid=os.getpid(), counters=counter_reporter.get_counts()), 200
@@ -1,8 +1,15 @@
 from flask import jsonify
 
+from app.utils.compression import InvalidCompressedBodyError
+
 from .views import upload_blueprint
 
 
 @upload_blueprint.errorhandler(413)
 def request_entity_too_large(error):
     return jsonify(error="Uploaded document exceeds file size limit"), 413
+
+
+@upload_blueprint.errorhandler(InvalidCompressedBodyError)
+def invalid_compressed_body(error):
+    return jsonify(error=error.description), 400
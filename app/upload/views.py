@@ -1,76 +1,493 @@
+import base64
 import pathlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import Blueprint, current_app, jsonify, request
 
-from app import document_store, scan_files_document_store
-from app.utils import get_mime_type
+from app import document_store, scan_files_document_store, upload_spool
+from app.utils import MIME_TYPE_SAMPLE_SIZE, get_mime_type, inspect_document
 from app.utils.authentication import check_auth
+from app.utils.compression import decompress_request_body
+from app.utils.concurrency import submit_in_context
+from app.utils.multipart import InvalidMultipartError, MultipartField, iter_multipart
+from app.utils.spool import SPOOL_STORED
+from app.utils.store import DocumentStoreError, get_content_id
 from app.utils.urls import get_api_download_url, get_direct_file_url
 
 upload_blueprint = Blueprint("upload", __name__, url_prefix="")
 upload_blueprint.before_request(check_auth)
+upload_blueprint.before_request(decompress_request_body)
+
+# Form fields that change where or how the document is stored. When streaming, the document is
+# written as it is received, so these have to be sent before it.
+STORAGE_FORM_FIELDS = ("filename", "sending_method")
 
 
 @upload_blueprint.route("/services/<uuid:service_id>/documents", methods=["POST"])
 def upload_document(service_id):
+    if current_app.config["UPLOAD_STREAMING_ENABLED"] and request.mimetype == "multipart/form-data":
+        return upload_document_streaming(service_id)
+
     if "document" not in request.files:
         return jsonify(error="No document upload"), 400
 
-    mimetype = get_mime_type(request.files["document"])
-    if not mime_type_is_allowed(mimetype, service_id):
-        return (
-            jsonify(
-                error="Unsupported document type '{}'. Supported types are: {}".format(
-                    mimetype, current_app.config["ALLOWED_MIME_TYPES"]
-                )
-            ),
-            400,
-        )
     file_content = request.files["document"].read()
+    inspection = inspect_document(file_content)
+    if not mime_type_is_allowed(inspection.mimetype, service_id):
+        return unsupported_mime_type_response(inspection.mimetype)
 
     filename = request.form.get("filename")
-    file_extension = None
-    if filename and "." in filename:
-        file_extension = "".join(pathlib.Path(filename.lower()).suffixes).lstrip(".")
+    mimetype = fix_csv_mime_type(inspection.mimetype, filename)
 
-    # Our MIME type auto-detection resolves CSV content as text/plain,
-    # so we fix that if possible
-    if (filename or "").lower().endswith(".csv") and mimetype == "text/plain":
-        mimetype = "text/csv"
+    sending_method = request.form.get("sending_method")
+
+    if current_app.config["UPLOAD_ASYNC_ENABLED"]:
+        document = spool_document(service_id, file_content, sending_method, mimetype, inspection.sha256)
+        return document_created_response(
+            service_id, document, filename, sending_method, mimetype, inspection.size, status_code=202
+        )
+
+    document = store_document(service_id, file_content, sending_method, mimetype, inspection.sha256)
+
+    return document_created_response(service_id, document, filename, sending_method, mimetype, inspection.size)
+
+
+@upload_blueprint.route("/services/<uuid:service_id>/documents/<uuid:document_id>/status", methods=["GET"])
+def get_document_status(service_id, document_id):
+    """
+    Status of a document uploaded asynchronously: pending until it is stored in both buckets,
+    then stored, or failed. Spool records are only on the disk of the pod which accepted the upload,
+    so other pods report the document as stored once it is in S3. They can't tell pending from
+    failed documents, reported as not found.
+    """
+    record = upload_spool.get_status(document_id)
+    if record is None:
+        sending_method = request.args.get("sending_method", "link")
+        if not scan_files_document_store.document_exists(service_id, document_id, sending_method):
+            return jsonify(error="Document not found"), 404
+        record = {"service_id": str(service_id), "status": SPOOL_STORED}
+
+    if record["service_id"] != str(service_id):
+        return jsonify(error="Document not found"), 404
+
+    return jsonify(status="ok", document_id=str(document_id), upload_status=record["status"]), 200
+
+
+@upload_blueprint.route("/services/<uuid:service_id>/documents/batch", methods=["POST"])
+def upload_documents_batch(service_id):
+    """
+    Uploads several documents in one request. Each document is sent as a `document` file field,
+    optionally with one `filename` field per document, in the same order. `sending_method` applies
+    to every document. Documents are stored concurrently and the batch is all or nothing.
+    The whole request is subject to MAX_CONTENT_LENGTH.
+    """
+    files = request.files.getlist("document")
+    if not files:
+        return jsonify(error="No document upload"), 400
+
+    max_documents = current_app.config["UPLOAD_BATCH_MAX_DOCUMENTS"]
+    if len(files) > max_documents:
+        return jsonify(error=f"Too many documents, a batch can contain at most {max_documents} documents"), 400
+
+    filenames = request.form.getlist("filename") or [None] * len(files)
+    if len(filenames) != len(files):
+        return jsonify(error="Expected one filename per document"), 400
 
     sending_method = request.form.get("sending_method")
 
-    document = document_store.put(service_id, file_content, sending_method=sending_method, mimetype=mimetype)
-    scan_files_document_store.put(service_id, document["id"], file_content, sending_method=sending_method, mimetype=mimetype)
+    uploads = []
+    for file, filename in zip(files, filenames):
+        file_content = file.read()
+        inspection = inspect_document(file_content)
+        if not mime_type_is_allowed(inspection.mimetype, service_id):
+            return unsupported_mime_type_response(inspection.mimetype)
+        uploads.append((file_content, filename, fix_csv_mime_type(inspection.mimetype, filename), inspection))
+
+    with ThreadPoolExecutor(max_workers=min(len(uploads), current_app.config["UPLOAD_BATCH_CONCURRENCY"])) as executor:
+        futures = [
+            submit_in_context(executor, store_document, service_id, file_content, sending_method, mimetype, inspection.sha256)
+            for file_content, _, mimetype, inspection in uploads
+        ]
+
+    errors = [future.exception() for future in futures]
+    if any(errors):
+        for future, error in zip(futures, errors):
+            if error is None:
+                document = future.result()
+                _delete_documents(service_id, document["id"], sending_method, document.get("encryption_key"))
+        raise next(error for error in errors if error)
 
     return (
         jsonify(
             status="ok",
-            document={
-                "id": document["id"],
-                "direct_file_url": get_direct_file_url(
-                    service_id=service_id,
-                    document_id=document["id"],
-                    key=document.get("encryption_key", ""),
-                    sending_method=sending_method,
-                ),
-                "url": get_api_download_url(
-                    service_id=service_id,
-                    document_id=document["id"],
-                    key=document.get("encryption_key", ""),
-                    filename=filename,
-                ),
-                "filename": filename,
-                "sending_method": sending_method,
-                "mime_type": mimetype,
-                "file_size": len(file_content),
-                "file_extension": file_extension,
-            },
+            documents=[
+                document_payload(service_id, future.result(), filename, sending_method, mimetype, inspection.size)
+                for future, (_, filename, mimetype, inspection) in zip(futures, uploads)
+            ],
         ),
         201,
     )
 
 
+def upload_document_streaming(service_id):
+    """
+    Same as `upload_document`, but the request body is parsed incrementally and the document is
+    piped into both buckets while it is still being received. Only one S3 part per bucket is held
+    in memory at a time, whatever the size of the document.
+    """
+    boundary = request.mimetype_params.get("boundary")
+    if not boundary:
+        return jsonify(error="No document upload"), 400
+
+    form = {}
+    stored = None
+    writers = []
+    try:
+        for part in iter_multipart(request.stream, boundary.encode(), current_app.config["UPLOAD_STREAM_CHUNK_SIZE"]):
+            if isinstance(part, MultipartField):
+                if stored is not None and part.name in STORAGE_FORM_FIELDS:
+                    _abort_writers(writers)
+                    return jsonify(error=f"Form field '{part.name}' must be sent before the document"), 400
+                form.setdefault(part.name, part.value)
+                continue
+
+            if part.name != "document" or stored is not None:
+                continue
+
+            head = b""
+            for chunk in part.chunks:
+                head += chunk
+                if len(head) >= MIME_TYPE_SAMPLE_SIZE:
+                    break
+
+            mimetype = get_mime_type(head)
+            if not mime_type_is_allowed(mimetype, service_id):
+                return unsupported_mime_type_response(mimetype)
+            mimetype = fix_csv_mime_type(mimetype, form.get("filename"))
+
+            sending_method = form.get("sending_method")
+            document = document_store.open_writer(service_id, sending_method=sending_method, mimetype=mimetype)
+            writers = [document["writer"]]
+            if not current_app.config["SCAN_FILES_SERVER_SIDE_COPY"]:
+                writers.append(
+                    scan_files_document_store.open_writer(
+                        service_id, document["id"], sending_method=sending_method, mimetype=mimetype
+                    )
+                )
+
+            file_size = 0
+            for chunk in _prepend(head, part.chunks):
+                file_size += len(chunk)
+                for writer in writers:
+                    writer.write(chunk)
+
+            stored = (document, sending_method, mimetype, file_size)
+
+        if stored is None:
+            return jsonify(error="No document upload"), 400
+
+        document, sending_method, mimetype, file_size = stored
+        document_writer = writers[0]
+
+        def close_document_writer():
+            document_writer.close()
+            return document
+
+        if current_app.config["SCAN_FILES_SERVER_SIDE_COPY"]:
+            copy_to_scan_files_bucket(service_id, close_document_writer(), sending_method)
+        else:
+            write_to_both_buckets(service_id, document["id"], sending_method, close_document_writer, writers[1].close)
+    except InvalidMultipartError:
+        # Same response as when werkzeug can't parse the form of a buffered upload
+        _abort_writers(writers)
+        return jsonify(error="No document upload"), 400
+    except Exception:
+        _abort_writers(writers)
+        raise
+
+    return document_created_response(service_id, document, form.get("filename"), sending_method, mimetype, file_size)
+
+
+def spool_document(service_id, file_content, sending_method, mimetype, content_sha256):
+    """
+    Asynchronous counterpart of `store_document`: the document id and encryption key are chosen
+    up front, and the document is spooled to local disk and stored in the background.
+    returns dict {'id': 'some-uuid', 'encryption_key': b'32 byte encryption key'}
+    """
+    document = {
+        "id": str(uuid.uuid4()),
+        "encryption_key": None if sending_method == "template_attach" else document_store.generate_encryption_key(),
+    }
+    upload_spool.add(
+        document["id"],
+        file_content,
+        {
+            "service_id": str(service_id),
+            "document_id": document["id"],
+            "sending_method": sending_method,
+            "mimetype": mimetype,
+            "content_sha256": content_sha256,
+            "encryption_key": document["encryption_key"] and base64.b64encode(document["encryption_key"]).decode("ascii"),
+        },
+    )
+    upload_spool.submit(document["id"], store_spooled_document)
+
+    return document
+
+
+def store_spooled_document(file_content, record):
+    store_document(
+        uuid.UUID(record["service_id"]),
+        file_content,
+        record["sending_method"],
+        record["mimetype"],
+        record["content_sha256"],
+        document_id=record["document_id"],
+        encryption_key=record["encryption_key"] and base64.b64decode(record["encryption_key"]),
+    )
+
+
+def store_document(service_id, file_content, sending_method, mimetype, content_sha256, document_id=None, encryption_key=None):
+    """
+    Stores the document in the documents bucket and in the scan files bucket.
+    `content_sha256` is the hex digest computed when the document was inspected. A new document id
+    and encryption key are generated unless given.
+    returns dict {'id': 'some-uuid', 'encryption_key': b'32 byte encryption key'}
+    """
+    if sending_method == "template_attach" and current_app.config["TEMPLATE_ATTACH_DEDUPLICATION_ENABLED"]:
+        return store_deduplicated_document(service_id, file_content, mimetype, content_sha256, document_id)
+
+    return _store_in_both_buckets(
+        service_id, document_id or str(uuid.uuid4()), file_content, sending_method, mimetype, content_sha256, encryption_key
+    )
+
+
+def store_deduplicated_document(service_id, file_content, mimetype, content_sha256, document_id=None):
+    """
+    Identical template_attach documents of a service share the same stored content, and so the same
+    scan verdict. Reused content is copied onto itself in both buckets before a document points to
+    it, so the content is never older than any of its documents and can't expire before them.
+    Content older than the configured maximum age is stored, and scanned, again instead. The shared
+    content is never deleted if storing it fails, since other documents may point to it.
+    Each document still gets its own id, stored as a small object pointing to the shared content.
+    """
+    content_age = document_store.get_content_age_seconds(service_id, content_sha256)
+    if (
+        content_age is None
+        or content_age > current_app.config["TEMPLATE_ATTACH_DEDUPLICATION_MAX_AGE_SECONDS"]
+        or not refresh_content(service_id, content_sha256, mimetype)
+    ):
+        _store_in_both_buckets(
+            service_id,
+            get_content_id(content_sha256),
+            file_content,
+            "template_attach",
+            mimetype,
+            content_sha256,
+            clean_up=False,
+        )
+    else:
+        current_app.logger.info(
+            "Reusing stored content for template_attach document",
+            extra={
+                "service_id": service_id,
+                "content_sha256": content_sha256,
+            },
+        )
+
+    return document_store.put_content_reference(service_id, content_sha256, mimetype, document_id=document_id)
+
+
+def refresh_content(service_id, content_sha256, mimetype):
+    """
+    Resets the age of shared template_attach content in both buckets. Returns False if either copy
+    is missing, for the content to be stored again.
+    """
+    if not document_store.refresh_content(service_id, content_sha256, mimetype):
+        return False
+    return scan_files_document_store.refresh_content(service_id, content_sha256, mimetype)
+
+
+def _store_in_both_buckets(
+    service_id, document_id, file_content, sending_method, mimetype, content_sha256, encryption_key=None, clean_up=True
+):
+    if current_app.config["SCAN_FILES_SERVER_SIDE_COPY"]:
+        document = document_store.put(
+            service_id,
+            file_content,
+            sending_method=sending_method,
+            mimetype=mimetype,
+            document_id=document_id,
+            content_sha256=content_sha256,
+            encryption_key=encryption_key,
+        )
+        copy_to_scan_files_bucket(service_id, document, sending_method, clean_up=clean_up)
+        return document
+
+    return write_to_both_buckets(
+        service_id,
+        document_id,
+        sending_method,
+        lambda: document_store.put(
+            service_id,
+            file_content,
+            sending_method=sending_method,
+            mimetype=mimetype,
+            document_id=document_id,
+            content_sha256=content_sha256,
+            encryption_key=encryption_key,
+        ),
+        lambda: scan_files_document_store.put(
+            service_id,
+            document_id,
+            file_content,
+            sending_method=sending_method,
+            mimetype=mimetype,
+            content_sha256=content_sha256,
+        ),
+        clean_up=clean_up,
+    )
+
+
+def copy_to_scan_files_bucket(service_id, document, sending_method, clean_up=True):
+    """
+    Creates the scan file with a server-side copy of the stored document. If the copy fails, the
+    document is deleted (unless `clean_up` is False) and the error is raised.
+    """
+    try:
+        scan_files_document_store.copy_from(
+            document_store.bucket,
+            service_id,
+            document["id"],
+            sending_method,
+            encryption_key=document.get("encryption_key"),
+        )
+    except Exception:
+        if clean_up:
+            _delete_documents(service_id, document["id"], sending_method, document.get("encryption_key"), scan_file=False)
+        raise
+
+
+def write_to_both_buckets(service_id, document_id, sending_method, write_document, write_scan_file, clean_up=True):
+    """
+    Runs the writes to the documents bucket and to the scan files bucket concurrently and returns
+    the result of `write_document`. The upload is all or nothing: if one of the writes fails, the
+    object stored by the other one is deleted (unless `clean_up` is False) and the error is raised.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        document_future = submit_in_context(executor, write_document)
+        scan_file_future = submit_in_context(executor, write_scan_file)
+
+    document_error = document_future.exception()
+    scan_file_error = scan_file_future.exception()
+    if document_error is None and scan_file_error is None:
+        return document_future.result()
+    if not clean_up:
+        raise document_error or scan_file_error
+
+    _delete_documents(
+        service_id,
+        document_id,
+        sending_method,
+        document_future.result().get("encryption_key") if document_error is None else None,
+        document=document_error is None,
+        scan_file=scan_file_error is None,
+    )
+    raise document_error or scan_file_error
+
+
+def _delete_documents(service_id, document_id, sending_method, key, document=True, scan_file=True):
+    """
+    Cleans up after a failed upload. Errors are logged rather than raised, so that the error that
+    caused the upload to fail is the one reported.
+    """
+    cleanups = []
+    if document:
+        cleanups.append(lambda: document_store.delete(service_id, document_id, key, sending_method))
+    if scan_file:
+        cleanups.append(lambda: scan_files_document_store.delete(service_id, document_id, sending_method))
+
+    for cleanup in cleanups:
+        try:
+            cleanup()
+        except DocumentStoreError as e:
+            current_app.logger.error(
+                "Failed to clean up partially uploaded document: {}".format(e),
+                extra={
+                    "service_id": service_id,
+                    "document_id": document_id,
+                },
+            )
+
+
+def _prepend(head, chunks):
+    if head:
+        yield head
+    yield from chunks
+
+
+def _abort_writers(writers):
+    for writer in writers:
+        writer.abort()
+
+
+def document_created_response(service_id, document, filename, sending_method, mimetype, file_size, status_code=201):
+    return (
+        jsonify(
+            status="ok",
+            document=document_payload(service_id, document, filename, sending_method, mimetype, file_size),
+        ),
+        status_code,
+    )
+
+
+def document_payload(service_id, document, filename, sending_method, mimetype, file_size):
+    file_extension = None
+    if filename and "." in filename:
+        file_extension = "".join(pathlib.Path(filename.lower()).suffixes).lstrip(".")
+
+    return {
+        "id": document["id"],
+        "direct_file_url": get_direct_file_url(
+            service_id=service_id,
+            document_id=document["id"],
+            key=document.get("encryption_key", ""),
+            sending_method=sending_method,
+        ),
+        "url": get_api_download_url(
+            service_id=service_id,
+            document_id=document["id"],
+            key=document.get("encryption_key", ""),
+            filename=filename,
+        ),
+        "filename": filename,
+        "sending_method": sending_method,
+        "mime_type": mimetype,
+        "file_size": file_size,
+        "file_extension": file_extension,
+    }
+
+
+def unsupported_mime_type_response(mimetype):
+    return (
+        jsonify(
+            error="Unsupported document type '{}'. Supported types are: {}".format(
+                mimetype, current_app.config["ALLOWED_MIME_TYPES"]
+            )
+        ),
+        400,
+    )
+
+
+def fix_csv_mime_type(mimetype, filename):
+    # Our MIME type auto-detection resolves CSV content as text/plain,
+    # so we fix that if possible
+    if (filename or "").lower().endswith(".csv") and mimetype == "text/plain":
+        return "text/csv"
+    return mimetype
+
+
 def mime_type_is_allowed(mimetype, service_id):
     if mimetype in current_app.config["ALLOWED_MIME_TYPES"]:
         return True
@@ -1,10 +1,39 @@
+import hashlib
+from typing import NamedTuple
+
 import magic
 
+MIME_TYPE_SAMPLE_SIZE = 2048
+
+
+class DocumentInspection(NamedTuple):
+    mimetype: str
+    size: int
+    sha256: str
+
+
+def get_mime_type(document):
+    """
+    `document` is either a seekable stream, rewound after reading, or the first bytes of the document
+    """
+    if isinstance(document, (bytes, bytearray)):
+        return magic.from_buffer(bytes(document[:MIME_TYPE_SAMPLE_SIZE]), mime=True)
 
-def get_mime_type(document_stream):
     try:
-        mime_type = magic.from_buffer(document_stream.read(2048), mime=True)
+        mime_type = magic.from_buffer(document.read(MIME_TYPE_SAMPLE_SIZE), mime=True)
     finally:
-        document_stream.seek(0)
+        document.seek(0)
 
     return mime_type
+
+
+def inspect_document(file_content):
+    """
+    Returns the MIME type, size and SHA-256 (hex digest) of a document held in memory. The document
+    is hashed once, and the digest is reused by the stores (as an S3 checksum) and for deduplication.
+    """
+    return DocumentInspection(
+        mimetype=get_mime_type(file_content),
+        size=len(file_content),
+        sha256=hashlib.sha256(file_content).hexdigest(),
+    )
@@ -1,7 +1,10 @@
+from functools import wraps
+
 from flask import abort, current_app, request
 
 
 def requires_auth(fn):
+    @wraps(fn)
     def wrapper(*args, **kwargs):
         check_auth()
         return fn(*args, **kwargs)
@@ -0,0 +1,52 @@
+import io
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over (a slice of) a bytes-like buffer, used to send part of a
+    document to S3 without copying it. Several readers can share the same buffer, each one with
+    its own position.
+    """
+
+    def __init__(self, buffer, start=0, end=None):
+        self._view = memoryview(buffer)[start:end]
+        self._position = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._view[self._position : self._position + len(b)]
+        b[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else self._position + size
+        data = self._view[self._position : end].tobytes()
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def tell(self):
+        return self._position
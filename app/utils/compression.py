@@ -0,0 +1,62 @@
+import gzip
+import io
+import zlib
+
+from flask import current_app, jsonify, request
+from werkzeug.exceptions import BadRequest
+from werkzeug.wsgi import get_input_stream
+
+# Errors raised when reading corrupt or truncated compressed data
+DECOMPRESSION_ERRORS = (OSError, EOFError, zlib.error)
+
+
+def decompress_request_body():
+    """
+    Accepts request bodies compressed with gzip (`Content-Encoding` header). The body is
+    decompressed as it is read, and both the compressed and decompressed sizes are capped at
+    MAX_CONTENT_LENGTH, so a small compressed body can't expand into an unbounded upload.
+    """
+    content_encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+    if content_encoding == "identity":
+        return
+
+    if content_encoding != "gzip":
+        return jsonify(error="Unsupported Content-Encoding '{}'".format(content_encoding)), 415
+
+    max_content_length = current_app.config["MAX_CONTENT_LENGTH"]
+    stream = get_input_stream(request.environ, max_content_length=max_content_length)
+
+    # The decompressed size isn't known up front, so the stream is marked as terminated: werkzeug
+    # then reads it to the end, enforcing MAX_CONTENT_LENGTH on the decompressed bytes.
+    request.environ["wsgi.input"] = DecompressedStream(stream, content_encoding)
+    request.environ["wsgi.input_terminated"] = True
+    request.environ.pop("CONTENT_LENGTH", None)
+
+
+class InvalidCompressedBodyError(BadRequest):
+    pass
+
+
+class DecompressedStream(io.RawIOBase):
+    """
+    Read-only stream of the decompressed content of `stream`. Corrupt compressed data raises
+    `InvalidCompressedBodyError`, a 400 Bad Request.
+    """
+
+    def __init__(self, stream, content_encoding):
+        self.content_encoding = content_encoding
+        self._stream = gzip.GzipFile(fileobj=stream, mode="rb")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        try:
+            return self._stream.read(size)
+        except DECOMPRESSION_ERRORS as e:
+            raise InvalidCompressedBodyError("Invalid {} request body".format(self.content_encoding)) from e
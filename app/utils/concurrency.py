@@ -0,0 +1,122 @@
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """
+    Submits `fn` to `executor`, running it in a copy of the caller's context so that Flask's
+    `current_app` and `request` stay available in the worker. Under gunicorn's gevent worker,
+    threads are monkey-patched and the executor's workers are greenlets.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class Prefetch:
+    """
+    Starts running `fn` in the background, in the caller's context, so that it runs while the caller
+    does something else, and `result()` waits for it. Used as a context manager: if the result
+    wasn't collected by the end of the block, it is discarded, calling `discard(result)` once `fn`
+    returns to release what it holds.
+    """
+
+    def __init__(self, fn, *args, discard=None, **kwargs):
+        self.discard = discard
+        self._collected = False
+        executor = ThreadPoolExecutor(max_workers=1)
+        self._future = submit_in_context(executor, fn, *args, **kwargs)
+        executor.shutdown(wait=False)
+
+    def result(self):
+        self._collected = True
+        return self._future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self._collected and self.discard is not None:
+            self._future.add_done_callback(self._discard)
+
+    def _discard(self, future):
+        if future.exception() is None:
+            self.discard(future.result())
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: while a call is in flight, callers with the same key
+    wait for its result, or exception, instead of making the call again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Returns `(fn(*args, **kwargs), shared)`, `shared` being True if the result is the one of a call
+        made by another caller.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is None:
+                future = self._calls[key] = Future()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class Notifier:
+    """
+    Lets threads (greenlets under gevent) wait for a notification about a key, without polling.
+    """
+
+    def __init__(self):
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def wait(self, key, timeout):
+        """
+        Waits up to `timeout` seconds for `notify(key)`. Returns True if notified.
+        """
+        with self._lock:
+            event, waiters = self._events.get(key, (None, 0))
+            if event is None:
+                event = threading.Event()
+            self._events[key] = (event, waiters + 1)
+
+        try:
+            return event.wait(timeout)
+        finally:
+            with self._lock:
+                current, waiters = self._events.get(key, (None, 0))
+                if current is event:
+                    if waiters > 1:
+                        self._events[key] = (event, waiters - 1)
+                    else:
+                        del self._events[key]
+
+    def notify(self, key):
+        """
+        Wakes up the threads waiting for `key`.
+        """
+        with self._lock:
+            event, _ = self._events.pop(key, (None, 0))
+        if event is not None:
+            event.set()
@@ -0,0 +1,61 @@
+import os
+import threading
+
+
+class CounterReporter:
+    """
+    Surfaces the counters kept by the app's components (legacy key lookups, cache hits...), which
+    are per process: each source's `get_counts()` is logged every `interval` seconds, and returned
+    by `get_counts` for the status endpoint.
+    """
+
+    def __init__(self):
+        self.interval = 5 * 60
+        self._sources = {}
+        self._app = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def init_app(self, app):
+        self._app = app
+        self.interval = app.config.get("COUNTERS_LOG_INTERVAL_SECONDS", self.interval)
+
+    def register(self, name, get_counts):
+        self._sources[name] = get_counts
+
+    def get_counts(self):
+        """
+        Returns the counts of every source, keyed by "<source>.<counter>".
+        """
+        return {
+            f"{name}.{counter}": count
+            for name, get_counts in self._sources.items()
+            for counter, count in sorted(get_counts().items())
+        }
+
+    def log_counts(self):
+        counts = self.get_counts()
+        if counts:
+            self._app.logger.info("Counters", extra={"pid": os.getpid(), "counters": counts})
+
+    def start(self):
+        """
+        Logs the counts in a background thread until `stop` is called.
+        """
+        if self._thread is None and self.interval > 0:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="counter-reporter", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.log_counts()
+            except Exception:
+                self._app.logger.exception("Failed to log counters")
@@ -0,0 +1,222 @@
+import contextlib
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+from flask import current_app
+
+
+class DocumentCache:
+    """
+    Read-through cache of template_attach documents, which are downloaded by every recipient of a
+    template, so that repeat downloads don't fetch the same object from S3 again. Only whole
+    documents are cached: range and conditional requests go to S3.
+
+    Documents are cached in two tiers, each evicting the least recently used documents to stay under
+    its size limit, and expiring documents `ttl` seconds after they were cached:
+
+    - memory: documents of up to `memory_max_document_size` bytes, per process
+    - disk: documents of up to `max_document_size` bytes, in a directory shared by the gunicorn workers
+      of a pod. Disk hits are served from the open file, so that the server can send it with sendfile
+      (`wsgi.file_wrapper`) instead of copying it through the worker.
+
+    Deleting a document only removes it from the cache of the process handling the deletion (see
+    `delete`), so the other processes and pods check that the document still exists before serving
+    it from their cache, when given an `exists` function.
+
+    Counts memory hits, disk hits and misses.
+    """
+
+    def __init__(self, directory=None):
+        self.enabled = False
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "document-download-cache")
+        self.ttl = 60 * 60
+        self.max_document_size = 10 * 1024 * 1024
+        self.memory_max_bytes = 32 * 1024 * 1024
+        self.memory_max_document_size = 1024 * 1024
+        self.disk_max_bytes = 1024 * 1024 * 1024
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config.get("TEMPLATE_ATTACH_CACHE_ENABLED", self.enabled)
+        self.directory = app.config.get("TEMPLATE_ATTACH_CACHE_DIR", self.directory)
+        self.ttl = app.config.get("TEMPLATE_ATTACH_CACHE_TTL_SECONDS", self.ttl)
+        self.max_document_size = app.config.get("TEMPLATE_ATTACH_CACHE_MAX_DOCUMENT_SIZE", self.max_document_size)
+        self.memory_max_bytes = app.config.get("TEMPLATE_ATTACH_CACHE_MEMORY_MAX_BYTES", self.memory_max_bytes)
+        self.memory_max_document_size = app.config.get(
+            "TEMPLATE_ATTACH_CACHE_MEMORY_MAX_DOCUMENT_SIZE", self.memory_max_document_size
+        )
+        self.disk_max_bytes = app.config.get("TEMPLATE_ATTACH_CACHE_DISK_MAX_BYTES", self.disk_max_bytes)
+
+    def get(self, key, fetch, exists=None):
+        """
+        Returns the cached document for `key`, or else the document returned by `fetch()`, caching it
+        unless it is too large. Documents are dicts as returned by `DocumentStore.get`.
+        If given, `exists()` is called before serving a cached document, which is dropped from the
+        cache if it returns False (the document was deleted through another process).
+        """
+        document = self._get_from_memory(key)
+        if document is None:
+            document, hit = self._get_from_disk(key), "disk_hits"
+        else:
+            hit = "memory_hits"
+
+        if document is not None:
+            if exists is None or exists():
+                self._count(hit)
+                return document
+            document["body"].close()
+            self.delete(key)
+
+        self._count("misses")
+        document = fetch()
+        if document["size"] > self.max_document_size:
+            return document
+
+        try:
+            content = document["body"].read()
+        finally:
+            document["body"].close()
+        metadata = {
+            "mimetype": document["mimetype"],
+            "etag": document.get("etag"),
+            "last_modified": document["last_modified"].isoformat() if document.get("last_modified") else None,
+            "expires_at": time.time() + self.ttl,
+        }
+        try:
+            self._put_in_disk(key, content, metadata)
+        except OSError as e:
+            # The cache is an optimisation: the document is still served if it can't be cached
+            current_app.logger.warning(f"Failed to cache document on disk: {e}")
+        if len(content) <= self.memory_max_document_size:
+            self._put_in_memory(key, content, metadata)
+        return self._document(io.BytesIO(content), len(content), metadata)
+
+    def delete(self, key):
+        """
+        Removes the document from the disk tier and from the memory tier of this process. The memory
+        tiers of other processes keep it until it expires.
+        """
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory_bytes -= len(entry[0])
+        path = self._path(key)
+        self._remove(path + ".json")
+        self._remove(path)
+
+    def get_counts(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def _get_from_memory(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            content, metadata = entry
+            if metadata["expires_at"] <= time.time():
+                del self._memory[key]
+                self._memory_bytes -= len(content)
+                return None
+            self._memory.move_to_end(key)
+        return self._document(io.BytesIO(content), len(content), metadata)
+
+    def _put_in_memory(self, key, content, metadata):
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous[0])
+            self._memory[key] = (content, metadata)
+            self._memory_bytes += len(content)
+            while self._memory_bytes > self.memory_max_bytes:
+                _, (evicted, _) = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _get_from_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path + ".json") as f:
+                metadata = json.load(f)
+            if metadata["expires_at"] <= time.time():
+                self._remove(path + ".json")
+                self._remove(path)
+                return None
+            body = open(path, "rb")
+        except (FileNotFoundError, ValueError):
+            return None
+
+        # Recently used documents are the last to be evicted. The open file can still be read if
+        # another process evicted it in the meantime.
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return self._document(body, os.fstat(body.fileno()).st_size, metadata)
+
+    def _put_in_disk(self, key, content, metadata):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        path = self._path(key)
+        self._write_atomically(path, content)
+        self._write_atomically(path + ".json", json.dumps(metadata).encode())
+        self._evict_from_disk()
+
+    def _evict_from_disk(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json") or entry.name.startswith("."):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_max_bytes:
+                break
+            self._remove(path + ".json")
+            self._remove(path)
+            total -= size
+
+    def _write_atomically(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    @staticmethod
+    def _document(body, size, metadata):
+        return {
+            "body": body,
+            "mimetype": metadata["mimetype"],
+            "size": size,
+            "etag": metadata["etag"],
+            "last_modified": datetime.fromisoformat(metadata["last_modified"]) if metadata["last_modified"] else None,
+        }
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -9,3 +9,26 @@ class GuardDutyMalwareS3Verdicts(str, Enum):
     UNSUPPORTED = "UNSUPPORTED"
     ACCESS_DENIED = "ACCESS_DENIED"
     FAILED = "FAILED"
+
+
+# EventBridge detail type of the events GuardDuty Malware Protection for S3 sends once it has scanned an object
+GUARDDUTY_SCAN_RESULT_DETAIL_TYPE = "GuardDuty Malware Protection Object Scan Result"
+
+
+def parse_scan_result_event(event):
+    """
+    Returns the bucket, key and verdict of the object a GuardDuty scan result event is about, or None
+    if the event is not a scan result.
+    """
+    if not isinstance(event, dict) or event.get("detail-type") != GUARDDUTY_SCAN_RESULT_DETAIL_TYPE:
+        return None
+
+    try:
+        detail = event["detail"]
+        return (
+            detail["s3ObjectDetails"]["bucketName"],
+            detail["s3ObjectDetails"]["objectKey"],
+            detail["scanResultDetails"]["scanResultStatus"],
+        )
+    except (KeyError, TypeError):
+        return None
@@ -0,0 +1,66 @@
+from functools import partial
+from itertools import chain
+from typing import Iterator, NamedTuple
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+
+class InvalidMultipartError(ValueError):
+    pass
+
+
+class MultipartField(NamedTuple):
+    name: str
+    value: str
+
+
+class MultipartFile(NamedTuple):
+    name: str
+    filename: str | None
+    chunks: Iterator[bytes]
+
+
+def iter_multipart(stream, boundary, chunk_size):
+    """
+    Incrementally parses a multipart/form-data body, yielding each part in the order it was sent.
+
+    Form fields are yielded as `MultipartField` once their value has been read. Files are yielded as
+    `MultipartFile` whose `chunks` iterator reads the file contents from the stream as it is consumed,
+    so a file never has to be held in memory. Any chunks left unconsumed are skipped before the next
+    part is yielded. A malformed or truncated body raises `InvalidMultipartError`, from either iterator.
+    """
+    events = _iter_events(stream, boundary, chunk_size)
+
+    for event in events:
+        if isinstance(event, Field):
+            value = b"".join(_iter_data(events))
+            yield MultipartField(event.name, value.decode("utf-8", "replace"))
+        elif isinstance(event, File):
+            part = MultipartFile(event.name, event.filename, _iter_data(events))
+            yield part
+            for _ in part.chunks:
+                pass
+
+
+def _iter_events(stream, boundary, chunk_size):
+    decoder = MultipartDecoder(boundary)
+
+    for data in chain(iter(partial(stream.read, chunk_size), b""), [None]):
+        try:
+            decoder.receive_data(data)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                yield event
+                event = decoder.next_event()
+        except ValueError as e:
+            raise InvalidMultipartError(str(e)) from e
+
+
+def _iter_data(events):
+    for event in events:
+        if not isinstance(event, Data):
+            return
+        if event.data:
+            yield event.data
+        if not event.more_data:
+            return
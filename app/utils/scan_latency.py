@@ -0,0 +1,107 @@
+import bisect
+import threading
+from collections import OrderedDict, deque
+
+# Upper bounds, in seconds, of the bins scan durations are counted in. Longer scans fall in a last,
+# open-ended bin.
+SCAN_DURATION_BINS = (2, 3, 5, 8, 13, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+
+# Upper bounds, in bytes, of the document size buckets scan durations are tracked for
+SIZE_BUCKETS = (100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+
+
+def get_size_bucket(size):
+    return bisect.bisect_left(SIZE_BUCKETS, size or 0)
+
+
+class ScanLatencyHistogram:
+    """
+    Rolling histograms of how long documents took to be scanned, per size bucket, used to tell clients
+    polling for a scan verdict when to come back.
+
+    A scan's duration is counted when its verdict is read from the object's tags and found terminal,
+    as the age of the document at that point, once per document. That's an upper bound, so ages over
+    `max_duration` are left out: those verdicts were most likely known well before they were read.
+    The last `max_recorded` documents counted are remembered. Each histogram counts the last `window`
+    scans. Estimates fall back to the histogram of every document until the document's own one has
+    `min_samples` scans. Histograms are per process.
+    """
+
+    def __init__(self):
+        self.window = 200
+        self.min_samples = 10
+        self.max_duration = 15 * 60
+        self.max_recorded = 10_000
+        self._histograms = {}
+        self._recorded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.window = app.config.get("SCAN_LATENCY_WINDOW", self.window)
+        self.min_samples = app.config.get("SCAN_LATENCY_MIN_SAMPLES", self.min_samples)
+
+    def is_recorded(self, key):
+        with self._lock:
+            return key in self._recorded
+
+    def record(self, key, size, age_seconds):
+        """
+        Counts the scan of a document found to have a verdict `age_seconds` after it was stored,
+        unless it was already counted.
+        """
+        duration_bin = bisect.bisect_left(SCAN_DURATION_BINS, age_seconds)
+        with self._lock:
+            if key in self._recorded:
+                return
+            self._recorded[key] = None
+            while len(self._recorded) > self.max_recorded:
+                self._recorded.popitem(last=False)
+            if age_seconds > self.max_duration:
+                return
+            for histogram_key in (get_size_bucket(size), None):
+                self._add(histogram_key, duration_bin)
+
+    def estimate_remaining(self, size, age_seconds):
+        """
+        Returns the median number of seconds left until the scan of a document `age_seconds` old
+        completes, going by the scans of similar documents which lasted longer than that, or None if
+        there aren't enough of them.
+        """
+        with self._lock:
+            counts = self._get_counts(get_size_bucket(size))
+            if counts is None:
+                return None
+
+            first_bin = bisect.bisect_left(SCAN_DURATION_BINS, age_seconds)
+            remaining_counts = counts[first_bin:]
+            total = sum(remaining_counts)
+            if total == 0:
+                return None
+
+            median_bin = first_bin
+            seen = 0
+            for median_bin, count in enumerate(remaining_counts, start=first_bin):
+                seen += count
+                if seen * 2 >= total:
+                    break
+
+        if median_bin == len(SCAN_DURATION_BINS):
+            # Open-ended bin: the scan is slow, but there's no telling by how much
+            return None
+        return max(SCAN_DURATION_BINS[median_bin] - age_seconds, 0)
+
+    def _get_counts(self, histogram_key):
+        for key in (histogram_key, None):
+            histogram = self._histograms.get(key)
+            if histogram is not None and len(histogram[0]) >= self.min_samples:
+                return histogram[1]
+        return None
+
+    def _add(self, histogram_key, duration_bin):
+        if histogram_key not in self._histograms:
+            self._histograms[histogram_key] = (deque(), [0] * (len(SCAN_DURATION_BINS) + 1))
+        bins, counts = self._histograms[histogram_key]
+        bins.append(duration_bin)
+        counts[duration_bin] += 1
+        while len(bins) > self.window:
+            counts[bins.popleft()] -= 1
@@ -0,0 +1,100 @@
+import json
+import threading
+
+import boto3
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError as BotoClientError
+
+from app.utils.guardduty import parse_scan_result_event
+
+
+class ScanResultConsumer:
+    """
+    Consumes the GuardDuty Malware Protection for S3 scan result events delivered to an SQS queue (by an
+    EventBridge rule), recording each verdict with `ScanFilesDocumentStore.record_scan_verdict` as soon
+    as the scan completes. Downloads and scan verdict checks then find the verdict in the verdict
+    cache, and only read the object's tags on a cache miss.
+
+    Each event is received by a single consumer, so the verdict cache should be shared between the
+    consumers (the "shared_memory" backend within a pod, "redis" between pods) for every process to
+    benefit. Events are deleted from the queue once recorded, and redelivered by SQS if recording fails.
+
+    `queue` is an SQS client, or anything implementing its `receive_message` and `delete_message`
+    methods.
+    """
+
+    def __init__(self, store, queue=None):
+        self.store = store
+        self.queue = queue
+        self.enabled = False
+        self.queue_url = None
+        self.wait_time = 20
+        self.batch_size = 10
+        self._app = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def init_app(self, app):
+        self._app = app
+        self.enabled = app.config.get("SCAN_RESULT_CONSUMER_ENABLED", self.enabled)
+        self.queue_url = app.config.get("SCAN_RESULT_QUEUE_URL", self.queue_url)
+        self.wait_time = app.config.get("SCAN_RESULT_QUEUE_WAIT_TIME_SECONDS", self.wait_time)
+        if self.enabled and self.queue is None:
+            self.queue = boto3.client("sqs")
+
+    def start(self):
+        """
+        Consumes events in a background thread until `stop` is called.
+        """
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="scan-result-consumer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def poll(self):
+        """
+        Receives a batch of events, waiting up to `wait_time` seconds for one, and records their
+        verdicts. Returns the number of verdicts recorded.
+        """
+        response = self.queue.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=self.batch_size,
+            WaitTimeSeconds=self.wait_time,
+        )
+
+        recorded = 0
+        for message in response.get("Messages", []):
+            try:
+                event = json.loads(message["Body"])
+            except ValueError:
+                event = None
+
+            result = parse_scan_result_event(event)
+            if result is None:
+                self._app.logger.warning("Ignoring unexpected scan result event", extra={"message_id": message.get("MessageId")})
+            else:
+                bucket, key, verdict = result
+                self.store.record_scan_verdict(bucket, key, verdict)
+                recorded += 1
+
+            self.queue.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"])
+        return recorded
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                # Recording a verdict can log through `current_app`
+                with self._app.app_context():
+                    self.poll()
+            except (BotoClientError, BotoCoreError):
+                self._app.logger.exception("Failed to receive scan result events")
+                self._stopped.wait(self.wait_time)
+            except Exception:
+                self._app.logger.exception("Failed to record scan result events")
+                self._stopped.wait(self.wait_time)
@@ -0,0 +1,217 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+SPOOL_PENDING = "pending"
+SPOOL_STORED = "stored"
+SPOOL_FAILED = "failed"
+
+
+class UploadSpool:
+    """
+    Durable local spool for documents accepted by the asynchronous upload mode. Each document is
+    written to disk, with a JSON record holding what is needed to store it and its status, before the
+    upload is acknowledged. A pool of background workers then drains the spool to S3.
+
+    Records are locked while a worker handles them, so the gunicorn workers sharing the spool
+    directory never store the same document twice. Documents left pending by a process that died are
+    picked up when a process starts (see `start`), or else when it first spools a document. Processes
+    wait for the documents they are storing before exiting (see `drain`). Storing a document is
+    attempted up to `store_attempts` times, waiting `retry_delay` seconds after the first failure and
+    twice as long after each next one, before it is marked as failed. Once a document is stored, or
+    has failed, its content is removed and only its status is kept, until the record gets older than
+    `record_ttl`. Old records are pruned when a process starts, and then every `prune_interval`
+    seconds in the background as documents are spooled.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "document-download-spool")
+        self.max_workers = 4
+        self.record_ttl = 24 * 60 * 60
+        self.prune_interval = 60 * 60
+        self.store_attempts = 5
+        self.retry_delay = 1
+        self._app = None
+        self._executor = None
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._recovered = False
+        self._pruned_at = None
+
+    def init_app(self, app):
+        self._app = app
+        self.directory = app.config.get("UPLOAD_SPOOL_DIR", self.directory)
+        self.max_workers = app.config.get("UPLOAD_ASYNC_WORKERS", self.max_workers)
+        self.record_ttl = app.config.get("UPLOAD_SPOOL_RECORD_TTL_SECONDS", self.record_ttl)
+        self.prune_interval = app.config.get("UPLOAD_SPOOL_PRUNE_INTERVAL_SECONDS", self.prune_interval)
+        self.store_attempts = app.config.get("UPLOAD_SPOOL_STORE_ATTEMPTS", self.store_attempts)
+        self.retry_delay = app.config.get("UPLOAD_SPOOL_RETRY_DELAY_SECONDS", self.retry_delay)
+
+    def add(self, document_id, content, record):
+        """
+        Durably writes the document and its record, with a pending status.
+        """
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self._write_atomically(self._content_path(document_id), content)
+        self._write_record(document_id, dict(record, status=SPOOL_PENDING))
+
+    def start(self, handler):
+        """
+        Schedules the documents left pending by processes that died to be stored with `handler`.
+        """
+        with self._lock:
+            self._start(handler)
+
+    def submit(self, document_id, handler):
+        """
+        Schedules `handler(content, record)` to store a spooled document in the background. The
+        document's status becomes stored once it returns, or failed if it raises.
+        """
+        with self._lock:
+            self._start(handler, skip=document_id)
+            self._submit(document_id, handler)
+            if time.monotonic() - self._pruned_at > self.prune_interval:
+                self._pruned_at = time.monotonic()
+                self._track(self._executor.submit(self._prune))
+
+    def drain(self, timeout=None):
+        """
+        Waits up to `timeout` seconds for the documents being stored, before the process exits.
+        Documents not stored by then stay pending, to be recovered by the next process to start.
+        """
+        with self._lock:
+            futures = list(self._futures)
+        _, not_done = wait(futures, timeout=timeout)
+        if not_done and self._app is not None:
+            self._app.logger.warning(f"Exiting with {len(not_done)} spooled documents still being stored")
+
+    def get_status(self, document_id):
+        """
+        Returns the record of a spooled document (without its encryption key), or None.
+        """
+        try:
+            with open(self._record_path(document_id)) as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None
+        record.pop("encryption_key", None)
+        return record
+
+    def join(self):
+        """
+        Waits for the documents submitted so far to be handled.
+        """
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+    def _start(self, handler, skip=None):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="upload-spool")
+        if not self._recovered:
+            self._recovered = True
+            self._pruned_at = time.monotonic()
+            if os.path.isdir(self.directory):
+                self._recover(handler, skip=skip)
+
+    def _submit(self, document_id, handler):
+        self._track(self._executor.submit(self._drain, document_id, handler))
+
+    def _track(self, future):
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+
+    def _recover(self, handler, skip):
+        for document_id, record in self._iter_records():
+            if record["status"] == SPOOL_PENDING and document_id != skip:
+                self._submit(document_id, handler)
+        self._prune()
+
+    def _prune(self):
+        now = time.time()
+        for document_id, record in self._iter_records():
+            if record["status"] != SPOOL_PENDING and now - record["updated_at"] > self.record_ttl:
+                self._remove(self._record_path(document_id))
+
+    def _iter_records(self):
+        for name in os.listdir(self.directory):
+            document_id, extension = os.path.splitext(name)
+            if extension != ".json":
+                continue
+            record = self.get_status(document_id)
+            if record is not None:
+                yield document_id, record
+
+    def _drain(self, document_id, handler):
+        with self._app.app_context(), open(self._record_path(document_id), "r+") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Already being stored by another process
+                return
+            if os.fstat(lock.fileno()).st_ino != os.stat(self._record_path(document_id)).st_ino:
+                # Stored by another process since we opened the record, which was replaced
+                return
+
+            record = json.load(lock)
+            if record["status"] != SPOOL_PENDING:
+                return
+
+            status = self._store(document_id, record, handler)
+
+            self._write_record(document_id, {k: v for k, v in record.items() if k != "encryption_key"} | {"status": status})
+            self._remove(self._content_path(document_id))
+
+    def _store(self, document_id, record, handler):
+        extra = {"service_id": record["service_id"], "document_id": document_id}
+        for attempt in range(1, self.store_attempts + 1):
+            try:
+                with open(self._content_path(document_id), "rb") as f:
+                    content = f.read()
+                handler(content, record)
+                return SPOOL_STORED
+            except Exception:
+                if attempt == self.store_attempts:
+                    self._app.logger.exception("Failed to store spooled document", extra=extra)
+                    return SPOOL_FAILED
+                self._app.logger.warning(f"Failed to store spooled document, attempt {attempt}", exc_info=True, extra=extra)
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+    def _write_record(self, document_id, record):
+        record = dict(record, updated_at=time.time())
+        self._write_atomically(self._record_path(document_id), json.dumps(record).encode())
+
+    def _write_atomically(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def _content_path(self, document_id):
+        return os.path.join(self.directory, str(document_id))
+
+    def _record_path(self, document_id):
+        return os.path.join(self.directory, f"{document_id}.json")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
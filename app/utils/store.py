@@ -1,13 +1,23 @@
+import base64
 import os
+import threading
 import uuid
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, urlunsplit
 
 import boto3
+from botocore.exceptions import BotoCoreError
 from botocore.exceptions import ClientError as BotoClientError
 from flask import current_app
 
+from app.utils.buffer import BufferReader
+from app.utils.concurrency import Notifier, SingleFlight, submit_in_context
 from app.utils.guardduty import GUARDDUTY_SCAN_TAG, GuardDutyMalwareS3Verdicts
 from app.utils.scan_files import SCAN_FILES_SCAN_TAG, ScanVerdicts
+from app.utils.scan_latency import ScanLatencyHistogram
+from app.utils.verdict_cache import TERMINAL_SCAN_VERDICTS, create_verdict_cache
 
 
 class DocumentStoreError(Exception):
@@ -30,6 +40,180 @@ class ScanUnsupportedError(Exception):
     pass
 
 
+class RangeNotSatisfiableError(Exception):
+    """
+    The requested byte range is outside the document. `size` is the size of the whole document,
+    when S3 reports it.
+    """
+
+    def __init__(self, size=None):
+        super().__init__("Requested range not satisfiable")
+        self.size = size
+
+
+class NotModifiedError(Exception):
+    """
+    The document hasn't changed since the version named by the request's conditions. `etag` is the
+    ETag of the current version, when S3 reports it.
+    """
+
+    def __init__(self, etag=None):
+        super().__init__("Not modified")
+        self.etag = etag
+
+
+# Version of the layout of document keys, included in download URLs. Version 1 (unversioned URLs) is
+# the old layout, without the sending method prefix.
+KEY_LAYOUT_VERSION = "2"
+
+
+# S3 rejects multipart uploads whose parts (other than the last one) are smaller than 5 MiB
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+# Deduplicated template_attach documents are stored as an empty object whose metadata holds the
+# SHA-256 of the content, which is stored once per service under a content id derived from it.
+CONTENT_SHA256_METADATA = "content-sha256"
+
+
+def get_content_id(content_sha256):
+    """
+    Document id under which deduplicated template_attach content is stored
+    """
+    return f"content/{content_sha256}"
+
+
+def get_checksum_params(content_sha256):
+    """
+    put_object parameters passing a precomputed SHA-256 (hex digest) of the body, so that botocore
+    doesn't hash the body again and S3 still checks its integrity. Empty if there is no digest.
+    """
+    if content_sha256 is None:
+        return {}
+    return {"ChecksumSHA256": base64.b64encode(bytes.fromhex(content_sha256)).decode("ascii")}
+
+
+def may_have_legacy_key(sending_method, key_layout):
+    """
+    Documents stored before keys were prefixed by sending method may still be under their old key.
+    Download URLs now carry the version of the key layout they were created with, so documents with
+    a versioned URL are known to use the current layout, and their old key isn't tried.
+    template_attach documents never used the old layout.
+    """
+    return sending_method != "template_attach" and key_layout != KEY_LAYOUT_VERSION
+
+
+def is_no_such_key(error):
+    # HEAD responses have no body, so a missing key is reported by head_object as a bare 404
+    return error.response["Error"]["Code"] in ("NoSuchKey", "404")
+
+
+def raise_for_get_error(error):
+    """
+    Raises RangeNotSatisfiableError if `error` is S3 rejecting the requested byte range, or
+    NotModifiedError if it is S3 answering a conditional request with a 304.
+    """
+    if error.response["Error"]["Code"] == "InvalidRange":
+        size = error.response["Error"].get("ActualObjectSize")
+        raise RangeNotSatisfiableError(int(size) if size else None) from error
+    if error.response["Error"]["Code"] == "304":
+        headers = error.response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        raise NotModifiedError(headers.get("etag")) from error
+
+
+class LegacyKeyProbe:
+    """
+    Looks objects up at their new key, falling back to their legacy key, for documents that may
+    still be under their old key (see `may_have_legacy_key`).
+
+    By default the legacy key is only tried once the new key is known to be missing, which takes two
+    round trips to S3 for legacy documents. In parallel mode, both keys are requested at once, so
+    legacy documents are found in one round trip. The new key still takes precedence: once it is
+    found, the legacy request is cancelled if it hasn't started, or else its response is passed to
+    `discard`, to release what it holds.
+
+    Counts where each operation found its objects: at the "new" key, the "legacy" key, or "missing".
+    """
+
+    def __init__(self):
+        self.parallel = False
+        self.max_workers = 16
+        self._counts = Counter()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.parallel = app.config.get("S3_LEGACY_KEY_PARALLEL_PROBE", self.parallel)
+
+    def lookup(self, operation, request, new_key, old_key, discard=None):
+        """
+        Returns `request(new_key)`, or `request(old_key)` if there is no object at the new key.
+        Raises DocumentStoreError if neither request succeeds. Other errors raised by `request` are
+        passed through.
+        """
+        legacy = submit_in_context(self._get_executor(), request, old_key) if self.parallel else None
+
+        try:
+            response = request(new_key)
+        except BotoClientError as e:
+            if not is_no_such_key(e):
+                if legacy is not None:
+                    self._discard(legacy, discard)
+                raise DocumentStoreError(e.response["Error"])
+            error = e
+        except BaseException:
+            if legacy is not None:
+                self._discard(legacy, discard)
+            raise
+        else:
+            if legacy is not None:
+                self._discard(legacy, discard)
+            self._count(operation, "new")
+            return response
+
+        try:
+            current_app.logger.info(f"Object not found at new path {new_key}, trying old path {old_key}")
+            response = legacy.result() if legacy is not None else request(old_key)
+        except BotoClientError as legacy_error:
+            # Preserve real fallback failure modes instead of masking them as NoSuchKey.
+            if not is_no_such_key(legacy_error):
+                raise DocumentStoreError(legacy_error.response["Error"])
+            self._count(operation, "missing")
+            raise DocumentStoreError(error.response["Error"])
+
+        current_app.logger.info(f"Found object at old path {old_key}, will serve from legacy location")
+        self._count(operation, "legacy")
+        return response
+
+    def get_counts(self):
+        """
+        Returns the lookup counts, keyed by "<operation>.<outcome>"
+        """
+        with self._lock:
+            return {f"{operation}.{outcome}": count for (operation, outcome), count in self._counts.items()}
+
+    def _count(self, operation, outcome):
+        with self._lock:
+            self._counts[operation, outcome] += 1
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="legacy-key-probe")
+            return self._executor
+
+    @staticmethod
+    def _discard(future, discard):
+        if future.cancel() or discard is None:
+            return
+
+        def _discard_response(future):
+            if future.exception() is None:
+                discard(future.result())
+
+        future.add_done_callback(_discard_response)
+
+
 def get_document_key(service_id, document_id, sending_method=None):
     if sending_method == "attach":
         key_prefix = "api_attachments/"
@@ -40,22 +224,227 @@ def get_document_key(service_id, document_id, sending_method=None):
     return f"{key_prefix}{service_id}/{document_id}"
 
 
+class S3MultipartWriter:
+    """
+    Writes an S3 object incrementally. Written bytes are buffered until a full part is available and
+    then sent as part of a multipart upload. Objects smaller than a single part are sent with a plain
+    put_object when the writer is closed.
+
+    With `max_concurrency` > 1, up to that many parts are sent in parallel (and held in memory) while
+    the next ones are written. Each part is retried on its own, up to `max_part_attempts` times, so a
+    transient failure doesn't mean resending the whole document.
+
+    Parts cut from an immutable buffer (bytes) are sent as views of that buffer rather than copies,
+    so writing a whole document at once doesn't double the memory it uses. Parts assembled from
+    smaller writes are sent from the buffer they were assembled in, also without a copy.
+
+    `object_params` are passed to put_object / create_multipart_upload (ContentType, encryption...).
+    SSE-C parameters are also sent with every part, as S3 requires.
+    """
+
+    def __init__(self, s3, bucket, key, part_size=S3_MIN_PART_SIZE, max_concurrency=1, max_part_attempts=1, **object_params):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.max_part_attempts = max_part_attempts
+        self.object_params = object_params
+        self.part_params = {k: v for k, v in object_params.items() if k.startswith("SSECustomer")}
+        self.size = 0
+        self.upload_id = None
+        self.parts = []
+        self._buffer = bytearray()
+        self._executor = None
+        self._pending = []
+
+    def write(self, data):
+        self.size += len(data)
+        data = memoryview(data)
+
+        if self._buffer:
+            missing = self.part_size - len(self._buffer)
+            self._buffer += data[:missing]
+            data = data[missing:]
+            if len(self._buffer) < self.part_size:
+                return
+            # The full buffer is handed over to the part rather than copied
+            part, self._buffer = self._buffer, bytearray()
+            self._upload_part(BufferReader(part))
+
+        while len(data) >= self.part_size:
+            part = data[: self.part_size]
+            # Immutable buffers (bytes) are sent as they are instead of being copied part by part
+            self._upload_part(BufferReader(part) if part.readonly else part.tobytes())
+            data = data[self.part_size :]
+
+        self._buffer += data
+
+    def close(self):
+        try:
+            part, self._buffer = self._buffer, bytearray()
+            if self.upload_id is None:
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=part, **self.object_params)
+            else:
+                if part:
+                    self._upload_part(BufferReader(part))
+                del part
+                self._wait_for_parts()
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={"Parts": sorted(self.parts, key=lambda part: part["PartNumber"])},
+                )
+                self.upload_id = None
+        except BotoClientError as e:
+            raise DocumentStoreError(e.response["Error"])
+        finally:
+            self._buffer = bytearray()
+
+    def abort(self):
+        """
+        Discards everything written so far. Nothing is stored in S3 until the writer is closed,
+        apart from the parts of an in-progress multipart upload which are aborted here.
+        """
+        self._buffer = bytearray()
+        for future in self._pending:
+            future.cancel()
+        self._shutdown_executor()
+        if self.upload_id is None:
+            return
+
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except BotoClientError as e:
+            current_app.logger.warning(f"Failed to abort multipart upload {self.upload_id} for {self.key}: {e}")
+        self.upload_id = None
+
+    def _upload_part(self, part):
+        if self.upload_id is None:
+            try:
+                response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.object_params)
+            except BotoClientError as e:
+                raise DocumentStoreError(e.response["Error"])
+            self.upload_id = response["UploadId"]
+
+        part_number = len(self.parts) + len(self._pending) + 1
+        if self.max_concurrency <= 1:
+            self.parts.append(self._send_part(part_number, part))
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        # Wait for a slot, so that no more than `max_concurrency` parts are held in memory
+        if len(self._pending) >= self.max_concurrency:
+            self.parts.append(self._pending.pop(0).result())
+        self._pending.append(submit_in_context(self._executor, self._send_part, part_number, part))
+
+    def _send_part(self, part_number, part):
+        attempt = 1
+        while True:
+            if isinstance(part, BufferReader):
+                part.seek(0)
+            try:
+                response = self.s3.upload_part(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    PartNumber=part_number,
+                    Body=part,
+                    **self.part_params,
+                )
+                return {"PartNumber": part_number, "ETag": response["ETag"]}
+            except (BotoClientError, BotoCoreError) as e:
+                if attempt >= self.max_part_attempts or not _is_retryable(e):
+                    if isinstance(e, BotoClientError):
+                        raise DocumentStoreError(e.response["Error"])
+                    raise DocumentStoreError(str(e))
+                current_app.logger.info(f"Retrying part {part_number} of {self.key} after error: {e}")
+                attempt += 1
+
+    def _wait_for_parts(self):
+        try:
+            while self._pending:
+                self.parts.append(self._pending.pop(0).result())
+        finally:
+            self._shutdown_executor()
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._pending = []
+
+
+def _is_retryable(error):
+    if isinstance(error, BotoCoreError):
+        # Connection errors, read timeouts...
+        return True
+    status_code = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    return status_code >= 500 or error.response["Error"].get("Code") in ("RequestTimeout", "SlowDown")
+
+
 class DocumentStore:
     def __init__(self, bucket=None):
         self.s3 = boto3.client("s3")
         self.bucket = bucket
         self.get_document_key = get_document_key
+        self.part_size = S3_MIN_PART_SIZE
+        self.multipart_threshold = None
+        self.multipart_concurrency = 1
+        self.part_attempts = 1
+        self.legacy_key_probe = LegacyKeyProbe()
+        self.presigned_url_expiry = 60
+        self.presigned_url_base_url = None
 
     def init_app(self, app):
         self.bucket = app.config["DOCUMENTS_BUCKET"]
+        self.legacy_key_probe.init_app(app)
+        self.presigned_url_expiry = app.config.get("TEMPLATE_ATTACH_PRESIGNED_URL_EXPIRY_SECONDS", self.presigned_url_expiry)
+        self.presigned_url_base_url = app.config.get("TEMPLATE_ATTACH_PRESIGNED_URL_BASE_URL", self.presigned_url_base_url)
+        self.part_size = app.config.get("S3_MULTIPART_PART_SIZE", self.part_size)
+        self.multipart_threshold = app.config.get("S3_MULTIPART_THRESHOLD", self.multipart_threshold)
+        self.multipart_concurrency = app.config.get("S3_MULTIPART_CONCURRENCY", self.multipart_concurrency)
+        self.part_attempts = app.config.get("S3_MULTIPART_PART_ATTEMPTS", self.part_attempts)
 
-    def put(self, service_id, document_stream, sending_method, mimetype="application/pdf"):
+    def put(
+        self,
+        service_id,
+        document_stream,
+        sending_method,
+        mimetype="application/pdf",
+        document_id=None,
+        content_sha256=None,
+        encryption_key=None,
+    ):
         """
         returns dict {'id': 'some-uuid', 'encryption_key': b'32 byte encryption key'}
         For template_attach, uses SSE-S3 and encryption_key is None.
+        A new document id and encryption key are generated unless given.
+
+        Documents larger than the multipart threshold are sent as a multipart upload, with parts
+        sent in parallel and retried individually.
+
+        `content_sha256` is the hex digest of the document, if already known. It is sent as the
+        object checksum (single part uploads only, multipart checksums being per part).
         """
 
-        document_id = str(uuid.uuid4())
+        document_id = document_id or str(uuid.uuid4())
+        if sending_method == "template_attach":
+            encryption_key = None
+        else:
+            encryption_key = encryption_key or self.generate_encryption_key()
+
+        if self._use_multipart(document_stream):
+            writer = self._writer(self.get_document_key(service_id, document_id, sending_method), mimetype, encryption_key)
+            try:
+                writer.write(document_stream)
+                writer.close()
+            except Exception:
+                writer.abort()
+                raise
+            return {"id": document_id, "encryption_key": encryption_key}
 
         # Use SSE-S3 for template_attach, SSE-C for all others
         if sending_method == "template_attach":
@@ -65,10 +454,9 @@ class DocumentStore:
                 Body=document_stream,
                 ContentType=mimetype,
                 ServerSideEncryption="AES256",
+                **get_checksum_params(content_sha256),
             )
-            encryption_key = None
         else:
-            encryption_key = self.generate_encryption_key()
             self.s3.put_object(
                 Bucket=self.bucket,
                 Key=self.get_document_key(service_id, document_id, sending_method),
@@ -76,64 +464,266 @@ class DocumentStore:
                 ContentType=mimetype,
                 SSECustomerKey=encryption_key,
                 SSECustomerAlgorithm="AES256",
+                **get_checksum_params(content_sha256),
             )
 
         return {"id": document_id, "encryption_key": encryption_key}
 
-    def get(self, service_id, document_id, decryption_key, sending_method):
+    def open_writer(self, service_id, sending_method, mimetype="application/pdf"):
+        """
+        returns dict {'id': 'some-uuid', 'encryption_key': b'32 byte encryption key', 'writer': S3MultipartWriter}
+        The document is stored once the writer is closed, with the same encryption as `put`.
+        """
+
+        document_id = str(uuid.uuid4())
+        encryption_key = None if sending_method == "template_attach" else self.generate_encryption_key()
+
+        # The document is being received while it is written, so parts are sent one at a time to hold
+        # a single part in memory, rather than buffering up to S3_MULTIPART_CONCURRENCY of them
+        writer = self._writer(
+            self.get_document_key(service_id, document_id, sending_method), mimetype, encryption_key, max_concurrency=1
+        )
+
+        return {"id": document_id, "encryption_key": encryption_key, "writer": writer}
+
+    def put_content_reference(self, service_id, content_sha256, mimetype="application/pdf", document_id=None):
+        """
+        Stores a template_attach document whose content is shared with other documents of the service,
+        and was stored with `get_content_id(content_sha256)` as its document id.
+        A new document id is generated unless one is given.
+        returns dict {'id': 'some-uuid', 'encryption_key': None}
+        """
+
+        document_id = document_id or str(uuid.uuid4())
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.get_document_key(service_id, document_id, "template_attach"),
+            Body=b"",
+            ContentType=mimetype,
+            ServerSideEncryption="AES256",
+            Metadata={CONTENT_SHA256_METADATA: content_sha256},
+        )
+
+        return {"id": document_id, "encryption_key": None}
+
+    def get_content_age_seconds(self, service_id, content_sha256):
+        """
+        Returns the age of shared template_attach content, or None if it isn't stored.
+        """
+        try:
+            response = self.s3.head_object(
+                Bucket=self.bucket,
+                Key=self.get_document_key(service_id, get_content_id(content_sha256), "template_attach"),
+            )
+        except BotoClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise DocumentStoreError(e.response["Error"])
+
+        return (datetime.now(timezone.utc) - response["LastModified"]).total_seconds()
+
+    def refresh_content(self, service_id, content_sha256, mimetype="application/pdf"):
+        """
+        Copies shared template_attach content onto itself, so that its age starts again from now.
+        Returns False if it isn't stored.
+        """
+        key = self.get_document_key(service_id, get_content_id(content_sha256), "template_attach")
+        try:
+            # S3 only copies an object onto itself if something changes, so the metadata is replaced
+            self.s3.copy_object(
+                Bucket=self.bucket,
+                Key=key,
+                CopySource={"Bucket": self.bucket, "Key": key},
+                MetadataDirective="REPLACE",
+                ContentType=mimetype,
+                ServerSideEncryption="AES256",
+            )
+        except BotoClientError as e:
+            if is_no_such_key(e):
+                return False
+            raise DocumentStoreError(e.response["Error"])
+        return True
+
+    def document_exists(self, service_id, document_id, sending_method):
+        """
+        Returns whether a template_attach document is still stored, without getting it.
+        """
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self.get_document_key(service_id, document_id, sending_method))
+        except BotoClientError as e:
+            if is_no_such_key(e):
+                return False
+            raise DocumentStoreError(e.response["Error"])
+        return True
+
+    def _use_multipart(self, document):
+        return (
+            self.multipart_threshold is not None
+            and isinstance(document, (bytes, bytearray, memoryview))
+            and len(document) > self.multipart_threshold
+        )
+
+    def _writer(self, key, mimetype, encryption_key, max_concurrency=None):
+        # SSE-S3 when there is no customer key (template_attach), SSE-C otherwise
+        if encryption_key is None:
+            encryption_params = {"ServerSideEncryption": "AES256"}
+        else:
+            encryption_params = {"SSECustomerKey": encryption_key, "SSECustomerAlgorithm": "AES256"}
+
+        return S3MultipartWriter(
+            self.s3,
+            self.bucket,
+            key,
+            self.part_size,
+            max_concurrency=max_concurrency or self.multipart_concurrency,
+            max_part_attempts=self.part_attempts,
+            ContentType=mimetype,
+            **encryption_params,
+        )
+
+    def get(
+        self,
+        service_id,
+        document_id,
+        decryption_key,
+        sending_method,
+        key_layout=None,
+        byte_range=None,
+        if_none_match=None,
+        if_modified_since=None,
+    ):
         """
         decryption_key should be raw bytes (not needed for template_attach)
+        key_layout is the key layout version from the download URL, if any (see `may_have_legacy_key`)
+        byte_range is a `Range` header value (e.g. "bytes=0-1023") to only get part of the document, in
+        which case `size` is the size of the part and `content_range` its `Content-Range` header value.
+        Raises RangeNotSatisfiableError if the range is outside the document.
+        if_none_match (an `If-None-Match` header value) and if_modified_since (a datetime) make the
+        request conditional: NotModifiedError is raised, without getting the body, if they match.
         """
         new_key = self.get_document_key(service_id, document_id, sending_method)
+        get_params = {
+            name: value
+            for name, value in (("Range", byte_range), ("IfNoneMatch", if_none_match), ("IfModifiedSince", if_modified_since))
+            if value
+        }
 
-        try:
-            # SSE-S3 for template_attach, SSE-C for all others
-            if sending_method == "template_attach":
-                document = self.s3.get_object(
+        def get_encrypted_object(key):
+            try:
+                return self.s3.get_object(
                     Bucket=self.bucket,
-                    Key=new_key,
-                )
-            else:
-                document = self.s3.get_object(
-                    Bucket=self.bucket,
-                    Key=new_key,
+                    Key=key,
                     SSECustomerKey=decryption_key,
                     SSECustomerAlgorithm="AES256",
+                    **get_params,
                 )
+            except BotoClientError as e:
+                raise_for_get_error(e)
+                raise
+
+        if may_have_legacy_key(sending_method, key_layout):
+            # Fallback to old path structure for backward compatibility
+            # Old structure: {service_id}/{document_id} for link, tmp/{service_id}/{document_id} for attach
+            document = self.legacy_key_probe.lookup(
+                "get_object",
+                get_encrypted_object,
+                new_key,
+                self._get_old_document_key(service_id, document_id, sending_method),
+                discard=lambda document: document["Body"].close(),
+            )
+            return self._document(document)
 
-            return {
-                "body": document["Body"],
-                "mimetype": document["ContentType"],
-                "size": document["ContentLength"],
-            }
+        try:
+            # SSE-S3 for template_attach, SSE-C for all others
+            if sending_method == "template_attach":
+                document = self._get_template_attach_object(service_id, new_key, sending_method, get_params)
+            else:
+                document = get_encrypted_object(new_key)
         except BotoClientError as e:
-            if e.response["Error"]["Code"] == "NoSuchKey" and sending_method != "template_attach":
-                # Fallback to old path structure for backward compatibility
-                # Old structure: {service_id}/{document_id} for link, tmp/{service_id}/{document_id} for attach
-                old_key = self._get_old_document_key(service_id, document_id, sending_method)
-
-                try:
-                    current_app.logger.info(f"File not found at new path {new_key}, trying old path {old_key}")
-                    document = self.s3.get_object(
-                        Bucket=self.bucket,
-                        Key=old_key,
-                        SSECustomerKey=decryption_key,
-                        SSECustomerAlgorithm="AES256",
-                    )
-                    current_app.logger.info(f"Found file at old path {old_key}, will serve from legacy location")
-
-                    return {
-                        "body": document["Body"],
-                        "mimetype": document["ContentType"],
-                        "size": document["ContentLength"],
-                    }
-                except BotoClientError as fallback_error:
-                    if fallback_error.response["Error"]["Code"] != "NoSuchKey":
-                        raise DocumentStoreError(fallback_error.response["Error"])
-                    # Fall through to raise original error when both paths are missing
+            raise DocumentStoreError(e.response["Error"])
 
+        return self._document(document)
+
+    def get_presigned_url(self, service_id, document_id, sending_method, content_disposition=None):
+        """
+        Returns a short-lived presigned URL to download a template_attach document straight from S3
+        (SSE-S3 objects need no customer key), served with the document's content type and the
+        given `Content-Disposition` header value.
+        When a base URL is configured, for a CDN in front of the bucket, the URL points to it instead.
+        """
+        if sending_method != "template_attach":
+            raise ValueError("Only template_attach documents can be downloaded with a presigned URL")
+
+        key = self.get_document_key(service_id, document_id, sending_method)
+        try:
+            # Also checks that the document exists before sending the client to it
+            document = self.s3.head_object(Bucket=self.bucket, Key=key)
+        except BotoClientError as e:
             raise DocumentStoreError(e.response["Error"])
 
+        content_sha256 = (document.get("Metadata") or {}).get(CONTENT_SHA256_METADATA)
+        if content_sha256:
+            # Deduplicated document: send the client to the shared content
+            key = self.get_document_key(service_id, get_content_id(content_sha256), sending_method)
+
+        params = {"Bucket": self.bucket, "Key": key, "ResponseContentType": document["ContentType"]}
+        if content_disposition:
+            params["ResponseContentDisposition"] = content_disposition
+        url = self.s3.generate_presigned_url("get_object", Params=params, ExpiresIn=self.presigned_url_expiry)
+
+        if self.presigned_url_base_url:
+            # The CDN forwards the signed query string to S3, with the bucket's host
+            base_url = urlsplit(self.presigned_url_base_url)
+            url = urlunsplit(urlsplit(url)._replace(scheme=base_url.scheme, netloc=base_url.netloc))
+        return url
+
+    def _get_template_attach_object(self, service_id, key, sending_method, get_params):
+        try:
+            document = self.s3.get_object(
+                Bucket=self.bucket,
+                Key=key,
+                **get_params,
+            )
+        except BotoClientError as e:
+            if e.response["Error"]["Code"] != "InvalidRange":
+                raise_for_get_error(e)
+                raise
+            # Deduplicated documents are empty, so no byte range of them can be satisfied: only
+            # their metadata is needed, to find their content
+            document = self.s3.head_object(Bucket=self.bucket, Key=key)
+            if not (document.get("Metadata") or {}).get(CONTENT_SHA256_METADATA):
+                raise_for_get_error(e)
+                raise
+
+        content_sha256 = (document.get("Metadata") or {}).get(CONTENT_SHA256_METADATA)
+        if not content_sha256:
+            return document
+
+        # Deduplicated document: serve the shared content, with the document's own content type
+        if "Body" in document:
+            document["Body"].close()
+        try:
+            content = self.s3.get_object(
+                Bucket=self.bucket,
+                Key=self.get_document_key(service_id, get_content_id(content_sha256), sending_method),
+                **get_params,
+            )
+        except BotoClientError as e:
+            raise_for_get_error(e)
+            raise
+        return {**content, "ContentType": document["ContentType"]}
+
+    @staticmethod
+    def _document(document):
+        return {
+            "body": document["Body"],
+            "mimetype": document["ContentType"],
+            "size": document["ContentLength"],
+            "content_range": document.get("ContentRange"),
+            "etag": document.get("ETag"),
+            "last_modified": document.get("LastModified"),
+        }
+
     def _get_old_document_key(self, service_id, document_id, sending_method):
         """
         Get the old path structure before folder reorganization.
@@ -179,9 +769,24 @@ class ScanFilesDocumentStore:
         self.bucket = bucket
         self.get_document_key = get_document_key
         self._get_old_document_key = staticmethod(self._get_old_document_key_impl)
+        self.part_size = S3_MIN_PART_SIZE
+        self.documents_bucket = None
+        self.verdict_cache = None
+        self.legacy_key_probe = LegacyKeyProbe()
+        self.verdict_flights = None
+        self.verdict_events = Notifier()
+        self.scan_latency = ScanLatencyHistogram()
 
     def init_app(self, app):
         self.bucket = app.config["SCAN_FILES_DOCUMENTS_BUCKET"]
+        self.legacy_key_probe.init_app(app)
+        self.scan_latency.init_app(app)
+        if app.config.get("DOWNLOAD_SINGLEFLIGHT_ENABLED"):
+            self.verdict_flights = SingleFlight()
+        # Used to find the shared content of deduplicated template_attach documents
+        self.documents_bucket = app.config.get("DOCUMENTS_BUCKET", self.documents_bucket)
+        self.part_size = app.config.get("S3_MULTIPART_PART_SIZE", self.part_size)
+        self.verdict_cache = create_verdict_cache(app.config)
         print(f"self.bucket: {self.bucket}")
 
     @staticmethod
@@ -196,45 +801,168 @@ class ScanFilesDocumentStore:
             # link mode or None
             return f"{service_id}/{document_id}"
 
-    def put(self, service_id, document_id, document_stream, sending_method, mimetype="application/pdf"):
+    def put(self, service_id, document_id, document_stream, sending_method, mimetype="application/pdf", content_sha256=None):
         self.s3.put_object(
             Bucket=self.bucket,
             Key=self.get_document_key(service_id, document_id, sending_method),
             Body=document_stream,
             ContentType=mimetype,
+            **get_checksum_params(content_sha256),
+        )
+
+    def copy_from(self, source_bucket, service_id, document_id, sending_method, encryption_key=None):
+        """
+        Creates the scan file with a server-side copy of the same document in `source_bucket`, so
+        the document bytes are only uploaded to S3 once. `encryption_key` is the SSE-C key of the
+        source document (None for template_attach, which uses SSE-S3). The content type is copied
+        along with the object.
+        """
+        key = self.get_document_key(service_id, document_id, sending_method)
+
+        if encryption_key is None:
+            self.s3.copy_object(
+                Bucket=self.bucket,
+                Key=key,
+                CopySource={"Bucket": source_bucket, "Key": key},
+            )
+        else:
+            self.s3.copy_object(
+                Bucket=self.bucket,
+                Key=key,
+                CopySource={"Bucket": source_bucket, "Key": key},
+                CopySourceSSECustomerKey=encryption_key,
+                CopySourceSSECustomerAlgorithm="AES256",
+            )
+
+    def refresh_content(self, service_id, content_sha256, mimetype="application/pdf"):
+        """
+        Copies the scan file of shared template_attach content onto itself, keeping its tags and so
+        its scan verdict, so that its age starts again from now. Returns False if it isn't stored.
+        """
+        key = self.get_document_key(service_id, get_content_id(content_sha256), "template_attach")
+        try:
+            # S3 only copies an object onto itself if something changes, so the metadata is replaced
+            self.s3.copy_object(
+                Bucket=self.bucket,
+                Key=key,
+                CopySource={"Bucket": self.bucket, "Key": key},
+                MetadataDirective="REPLACE",
+                ContentType=mimetype,
+            )
+        except BotoClientError as e:
+            if is_no_such_key(e):
+                return False
+            raise DocumentStoreError(e.response["Error"])
+        return True
+
+    def open_writer(self, service_id, document_id, sending_method, mimetype="application/pdf"):
+        """
+        Streaming counterpart of `put`: the document is stored once the returned writer is closed.
+        """
+        return S3MultipartWriter(
+            self.s3,
+            self.bucket,
+            self.get_document_key(service_id, document_id, sending_method),
+            self.part_size,
+            ContentType=mimetype,
         )
 
-    def check_scan_verdict(self, service_id, document_id, sending_method):
+    def check_scan_verdict(self, service_id, document_id, sending_method, key_layout=None):
         """
         S3 scanning will write the scan verdict as a tag on the S3 object.
         Inspect this value and raise an error accordingly.
-        Falls back to old path structure for backward compatibility during migration.
+        Falls back to old path structure for backward compatibility during migration, for unversioned URLs.
+        Terminal verdicts are cached, when the verdict cache is enabled. With singleflight enabled,
+        concurrent checks of the same document share one lookup. The first terminal verdict read from
+        the tags of a document is counted in `scan_latency`.
         """
+        if self.verdict_flights is None:
+            return self._check_scan_verdict(service_id, document_id, sending_method, key_layout)
+
+        verdict, _ = self.verdict_flights.do(
+            (service_id, document_id, sending_method, key_layout),
+            self._check_scan_verdict,
+            service_id,
+            document_id,
+            sending_method,
+            key_layout,
+        )
+        return verdict
 
+    def _check_scan_verdict(self, service_id, document_id, sending_method, key_layout):
         new_key = self.get_document_key(service_id, document_id, sending_method)
 
-        try:
-            response = self.s3.get_object_tagging(Bucket=self.bucket, Key=new_key)
-        except BotoClientError as e:
-            # Fallback to old path for legacy files (only if NoSuchKey and not template_attach)
-            if e.response["Error"]["Code"] == "NoSuchKey" and sending_method != "template_attach":
-                old_key = self._get_old_document_key(service_id, document_id, sending_method)
-                try:
-                    current_app.logger.info(f"Scan verdict not found at new path {new_key}, trying old path {old_key}")
-                    response = self.s3.get_object_tagging(Bucket=self.bucket, Key=old_key)
-                    current_app.logger.info(f"Found object at old path {old_key} for scan verdict check")
-                except BotoClientError as fallback_error:
-                    # Preserve real fallback failure modes instead of masking them as NoSuchKey.
-                    if fallback_error.response["Error"]["Code"] != "NoSuchKey":
-                        raise DocumentStoreError(fallback_error.response["Error"])
+        if self.verdict_cache and (cached_status := self.verdict_cache.get(new_key)):
+            return self._raise_for_verdict(cached_status)
+
+        if may_have_legacy_key(sending_method, key_layout):
+            # Fallback to old path for legacy files
+            response = self.legacy_key_probe.lookup(
+                "get_object_tagging",
+                lambda key: self.s3.get_object_tagging(Bucket=self.bucket, Key=key),
+                new_key,
+                self._get_old_document_key(service_id, document_id, sending_method),
+            )
+        else:
+            try:
+                response = self.s3.get_object_tagging(Bucket=self.bucket, Key=new_key)
+            except BotoClientError as e:
+                if is_no_such_key(e) and (content_key := self._get_content_key(service_id, document_id, sending_method)):
+                    try:
+                        response = self.s3.get_object_tagging(Bucket=self.bucket, Key=content_key)
+                    except BotoClientError as content_error:
+                        raise DocumentStoreError(content_error.response["Error"])
+                else:
                     raise DocumentStoreError(e.response["Error"])
-            else:
-                raise DocumentStoreError(e.response["Error"])
 
         tag_dict = {t["Key"]: t["Value"] for t in response["TagSet"]}
 
         # Support both GuardDuty and ScanFiles tags for scan verdicts during the transition to GuardDuty
         av_status = tag_dict.get(GUARDDUTY_SCAN_TAG) or tag_dict.get(SCAN_FILES_SCAN_TAG)
+        if self.verdict_cache:
+            self.verdict_cache.set(new_key, av_status)
+        if av_status in TERMINAL_SCAN_VERDICTS:
+            self.verdict_events.notify(new_key)
+            self._record_scan_duration(service_id, document_id, sending_method, key_layout)
+        return self._raise_for_verdict(av_status)
+
+    def _record_scan_duration(self, service_id, document_id, sending_method, key_layout):
+        key = (service_id, document_id)
+        if self.scan_latency.is_recorded(key):
+            return
+        try:
+            age_data = self.get_object_age_seconds(service_id, document_id, sending_method, key_layout=key_layout)
+        except (DocumentStoreError, BotoCoreError) as e:
+            current_app.logger.info(f"Failed to get the age of scanned document {document_id}: {e}")
+            return
+        self.scan_latency.record(key, age_data.get("size"), age_data["age_seconds"])
+
+    def record_scan_verdict(self, bucket, key, verdict):
+        """
+        Records the scan verdict of a scan file, as reported by a scan result event, so that
+        `check_scan_verdict` finds it in the verdict cache instead of reading the object's tags.
+        Ignores objects of other buckets. The shared content of deduplicated template_attach documents
+        isn't found by document key, so their verdicts are still read from the tags.
+        """
+        if bucket != self.bucket:
+            return
+        if self.verdict_cache:
+            self.verdict_cache.set(key, verdict)
+        if verdict in TERMINAL_SCAN_VERDICTS:
+            self.verdict_events.notify(key)
+
+    def wait_for_scan_verdict(self, service_id, document_id, sending_method, timeout):
+        """
+        Waits up to `timeout` seconds for a terminal scan verdict of the document to be found by this
+        process. Returns True if one was, in which case `check_scan_verdict` should be called again.
+        """
+        return self.verdict_events.wait(self.get_document_key(service_id, document_id, sending_method), timeout)
+
+    @staticmethod
+    def _raise_for_verdict(av_status):
+        """
+        Raises the error matching a scan verdict, or returns the verdict if the document can be downloaded.
+        """
         if av_status is None or av_status == ScanVerdicts.IN_PROGRESS.value:
             raise ScanInProgressError("Content scanning is in progress")
         elif av_status in (
@@ -254,6 +982,46 @@ class ScanFilesDocumentStore:
             raise ScanFailedError(f"Scan failed with status {av_status}")
         return av_status
 
+    def _get_content_key(self, service_id, document_id, sending_method):
+        """
+        Deduplicated template_attach documents have no scan file of their own: the scan file is the one
+        of their shared content, found from the document's metadata in the documents bucket.
+        Returns None for any other document.
+        """
+        if sending_method != "template_attach" or not self.documents_bucket:
+            return None
+
+        try:
+            response = self.s3.head_object(
+                Bucket=self.documents_bucket,
+                Key=self.get_document_key(service_id, document_id, sending_method),
+            )
+        except BotoClientError:
+            return None
+
+        content_sha256 = (response.get("Metadata") or {}).get(CONTENT_SHA256_METADATA)
+        if not content_sha256:
+            return None
+        return self.get_document_key(service_id, get_content_id(content_sha256), sending_method)
+
+    def document_exists(self, service_id, document_id, sending_method):
+        """
+        Returns whether the scan file of a document is stored. Uploads store it along with the
+        document, and remove it if storing the document fails.
+        """
+        try:
+            # ETag doesn't matter, but ObjectAttributes can't be empty
+            self.s3.get_object_attributes(
+                Bucket=self.bucket,
+                Key=self.get_document_key(service_id, document_id, sending_method),
+                ObjectAttributes=["ETag"],
+            )
+        except BotoClientError as e:
+            if is_no_such_key(e):
+                return False
+            raise DocumentStoreError(e.response["Error"])
+        return True
+
     def delete(self, service_id, document_id, sending_method):
         """
         Delete a document from S3.
@@ -266,37 +1034,41 @@ class ScanFilesDocumentStore:
         except BotoClientError as e:
             raise DocumentStoreError(e.response["Error"])
 
-    def get_object_age_seconds(self, service_id, document_id, sending_method) -> dict:
+    def get_object_age_seconds(self, service_id, document_id, sending_method, key_layout=None) -> dict:
         """
-        Returns the object age in seconds, as well as some data for debugging purposes.
+        Returns the object age in seconds, along with its size, as well as some data for debugging purposes.
         Returns {"age_seconds": 0, ... } if the age would be negative.
-        Falls back to old path structure for backward compatibility during migration.
+        Falls back to old path structure for backward compatibility during migration, for unversioned URLs.
         """
 
         new_key = self.get_document_key(service_id, document_id, sending_method)
 
-        try:
-            # ETag doesn't matter, but I need to specify ObjectAttributes
-            response = self.s3.get_object_attributes(
+        def get_object_attributes(key):
+            return self.s3.get_object_attributes(
                 Bucket=self.bucket,
-                Key=new_key,
-                ObjectAttributes=["ETag"],
+                Key=key,
+                ObjectAttributes=["ETag", "ObjectSize"],
             )
-        except BotoClientError as e:
+
+        if may_have_legacy_key(sending_method, key_layout):
             # Fallback to old path for legacy files
-            if e.response["Error"]["Code"] == "NoSuchKey" and sending_method != "template_attach":
-                old_key = self._get_old_document_key(service_id, document_id, sending_method)
-                try:
-                    current_app.logger.info(f"Object not found at new path {new_key}, checking old path {old_key}")
-                    response = self.s3.get_object_attributes(
-                        Bucket=self.bucket,
-                        Key=old_key,
-                        ObjectAttributes=["ETag"],
-                    )
-                except BotoClientError as fallback_error:
-                    raise DocumentStoreError(fallback_error.response["Error"])
-            else:
-                raise DocumentStoreError(e.response["Error"])
+            response = self.legacy_key_probe.lookup(
+                "get_object_attributes",
+                get_object_attributes,
+                new_key,
+                self._get_old_document_key(service_id, document_id, sending_method),
+            )
+        else:
+            try:
+                response = get_object_attributes(new_key)
+            except BotoClientError as e:
+                if is_no_such_key(e) and (content_key := self._get_content_key(service_id, document_id, sending_method)):
+                    try:
+                        response = get_object_attributes(content_key)
+                    except BotoClientError as content_error:
+                        raise DocumentStoreError(content_error.response["Error"])
+                else:
+                    raise DocumentStoreError(e.response["Error"])
 
         last_modified = response["ResponseMetadata"]["HTTPHeaders"]["last-modified"]
         last_modified_parsed = datetime.strptime(last_modified, "%a, %d %b %Y %H:%M:%S %Z")
@@ -310,6 +1082,7 @@ class ScanFilesDocumentStore:
 
         return {
             "age_seconds": age_seconds,
+            "size": response.get("ObjectSize"),
             "last_modified": last_modified,
             "last_modified_parsed": last_modified_parsed,
             "now": now,
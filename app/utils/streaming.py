@@ -0,0 +1,48 @@
+import time
+
+from flask import current_app
+
+
+class StreamedBody:
+    """
+    WSGI response iterable streaming an S3 `StreamingBody` in chunks of `chunk_size` bytes, so that at
+    most one chunk is buffered however slowly the client reads.
+
+    The server closes the iterable once the response is sent, or as soon as the client disconnects,
+    which closes the body and releases its S3 connection straight away rather than when the body is
+    garbage collected. The transfer rate is then logged.
+    """
+
+    def __init__(self, body, chunk_size, extra=None):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.extra = extra or {}
+        self.bytes_sent = 0
+        self.completed = False
+        self._logger = current_app.logger
+        self._started_at = None
+        self._closed = False
+
+    def __iter__(self):
+        self._started_at = time.monotonic()
+        for chunk in self.body.iter_chunks(self.chunk_size):
+            self.bytes_sent += len(chunk)
+            yield chunk
+        self.completed = True
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.body.close()
+
+        duration = time.monotonic() - self._started_at if self._started_at is not None else 0
+        self._logger.info(
+            "Streamed document" if self.completed else "Client disconnected while streaming document",
+            extra={
+                **self.extra,
+                "bytes_sent": self.bytes_sent,
+                "duration_seconds": round(duration, 3),
+                "bytes_per_second": round(self.bytes_sent / duration) if duration > 0 else None,
+            },
+        )
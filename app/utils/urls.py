@@ -3,6 +3,11 @@ from urllib.parse import quote, urlencode, urlunsplit
 from flask import current_app, url_for
 from notifications_utils.base64_uuid import bytes_to_base64, uuid_to_base64
 
+from app.utils.store import KEY_LAYOUT_VERSION
+
+# Query parameter holding the key layout version, so that downloads go straight to the right S3 key
+KEY_LAYOUT_PARAM = "v"
+
 
 def get_direct_file_url(service_id, document_id, key, sending_method):
     return url_for(
@@ -12,6 +17,7 @@ def get_direct_file_url(service_id, document_id, key, sending_method):
         key=bytes_to_base64(key) if key else "",
         sending_method=sending_method,
         _external=True,
+        **{KEY_LAYOUT_PARAM: KEY_LAYOUT_VERSION},
     )
 
 
@@ -24,6 +30,7 @@ def get_api_download_url(service_id, document_id, key, filename):
         query_params["key"] = bytes_to_base64(key)
     if filename:
         query_params["filename"] = filename
+    query_params[KEY_LAYOUT_PARAM] = KEY_LAYOUT_VERSION
     query = urlencode(query_params, quote_via=quote)
 
     return urlunsplit([scheme, netloc, path, query, None])
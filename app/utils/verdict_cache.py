@@ -0,0 +1,206 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import current_app
+
+from app.utils.guardduty import GuardDutyMalwareS3Verdicts
+from app.utils.scan_files import ScanVerdicts
+
+# Scan verdicts that never change once set, and so can be cached. Verdicts are stored as their
+# position in this tuple (0 meaning empty), so new verdicts must be appended.
+TERMINAL_SCAN_VERDICTS = (
+    GuardDutyMalwareS3Verdicts.NO_THREATS_FOUND.value,
+    GuardDutyMalwareS3Verdicts.THREATS_FOUND.value,
+    ScanVerdicts.CLEAN.value,
+    ScanVerdicts.MALICIOUS.value,
+    ScanVerdicts.SUSPICIOUS.value,
+)
+
+VERDICT_CACHE_BACKENDS = ("memory", "shared_memory", "redis")
+
+
+def create_verdict_cache(config):
+    """
+    Returns the verdict cache selected by SCAN_VERDICT_CACHE_BACKEND, or None if caching is disabled.
+    Verdict caches implement `get(key)` and `set(key, verdict)`, `set` ignoring non-terminal verdicts.
+
+    - memory: per process
+    - shared_memory: shared by the workers of a pod
+    - redis: shared by every pod
+    """
+    if not config.get("SCAN_VERDICT_CACHE_ENABLED"):
+        return None
+
+    backend = config.get("SCAN_VERDICT_CACHE_BACKEND", "shared_memory")
+    max_entries = config["SCAN_VERDICT_CACHE_MAX_ENTRIES"]
+    ttl = config["SCAN_VERDICT_CACHE_TTL_SECONDS"]
+    if backend == "memory":
+        return InMemoryVerdictCache(max_entries, ttl)
+    if backend == "shared_memory":
+        return SharedMemoryVerdictCache(config["SCAN_VERDICT_CACHE_PATH"], max_entries, ttl)
+    if backend == "redis":
+        import redis
+
+        timeout = config["SCAN_VERDICT_CACHE_REDIS_TIMEOUT_SECONDS"]
+        client = redis.Redis.from_url(
+            config["SCAN_VERDICT_CACHE_REDIS_URL"], socket_timeout=timeout, socket_connect_timeout=timeout
+        )
+        return RedisVerdictCache(client, ttl)
+    raise ValueError(f"Unknown scan verdict cache backend '{backend}', expected one of {VERDICT_CACHE_BACKENDS}")
+
+
+class InMemoryVerdictCache:
+    """
+    Cache of terminal scan verdicts, keyed by S3 key, local to the process. Holds up to `max_entries`
+    verdicts, evicting the least recently used one, each expiring `ttl` seconds after being set.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            verdict, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return verdict
+
+    def set(self, key, verdict):
+        if verdict not in TERMINAL_SCAN_VERDICTS:
+            return
+
+        with self._lock:
+            self._entries[key] = (verdict, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SharedMemoryVerdictCache:
+    """
+    Cache of terminal scan verdicts, keyed by S3 key, shared by all the gunicorn workers of a pod
+    through a memory-mapped file (in /dev/shm by default, so it never touches the disk).
+
+    The cache is a fixed-size hash table of `max_entries` slots, split into buckets of `WAYS` slots.
+    A new entry replaces an expired one of its bucket, or else the one closest to expiring, which
+    bounds the memory used without any bookkeeping. Entries expire `ttl` seconds after being set.
+    Accesses are serialised with a lock on the file (between processes) and a thread lock (between
+    the threads / greenlets of a process).
+    """
+
+    WAYS = 8
+    # key digest, expiry timestamp, verdict
+    SLOT = struct.Struct("16sdB7x")
+
+    def __init__(self, path, max_entries, ttl):
+        self.ttl = ttl
+        self.buckets = max(1, -(-max_entries // self.WAYS))
+        self.size = self.buckets * self.WAYS * self.SLOT.size
+        self._lock = threading.Lock()
+
+        self._file = open(path, "a+b")
+        with self._locked():
+            if os.fstat(self._file.fileno()).st_size != self.size:
+                # New cache, or one sized by a different configuration: start empty
+                self._file.truncate(0)
+                self._file.truncate(self.size)
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+
+    def get(self, key):
+        """
+        Returns the cached verdict for `key`, or None.
+        """
+        digest = self._digest(key)
+        now = time.time()
+        with self._locked():
+            for offset in self._bucket(digest):
+                slot_digest, expires_at, verdict = self.SLOT.unpack_from(self._map, offset)
+                if slot_digest == digest and verdict and expires_at > now:
+                    return TERMINAL_SCAN_VERDICTS[verdict - 1]
+        return None
+
+    def set(self, key, verdict):
+        """
+        Caches `verdict` for `key`, unless it isn't a terminal verdict.
+        """
+        if verdict not in TERMINAL_SCAN_VERDICTS:
+            return
+
+        digest = self._digest(key)
+        now = time.time()
+        with self._locked():
+            victim, victim_expires_at = None, None
+            for offset in self._bucket(digest):
+                slot_digest, expires_at, _ = self.SLOT.unpack_from(self._map, offset)
+                if slot_digest == digest or expires_at <= now:
+                    victim = offset
+                    break
+                if victim is None or expires_at < victim_expires_at:
+                    victim, victim_expires_at = offset, expires_at
+
+            self.SLOT.pack_into(self._map, victim, digest, now + self.ttl, TERMINAL_SCAN_VERDICTS.index(verdict) + 1)
+
+    def _bucket(self, digest):
+        start = int.from_bytes(digest[:8], "little") % self.buckets * self.WAYS * self.SLOT.size
+        return range(start, start + self.WAYS * self.SLOT.size, self.SLOT.size)
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+
+class RedisVerdictCache:
+    """
+    Cache of terminal scan verdicts, keyed by S3 key, shared by every pod through Redis. Entries expire
+    `ttl` seconds after being set, and Redis' own eviction policy bounds the memory used.
+
+    The cache is an optimisation: Redis errors are logged and treated as cache misses, so that
+    downloads keep working, reading verdicts from S3, while Redis is unavailable.
+    """
+
+    KEY_PREFIX = "scan-verdict:"
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, key):
+        try:
+            verdict = self.client.get(self.KEY_PREFIX + key)
+        except Exception as e:
+            current_app.logger.warning(f"Failed to read scan verdict from cache: {e}")
+            return None
+        return verdict.decode() if verdict is not None else None
+
+    def set(self, key, verdict):
+        if verdict not in TERMINAL_SCAN_VERDICTS:
+            return
+
+        try:
+            self.client.set(self.KEY_PREFIX + key, verdict, ex=self.ttl)
+        except Exception as e:
+            current_app.logger.warning(f"Failed to write scan verdict to cache: {e}")
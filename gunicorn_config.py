@@ -73,5 +73,12 @@ def on_exit(server):
     server.log.info("Total gunicorn API running time: {:.2f} seconds".format(elapsed_time))
 
 
+def worker_exit(server, worker):
+    # Finish storing the documents acknowledged by asynchronous uploads, within the graceful timeout
+    from app import upload_spool
+
+    upload_spool.drain(timeout=max(graceful_timeout - 10, 0) if on_aws else None)
+
+
 def worker_int(worker):
     worker.log.info("worker: received SIGINT {}".format(worker.pid))
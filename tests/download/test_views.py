@@ -1,18 +1,27 @@
 import io
 import json
+import threading
+from datetime import datetime, timezone
 from unittest import mock
 from uuid import UUID
 
 import pytest
+from app.utils.document_cache import DocumentCache
+from app.utils.scan_latency import ScanLatencyHistogram
 from app.utils.store import (
     DocumentStoreError,
     MaliciousContentError,
+    NotModifiedError,
+    RangeNotSatisfiableError,
     ScanFailedError,
     ScanInProgressError,
     ScanUnsupportedError,
 )
+from botocore.response import StreamingBody
 from flask import url_for
 
+from tests.conftest import set_config
+
 
 @pytest.fixture
 def store(mocker):
@@ -21,7 +30,10 @@ def store(mocker):
 
 @pytest.fixture
 def scan_files_store(mocker):
-    return mocker.patch("app.download.views.scan_files_document_store")
+    scan_files_store = mocker.patch("app.download.views.scan_files_document_store")
+    scan_files_store.get_object_age_seconds.return_value = {"age_seconds": 30, "size": 1000}
+    scan_files_store.scan_latency = ScanLatencyHistogram()
+    return scan_files_store
 
 
 @pytest.mark.parametrize(
@@ -29,7 +41,7 @@ def scan_files_store(mocker):
     ["download.download_document", "download.download_document_b64"],
 )
 def test_document_download(client, store, endpoint, mocker):
-    mocker.patch("app.download.views.check_scan_verdict", return_value=None)
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
     store.get.return_value = {
         "body": io.BytesIO(b"PDF document contents"),
         "mimetype": "application/pdf",
@@ -48,6 +60,7 @@ def test_document_download(client, store, endpoint, mocker):
     assert response.status_code == 200
     assert response.get_data() == b"PDF document contents"
     assert dict(response.headers) == {
+        "Accept-Ranges": "bytes",
         "Cache-Control": mock.ANY,
         "Date": mock.ANY,
         "Content-Length": "100",
@@ -61,6 +74,7 @@ def test_document_download(client, store, endpoint, mocker):
         UUID("ffffffff-ffff-ffff-ffff-ffffffffffff"),
         bytes(32),
         "link",
+        key_layout=None,
     )
 
 
@@ -69,7 +83,7 @@ def test_document_download(client, store, endpoint, mocker):
     ["download.download_document", "download.download_document_b64"],
 )
 def test_document_download_with_filename(client, store, endpoint, mocker):
-    mocker.patch("app.download.views.check_scan_verdict", return_value=None)
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
     store.get.return_value = {
         "body": io.BytesIO(b"PDF document contents"),
         "mimetype": "application/pdf",
@@ -90,6 +104,7 @@ def test_document_download_with_filename(client, store, endpoint, mocker):
     assert response.status_code == 200
     assert response.get_data() == b"PDF document contents"
     assert dict(response.headers) == {
+        "Accept-Ranges": "bytes",
         "Cache-Control": mock.ANY,
         "Date": mock.ANY,
         "Content-Length": "100",
@@ -104,11 +119,12 @@ def test_document_download_with_filename(client, store, endpoint, mocker):
         UUID("ffffffff-ffff-ffff-ffff-ffffffffffff"),
         bytes(32),
         "attach",
+        key_layout=None,
     )
 
 
 def test_document_download_template_attach_skips_scan_verdict(client, store, mocker):
-    mock_check = mocker.patch("app.download.views.check_scan_verdict")
+    mock_check = mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict")
     store.get.return_value = {
         "body": io.BytesIO(b"PDF document contents"),
         "mimetype": "application/pdf",
@@ -132,11 +148,12 @@ def test_document_download_template_attach_skips_scan_verdict(client, store, moc
         UUID("ffffffff-ffff-ffff-ffff-ffffffffffff"),
         None,
         "template_attach",
+        key_layout=None,
     )
 
 
 def test_document_download_template_attach_no_key_required(client, store, mocker):
-    mocker.patch("app.download.views.check_scan_verdict")
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict")
     store.get.return_value = {
         "body": io.BytesIO(b"PDF document contents"),
         "mimetype": "application/pdf",
@@ -183,7 +200,7 @@ def test_document_download_with_invalid_decryption_key(client):
 
 
 def test_document_download_document_store_error(client, store, mocker):
-    mocker.patch("app.download.views.check_scan_verdict", return_value=None)
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
     store.get.side_effect = DocumentStoreError("something went wrong")
     response = client.get(
         url_for(
@@ -218,7 +235,7 @@ def test_document_download_document_store_error(client, store, mocker):
 def test_document_download_check_scan_verdict_errors(
     client, store, scan_files_store, mocker, endpoint, response_code, error, scan_return
 ):
-    mocker.patch("app.download.views.check_scan_verdict", side_effect=error)
+    scan_files_store.check_scan_verdict.side_effect = error
     scan_files_store.get_object_age_seconds.return_value = {"age_seconds": scan_return}
     store.get.return_value = store.get.return_value = {
         "body": io.BytesIO(b"PDF document contents"),
@@ -311,3 +328,645 @@ def test_scan_unsupported_returns_scan_verdict(client, scan_files_store):
     )
     assert response.status_code == 422
     assert json.loads(response.data) == {"scan_verdict": "scan_unsupported"}
+
+
+@pytest.fixture
+def scan_latency(scan_files_store):
+    return scan_files_store.scan_latency
+
+
+@pytest.mark.parametrize(
+    "estimate, age_seconds, retry_after",
+    [
+        (None, 30, "5"),
+        (12, 30, "12"),
+        (0.2, 30, "1"),
+        (300, 30, "60"),
+        (300, 11 * 60 - 10, "11"),
+    ],
+)
+def test_check_scan_verdict_in_progress_sets_retry_after(
+    client, scan_files_store, scan_latency, mocker, estimate, age_seconds, retry_after
+):
+    scan_files_store.check_scan_verdict.side_effect = ScanInProgressError("Content scanning is in progress")
+    scan_files_store.get_object_age_seconds.return_value = {"age_seconds": age_seconds, "size": 1000}
+    estimate_remaining = mocker.patch.object(scan_latency, "estimate_remaining", return_value=estimate)
+
+    response = client.post(
+        url_for(
+            "download.check_scan_verdict",
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+        )
+    )
+
+    assert response.status_code == 428
+    assert response.headers["Retry-After"] == retry_after
+    assert response.json == {"error": "Content scanning is in progress"}
+    estimate_remaining.assert_called_once_with(1000, age_seconds)
+
+
+def test_check_scan_verdict_without_retry_after_when_verdict_known(client, scan_files_store):
+    scan_files_store.check_scan_verdict.return_value = "NO_THREATS_FOUND"
+
+    response = client.post(
+        url_for(
+            "download.check_scan_verdict",
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+        )
+    )
+
+    assert response.status_code == 200
+    assert "Retry-After" not in response.headers
+
+
+def test_check_scan_verdict_waits_for_verdict(client, scan_files_store):
+    scan_files_store.check_scan_verdict.side_effect = [
+        ScanInProgressError("Content scanning is in progress"),
+        ScanInProgressError("Content scanning is in progress"),
+        "NO_THREATS_FOUND",
+    ]
+    scan_files_store.get_object_age_seconds.return_value = {"age_seconds": 30}
+    scan_files_store.wait_for_scan_verdict.side_effect = [False, True]
+
+    response = client.post(
+        url_for(
+            "download.check_scan_verdict",
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+        ),
+        data={"sending_method": "link", "wait": "10"},
+    )
+
+    assert response.status_code == 200
+    assert response.json == {"scan_verdict": "NO_THREATS_FOUND"}
+    assert scan_files_store.check_scan_verdict.call_count == 3
+    delays = [call.args[3] for call in scan_files_store.wait_for_scan_verdict.call_args_list]
+    assert delays[0] == pytest.approx(1, abs=0.1)
+    assert delays[1] == pytest.approx(2, abs=0.1)
+
+
+def test_check_scan_verdict_stops_waiting_at_deadline(app, client, scan_files_store, mocker):
+    scan_files_store.check_scan_verdict.side_effect = ScanInProgressError("Content scanning is in progress")
+    scan_files_store.get_object_age_seconds.return_value = {"age_seconds": 30}
+    mocker.patch("app.download.views.time").monotonic.side_effect = [0, 0, 1, 3, 7, 15]
+
+    with set_config(app, SCAN_VERDICT_MAX_WAIT_SECONDS=10):
+        response = client.post(
+            url_for(
+                "download.check_scan_verdict",
+                service_id="00000000-0000-0000-0000-000000000000",
+                document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+            ),
+            data={"wait": "60"},
+        )
+
+    assert response.status_code == 428
+    assert [call.args[3] for call in scan_files_store.wait_for_scan_verdict.call_args_list] == [1, 2, 4, 3]
+
+
+@pytest.mark.parametrize("wait", ["not-a-number", "nan", "inf", "-inf", ""])
+def test_check_scan_verdict_rejects_invalid_wait(client, scan_files_store, wait):
+    response = client.post(
+        url_for(
+            "download.check_scan_verdict",
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+        ),
+        data={"wait": wait},
+    )
+
+    assert response.status_code == 400
+    assert response.json == {"error": "Invalid wait, expected a number of seconds"}
+    scan_files_store.check_scan_verdict.assert_not_called()
+
+
+def test_document_download_ignores_wait(client, store, scan_files_store):
+    scan_files_store.check_scan_verdict.side_effect = ScanInProgressError("Content scanning is in progress")
+    store.get.return_value = {"body": io.BytesIO(b"PDF document contents"), "mimetype": "application/pdf", "size": 100}
+
+    response = client.get(
+        url_for(
+            "download.download_document",
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+            key="AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",  # 32 \x00 bytes
+            wait="20",
+        )
+    )
+
+    assert response.status_code == 200
+    scan_files_store.check_scan_verdict.assert_called_once()
+    scan_files_store.wait_for_scan_verdict.assert_not_called()
+
+
+@pytest.mark.parametrize("wait", [None, "0", "-5"])
+def test_check_scan_verdict_without_wait_answers_straight_away(client, scan_files_store, wait):
+    scan_files_store.check_scan_verdict.side_effect = ScanInProgressError("Content scanning is in progress")
+    scan_files_store.get_object_age_seconds.return_value = {"age_seconds": 30}
+
+    response = client.post(
+        url_for(
+            "download.check_scan_verdict",
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+        ),
+        data={"wait": wait} if wait is not None else {},
+    )
+
+    assert response.status_code == 428
+    scan_files_store.check_scan_verdict.assert_called_once()
+    scan_files_store.wait_for_scan_verdict.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "endpoint",
+    ["download.download_document", "download.download_document_b64"],
+)
+def test_document_download_fetches_document_while_checking_scan_verdict(client, store, endpoint, mocker):
+    fetch_started = threading.Event()
+
+    def get(*args, **kwargs):
+        fetch_started.set()
+        return {"body": io.BytesIO(b"PDF document contents"), "mimetype": "application/pdf", "size": 100}
+
+    def check_scan_verdict(*args, **kwargs):
+        # only returns once the document is being fetched
+        assert fetch_started.wait(timeout=5)
+
+    store.get.side_effect = get
+    check_scan_verdict = mocker.patch(
+        "app.download.views.scan_files_document_store.check_scan_verdict", side_effect=check_scan_verdict
+    )
+
+    response = client.get(
+        url_for(
+            endpoint,
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+            key="AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",  # 32 \x00 bytes
+        )
+    )
+
+    assert response.status_code == 200
+    assert response.get_data() == b"PDF document contents"
+    check_scan_verdict.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "endpoint, response_code",
+    [["download.download_document", 423], ["download.download_document_b64", 404]],
+)
+def test_document_download_closes_document_if_malicious(client, store, scan_files_store, endpoint, response_code):
+    body = io.BytesIO(b"PDF document contents")
+    closed = threading.Event()
+    body.close = mock.Mock(side_effect=closed.set)
+    store.get.return_value = {"body": body, "mimetype": "application/pdf", "size": 100}
+    scan_files_store.check_scan_verdict.side_effect = MaliciousContentError("Malicious content detected")
+
+    response = client.get(
+        url_for(
+            endpoint,
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+            key="AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",  # 32 \x00 bytes
+            v="2",
+        )
+    )
+
+    assert response.status_code == response_code
+    assert b"PDF document contents" not in response.get_data()
+    assert closed.wait(timeout=5)
+    scan_files_store.check_scan_verdict.assert_called_once_with(
+        UUID("00000000-0000-0000-0000-000000000000"), UUID("ffffffff-ffff-ffff-ffff-ffffffffffff"), "link", key_layout="2"
+    )
+
+
+@pytest.mark.parametrize(
+    "endpoint",
+    ["download.download_document", "download.download_document_b64"],
+)
+def test_document_download_byte_range(client, store, endpoint, mocker):
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
+    store.get.return_value = {
+        "body": io.BytesIO(b"PDF docume"),
+        "mimetype": "application/pdf",
+        "size": 10,
+        "content_range": "bytes 0-9/21",
+        "etag": '"etag"',
+    }
+
+    response = client.get(
+        url_for(
+            endpoint,
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+            key="AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",  # 32 \x00 bytes
+        ),
+        headers={"Range": "bytes=0-9", "If-Range": '"etag"'},
+    )
+
+    assert response.status_code == 206
+    assert response.get_data() == b"PDF docume"
+    assert response.headers["Content-Range"] == "bytes 0-9/21"
+    assert response.headers["Content-Length"] == "10"
+    assert response.headers["Accept-Ranges"] == "bytes"
+    store.get.assert_called_once_with(
+        UUID("00000000-0000-0000-0000-000000000000"),
+        UUID("ffffffff-ffff-ffff-ffff-ffffffffffff"),
+        bytes(32),
+        "link",
+        key_layout=None,
+        byte_range="bytes=0-9",
+    )
+
+
+def test_document_download_sends_whole_document_if_if_range_does_not_match(client, store, mocker):
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
+    partial_body = mock.Mock()
+    store.get.side_effect = [
+        {"body": partial_body, "mimetype": "application/pdf", "size": 10, "content_range": "bytes 0-9/21", "etag": '"new"'},
+        {"body": io.BytesIO(b"PDF document contents"), "mimetype": "application/pdf", "size": 21, "etag": '"new"'},
+    ]
+
+    response = client.get(
+        url_for(
+            "download.download_document",
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+            key="AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",  # 32 \x00 bytes
+        ),
+        headers={"Range": "bytes=0-9", "If-Range": '"old"'},
+    )
+
+    assert response.status_code == 200
+    assert response.get_data() == b"PDF document contents"
+    assert "Content-Range" not in response.headers
+    partial_body.close.assert_called_once_with()
+    assert store.get.call_args_list[1].kwargs == {"key_layout": None}
+
+
+def test_document_download_ignores_multiple_ranges(client, store, mocker):
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
+    store.get.return_value = {"body": io.BytesIO(b"PDF document contents"), "mimetype": "application/pdf", "size": 21}
+
+    response = client.get(
+        url_for(
+            "download.download_document",
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+            key="AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",  # 32 \x00 bytes
+        ),
+        headers={"Range": "bytes=0-1,5-9"},
+    )
+
+    assert response.status_code == 200
+    assert store.get.call_args.kwargs == {"key_layout": None}
+
+
+@pytest.mark.parametrize(
+    "endpoint",
+    ["download.download_document", "download.download_document_b64"],
+)
+def test_document_download_range_not_satisfiable(client, store, endpoint, mocker):
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
+    store.get.side_effect = RangeNotSatisfiableError(21)
+
+    response = client.get(
+        url_for(
+            endpoint,
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+            key="AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",  # 32 \x00 bytes
+        ),
+        headers={"Range": "bytes=100-"},
+    )
+
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */21"
+
+
+@pytest.mark.parametrize(
+    "endpoint",
+    ["download.download_document", "download.download_document_b64"],
+)
+def test_document_download_sends_validators(client, store, endpoint, mocker):
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
+    store.get.return_value = {
+        "body": io.BytesIO(b"PDF document contents"),
+        "mimetype": "application/pdf",
+        "size": 21,
+        "etag": '"etag"',
+        "last_modified": datetime(2015, 10, 21, 7, 28, tzinfo=timezone.utc),
+    }
+
+    response = client.get(
+        url_for(
+            endpoint,
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+            key="AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",  # 32 \x00 bytes
+        )
+    )
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"etag"'
+    assert response.headers["Last-Modified"] == "Wed, 21 Oct 2015 07:28:00 GMT"
+
+
+@pytest.mark.parametrize(
+    "headers, conditions",
+    [
+        ({"If-None-Match": '"etag"'}, {"if_none_match": '"etag"'}),
+        (
+            {"If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"},
+            {"if_modified_since": datetime(2015, 10, 21, 7, 28, tzinfo=timezone.utc)},
+        ),
+        ({"If-None-Match": '"etag"', "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"}, {"if_none_match": '"etag"'}),
+    ],
+)
+@pytest.mark.parametrize(
+    "endpoint",
+    ["download.download_document", "download.download_document_b64"],
+)
+def test_document_download_not_modified(client, store, endpoint, headers, conditions, mocker):
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
+    store.get.side_effect = NotModifiedError('"etag"')
+
+    response = client.get(
+        url_for(
+            endpoint,
+            service_id="00000000-0000-0000-0000-000000000000",
+            document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+            key="AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",  # 32 \x00 bytes
+        ),
+        headers=headers,
+    )
+
+    assert response.status_code == 304
+    assert response.get_data() == b""
+    assert response.headers["ETag"] == '"etag"'
+    store.get.assert_called_once_with(
+        UUID("00000000-0000-0000-0000-000000000000"),
+        UUID("ffffffff-ffff-ffff-ffff-ffffffffffff"),
+        bytes(32),
+        "link",
+        key_layout=None,
+        byte_range=None,
+        **conditions,
+    )
+
+
+@pytest.mark.parametrize(
+    "endpoint",
+    ["download.download_document", "download.download_document_b64"],
+)
+def test_document_download_template_attach_presigned_redirect(app, client, store, endpoint, mocker):
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
+    store.get_presigned_url.return_value = "https://test-bucket.s3.amazonaws.com/key?X-Amz-Signature=abc"
+
+    with set_config(app, TEMPLATE_ATTACH_PRESIGNED_REDIRECT_ENABLED=True):
+        response = client.get(
+            url_for(
+                endpoint,
+                service_id="00000000-0000-0000-0000-000000000000",
+                document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+                sending_method="template_attach",
+                filename="rapport final é.pdf",
+            )
+        )
+
+    assert response.status_code == 302
+    assert response.headers["Location"] == "https://test-bucket.s3.amazonaws.com/key?X-Amz-Signature=abc"
+    assert response.headers["Cache-Control"] == "no-store"
+    store.get.assert_not_called()
+    store.get_presigned_url.assert_called_once_with(
+        UUID("00000000-0000-0000-0000-000000000000"),
+        UUID("ffffffff-ffff-ffff-ffff-ffffffffffff"),
+        "template_attach",
+        "attachment; filename=\"rapport final e.pdf\"; filename*=UTF-8''rapport%20final%20%C3%A9.pdf",
+    )
+
+
+def test_document_download_template_attach_presigned_redirect_checks_scan_verdict(app, client, store, mocker):
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", side_effect=MaliciousContentError())
+
+    with set_config(app, TEMPLATE_ATTACH_PRESIGNED_REDIRECT_ENABLED=True):
+        response = client.get(
+            url_for(
+                "download.download_document_b64",
+                service_id="00000000-0000-0000-0000-000000000000",
+                document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+                sending_method="template_attach",
+            )
+        )
+
+    assert response.status_code == 404
+
+
+def test_document_download_template_attach_served_from_cache(app, client, store, mocker, tmp_path):
+    cache = mocker.patch("app.download.views.template_attach_cache", DocumentCache(str(tmp_path)))
+    cache.enabled = True
+    store.get.side_effect = lambda *args, **kwargs: {
+        "body": io.BytesIO(b"PDF document contents"),
+        "mimetype": "application/pdf",
+        "size": 21,
+    }
+
+    for _ in range(2):
+        response = client.get(
+            url_for(
+                "download.download_document",
+                service_id="00000000-0000-0000-0000-000000000000",
+                document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+                sending_method="template_attach",
+            )
+        )
+
+        assert response.status_code == 200
+        assert response.get_data() == b"PDF document contents"
+        assert response.headers["Content-Length"] == "21"
+
+    store.get.assert_called_once_with(
+        UUID("00000000-0000-0000-0000-000000000000"),
+        UUID("ffffffff-ffff-ffff-ffff-ffffffffffff"),
+        None,
+        "template_attach",
+        key_layout=None,
+    )
+    assert cache.get_counts() == {"misses": 1, "memory_hits": 1}
+
+
+def test_document_download_template_attach_not_served_from_cache_once_deleted(app, client, store, mocker, tmp_path):
+    cache = mocker.patch("app.download.views.template_attach_cache", DocumentCache(str(tmp_path)))
+    cache.enabled = True
+    store.get.side_effect = [
+        {"body": io.BytesIO(b"PDF document contents"), "mimetype": "application/pdf", "size": 21},
+        DocumentStoreError("The specified key does not exist."),
+    ]
+    store.document_exists.return_value = False
+    url = url_for(
+        "download.download_document",
+        service_id="00000000-0000-0000-0000-000000000000",
+        document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+        sending_method="template_attach",
+    )
+
+    assert client.get(url).status_code == 200
+    assert client.get(url).status_code == 400
+
+    store.document_exists.assert_called_once_with(
+        UUID("00000000-0000-0000-0000-000000000000"), UUID("ffffffff-ffff-ffff-ffff-ffffffffffff"), "template_attach"
+    )
+    assert store.get.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "endpoint",
+    ["download.download_document", "download.download_document_b64"],
+)
+def test_document_download_streams_s3_body_in_chunks(app, client, store, endpoint, mocker):
+    mocker.patch("app.download.views.scan_files_document_store.check_scan_verdict", return_value=None)
+    raw_stream = io.BytesIO(b"PDF document contents")
+    store.get.return_value = {"body": StreamingBody(raw_stream, 21), "mimetype": "application/pdf", "size": 21}
+
+    with set_config(app, DOWNLOAD_STREAM_CHUNK_SIZE=8):
+        response = client.get(
+            url_for(
+                endpoint,
+                service_id="00000000-0000-0000-0000-000000000000",
+                document_id="ffffffff-ffff-ffff-ffff-ffffffffffff",
+                key="AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",  # 32 \x00 bytes
+                filename="file.pdf",
+            ),
+            buffered=False,
+        )
+
+    assert response.status_code == 200
+    assert next(response.response) == b"PDF docu"
+    response.close()
+
+    assert raw_stream.closed
+    assert response.headers["Content-Length"] == "21"
+    assert response.headers["Content-Type"] == "application/pdf"
+    assert response.headers["Content-Disposition"] == "attachment; filename=file.pdf"
+    assert response.headers["Cache-Control"] == "no-cache"
+
+
+def test_get_whole_document_shares_small_documents(app, store):
+    from app.download.views import get_whole_document
+
+    store.get.return_value = {"body": io.BytesIO(b"PDF document contents"), "mimetype": "application/pdf", "size": 21}
+
+    with app.test_request_context(), set_config(app, DOWNLOAD_SINGLEFLIGHT_ENABLED=True):
+        document = get_whole_document("service-id", "document-id", bytes(32), "link", None)
+
+        with mock.patch("app.download.views.document_flights") as document_flights:
+            document_flights.do.return_value = ({"mimetype": "application/pdf", "size": 21, "content": b"shared"}, True)
+            shared_document = get_whole_document("service-id", "document-id", bytes(32), "link", None)
+
+    assert document["body"].read() == b"PDF document contents"
+    assert shared_document == {"body": mock.ANY, "mimetype": "application/pdf", "size": 21}
+    assert shared_document["body"].read() == b"shared"
+    store.get.assert_called_once_with("service-id", "document-id", bytes(32), "link", key_layout=None)
+    assert document_flights.do.call_args.args[0] == ("service-id", "document-id", bytes(32), "link", None)
+
+
+def test_get_whole_document_does_not_share_large_documents(app, store):
+    from app.download.views import get_whole_document
+
+    own_body = mock.Mock()
+    store.get.return_value = {"body": own_body, "mimetype": "application/pdf", "size": 21}
+
+    with (
+        app.test_request_context(),
+        set_config(app, DOWNLOAD_SINGLEFLIGHT_ENABLED=True, DOWNLOAD_SINGLEFLIGHT_MAX_DOCUMENT_SIZE=10),
+    ):
+        assert get_whole_document("service-id", "document-id", bytes(32), "link", None)["body"] is own_body
+        own_body.read.assert_not_called()
+
+        with mock.patch("app.download.views.document_flights") as document_flights:
+            document_flights.do.return_value = ({"body": mock.Mock(), "mimetype": "application/pdf", "size": 21}, True)
+            assert get_whole_document("service-id", "document-id", bytes(32), "link", None)["body"] is own_body
+
+    assert store.get.call_count == 2
+
+
+def test_check_scan_verdicts(client, scan_files_store):
+    verdicts = {
+        UUID("00000000-0000-0000-0000-000000000001"): "NO_THREATS_FOUND",
+        UUID("00000000-0000-0000-0000-000000000002"): MaliciousContentError("Malicious content detected"),
+        UUID("00000000-0000-0000-0000-000000000003"): ScanInProgressError("Content scanning is in progress"),
+        UUID("00000000-0000-0000-0000-000000000004"): ScanFailedError("Scan failed"),
+        UUID("00000000-0000-0000-0000-000000000005"): DocumentStoreError("Not found"),
+    }
+
+    def check_scan_verdict(service_id, document_id, sending_method, key_layout=None):
+        verdict = verdicts[document_id]
+        if isinstance(verdict, Exception):
+            raise verdict
+        return verdict
+
+    scan_files_store.check_scan_verdict.side_effect = check_scan_verdict
+    scan_files_store.get_object_age_seconds.return_value = {"age_seconds": 30}
+
+    response = client.post(
+        url_for("download.check_scan_verdicts", service_id="00000000-0000-0000-0000-000000000000"),
+        json={"documents": [{"document_id": str(document_id), "sending_method": "attach", "v": "2"} for document_id in verdicts]},
+    )
+
+    assert response.status_code == 200
+    assert response.json == {
+        "status": "ok",
+        "scan_verdicts": {
+            "00000000-0000-0000-0000-000000000001": {"scan_verdict": "NO_THREATS_FOUND", "status_code": 200},
+            "00000000-0000-0000-0000-000000000002": {"error": "Malicious content detected", "status_code": 423},
+            "00000000-0000-0000-0000-000000000003": {
+                "error": "Content scanning is in progress",
+                "retry_after": 5,
+                "status_code": 428,
+            },
+            "00000000-0000-0000-0000-000000000004": {"scan_verdict": "scan_failed", "status_code": 422},
+            "00000000-0000-0000-0000-000000000005": {"error": "Document not found", "status_code": 404},
+        },
+    }
+    scan_files_store.check_scan_verdict.assert_any_call(
+        UUID("00000000-0000-0000-0000-000000000000"), UUID("00000000-0000-0000-0000-000000000001"), "attach", key_layout="2"
+    )
+
+
+@pytest.mark.parametrize("authorization, status_code", [(None, 401), ("Bearer invalid-token", 403)])
+def test_check_scan_verdicts_requires_auth(client, scan_files_store, authorization, status_code):
+    response = client.post(
+        url_for("download.check_scan_verdicts", service_id="00000000-0000-0000-0000-000000000000"),
+        json={"documents": [{"document_id": "ffffffff-ffff-ffff-ffff-ffffffffffff", "sending_method": "link"}]},
+        headers={"Authorization": authorization},
+    )
+
+    assert response.status_code == status_code
+    scan_files_store.check_scan_verdict.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "body, error",
+    [
+        ({}, "Expected a list of documents"),
+        ({"documents": []}, "Expected a list of documents"),
+        ({"documents": [{"document_id": "not-a-uuid"}]}, "Invalid document id"),
+        ({"documents": [{"sending_method": "link"}]}, "Invalid document id"),
+        (
+            {"documents": [{"document_id": "00000000-0000-0000-0000-000000000001"}] * 3},
+            "Too many documents, at most 2 scan verdicts can be checked at once",
+        ),
+    ],
+)
+def test_check_scan_verdicts_invalid_request(app, client, scan_files_store, body, error):
+    with set_config(app, SCAN_VERDICT_BULK_MAX_DOCUMENTS=2):
+        response = client.post(
+            url_for("download.check_scan_verdicts", service_id="00000000-0000-0000-0000-000000000000"), json=body
+        )
+
+    assert response.status_code == 400
+    assert response.json == {"error": error}
+    scan_files_store.check_scan_verdict.assert_not_called()
@@ -1,3 +1,5 @@
+from unittest import mock
+
 import pytest
 
 
@@ -8,3 +10,12 @@ import pytest
 def test_healthcheck_endpoint(client, endpoint):
     response = client.get(endpoint)
     assert response.status_code == 200
+
+
+def test_counters_endpoint(client, mocker):
+    mocker.patch("app.healthcheck.counter_reporter.get_counts", return_value={"documents.legacy_key_probe.get_object.new": 3})
+
+    response = client.get("/_status/counters")
+
+    assert response.status_code == 200
+    assert response.json == {"pid": mock.ANY, "counters": {"documents.legacy_key_probe.get_object.new": 3}}
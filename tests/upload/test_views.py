@@ -1,6 +1,14 @@
+import gzip
+import hashlib
 import io
+import tracemalloc
+import uuid
+from unittest import mock
 
 import pytest
+from app.utils.store import DocumentStore, DocumentStoreError, ScanFilesDocumentStore
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
 
 from tests.conftest import set_config
 
@@ -56,6 +64,7 @@ def test_document_upload_returns_link_to_api(
 
     if in_api_url:
         api_url_parts.append(f"&filename={filename}")
+    api_url_parts.append("&v=2")
 
     response = client.post(
         "/services/00000000-0000-0000-0000-000000000000/documents",
@@ -75,6 +84,7 @@ def test_document_upload_returns_link_to_api(
                     "/documents/ffffffff-ffff-ffff-ffff-ffffffffffff",
                     "?key=AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",
                     f"&sending_method={sending_method}",
+                    "&v=2",
                 ]
             ),
             "filename": expected_filename,
@@ -160,7 +170,7 @@ def test_document_upload_unknown_type(client):
 )
 def test_document_upload_extra_mime_type(app, client, mocker, store, scan_files_store, extra_mime_types, expected_status_code):
     # Even if uploading "a PDF", make sure it's detected as "application/octet-stream"
-    mocker.patch("app.upload.views.get_mime_type", return_value="application/octet-stream")
+    mocker.patch("app.utils.get_mime_type", return_value="application/octet-stream")
 
     store.put.return_value = {
         "id": "ffffffff-ffff-ffff-ffff-ffffffffffff",
@@ -271,3 +281,768 @@ def test_upload_document_adds_file_to_scan_files_bucket(
 
     assert response.status_code == 201
     scan_files_store.put.assert_called_once()
+
+
+@pytest.fixture
+def streaming_stores(app, store, scan_files_store):
+    store.open_writer.return_value = {
+        "id": "ffffffff-ffff-ffff-ffff-ffffffffffff",
+        "encryption_key": bytes(32),
+        "writer": mock.Mock(),
+    }
+
+    with set_config(app, UPLOAD_STREAMING_ENABLED=True, UPLOAD_STREAM_CHUNK_SIZE=1024):
+        yield store, scan_files_store
+
+
+class FakeS3:
+    """
+    Reads what is uploaded without keeping it, unlike a Mock which holds on to the call arguments.
+    """
+
+    def __init__(self):
+        self.uploaded = 0
+
+    def create_multipart_upload(self, **kwargs):
+        return {"UploadId": "upload-id"}
+
+    def upload_part(self, Body, PartNumber, **kwargs):
+        while chunk := Body.read(64 * 1024):
+            self.uploaded += len(chunk)
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def put_object(self, Body, **kwargs):
+        self.uploaded += len(Body)
+
+    def complete_multipart_upload(self, **kwargs):
+        pass
+
+
+def test_streaming_document_upload_holds_one_part_per_bucket_in_memory(app, client, mocker, tmp_path):
+    part_size = 1024 * 1024
+    document_store = DocumentStore(bucket="documents-bucket")
+    document_store.s3 = FakeS3()
+    document_store.part_size = part_size
+    document_store.multipart_concurrency = 4
+    scan_files_document_store = ScanFilesDocumentStore(bucket="scan-files-bucket")
+    scan_files_document_store.s3 = FakeS3()
+    scan_files_document_store.part_size = part_size
+    mocker.patch("app.upload.views.document_store", document_store)
+    mocker.patch("app.upload.views.scan_files_document_store", scan_files_document_store)
+
+    content = b"a,b,c\n" * (8 * part_size // 6)
+    boundary, body = encode_multipart(
+        {"sending_method": "attach", "document": FileStorage(io.BytesIO(content), filename="file.csv")}
+    )
+    (tmp_path / "body").write_bytes(body)
+    del content, body
+
+    with set_config(app, UPLOAD_STREAMING_ENABLED=True), open(tmp_path / "body", "rb") as f:
+        tracemalloc.start()
+        try:
+            response = client.post(
+                "/services/00000000-0000-0000-0000-000000000000/documents",
+                input_stream=f,
+                content_type=f"multipart/form-data; boundary={boundary}",
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    assert response.status_code == 201
+    assert document_store.s3.uploaded == scan_files_document_store.s3.uploaded == response.json["document"]["file_size"]
+    # About one part being filled or sent per bucket, whereas reading the whole document takes 8 parts
+    assert peak < 4 * part_size
+
+
+def test_streaming_document_upload(client, streaming_stores):
+    store, scan_files_store = streaming_stores
+    content = b"%PDF-1.4 " + b"a" * 10000
+
+    response = client.post(
+        "/services/00000000-0000-0000-0000-000000000000/documents",
+        content_type="multipart/form-data",
+        data={
+            "sending_method": "attach",
+            "filename": "file.pdf",
+            "document": (io.BytesIO(content), "file.pdf"),
+        },
+    )
+
+    assert response.status_code == 201
+    assert response.json["document"]["id"] == "ffffffff-ffff-ffff-ffff-ffffffffffff"
+    assert response.json["document"]["mime_type"] == "application/pdf"
+    assert response.json["document"]["file_size"] == len(content)
+    assert response.json["document"]["file_extension"] == "pdf"
+    assert response.json["document"]["sending_method"] == "attach"
+
+    store.put.assert_not_called()
+    store.open_writer.assert_called_once_with(
+        uuid.UUID("00000000-0000-0000-0000-000000000000"), sending_method="attach", mimetype="application/pdf"
+    )
+    scan_files_store.open_writer.assert_called_once_with(
+        uuid.UUID("00000000-0000-0000-0000-000000000000"),
+        "ffffffff-ffff-ffff-ffff-ffffffffffff",
+        sending_method="attach",
+        mimetype="application/pdf",
+    )
+    for writer in (store.open_writer.return_value["writer"], scan_files_store.open_writer.return_value):
+        assert b"".join(call.args[0] for call in writer.write.call_args_list) == content
+        assert max(len(call.args[0]) for call in writer.write.call_args_list) < 4096
+        writer.close.assert_called_once_with()
+
+
+def test_streaming_document_upload_fixes_csv_mime_type(client, streaming_stores):
+    store, _ = streaming_stores
+
+    response = client.post(
+        "/services/00000000-0000-0000-0000-000000000000/documents",
+        content_type="multipart/form-data",
+        data={"filename": "file.csv", "document": (io.BytesIO(b"foo,bar"), "file.csv")},
+    )
+
+    assert response.status_code == 201
+    assert response.json["document"]["mime_type"] == "text/csv"
+    assert store.open_writer.call_args.kwargs["mimetype"] == "text/csv"
+
+
+def test_streaming_document_upload_unknown_type(client, streaming_stores):
+    store, _ = streaming_stores
+
+    response = client.post(
+        "/services/12345678-1111-1111-1111-123456789012/documents",
+        content_type="multipart/form-data",
+        data={"document": (io.BytesIO(b"\x00pdf file contents\n"), "file.pdf")},
+    )
+
+    assert response.status_code == 400
+    assert response.json["error"].startswith("Unsupported document type 'application/octet-stream'")
+    store.open_writer.assert_not_called()
+
+
+def test_streaming_document_upload_no_document(client, streaming_stores):
+    response = client.post(
+        "/services/12345678-1111-1111-1111-123456789012/documents",
+        content_type="multipart/form-data",
+        data={"file": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf")},
+    )
+
+    assert response.status_code == 400
+    assert response.json == {"error": "No document upload"}
+
+
+def test_streaming_document_upload_rejects_storage_fields_after_the_document(client, streaming_stores):
+    store, scan_files_store = streaming_stores
+    body = b"".join(
+        [
+            b"--boundary\r\n",
+            b'Content-Disposition: form-data; name="document"; filename="file.pdf"\r\n\r\n',
+            b"%PDF-1.4 file contents\r\n",
+            b"--boundary\r\n",
+            b'Content-Disposition: form-data; name="sending_method"\r\n\r\n',
+            b"attach\r\n",
+            b"--boundary--\r\n",
+        ]
+    )
+
+    response = client.post(
+        "/services/12345678-1111-1111-1111-123456789012/documents",
+        content_type="multipart/form-data; boundary=boundary",
+        data=body,
+    )
+
+    assert response.status_code == 400
+    assert response.json == {"error": "Form field 'sending_method' must be sent before the document"}
+    for writer in (store.open_writer.return_value["writer"], scan_files_store.open_writer.return_value):
+        writer.abort.assert_called_once_with()
+        writer.close.assert_not_called()
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_document_upload_with_truncated_body(app, client, streaming_stores, streaming):
+    store, scan_files_store = streaming_stores
+    body = b"".join(
+        [
+            b"--boundary\r\n",
+            b'Content-Disposition: form-data; name="document"; filename="file.pdf"\r\n\r\n',
+            b"%PDF-1.4 file contents" * 100,
+        ]
+    )
+
+    with set_config(app, UPLOAD_STREAMING_ENABLED=streaming):
+        response = client.post(
+            "/services/12345678-1111-1111-1111-123456789012/documents",
+            content_type="multipart/form-data; boundary=boundary",
+            data=body,
+        )
+
+    assert response.status_code == 400
+    assert response.json == {"error": "No document upload"}
+    if streaming:
+        for writer in (store.open_writer.return_value["writer"], scan_files_store.open_writer.return_value):
+            writer.abort.assert_called_once_with()
+            writer.close.assert_not_called()
+
+
+def test_streaming_document_upload_aborts_writers_on_store_error(client, streaming_stores):
+    store, scan_files_store = streaming_stores
+    scan_files_store.open_writer.return_value.close.side_effect = DocumentStoreError("boom")
+
+    with pytest.raises(DocumentStoreError):
+        client.post(
+            "/services/12345678-1111-1111-1111-123456789012/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf")},
+        )
+
+    store.open_writer.return_value["writer"].abort.assert_called_once_with()
+    scan_files_store.open_writer.return_value.abort.assert_called_once_with()
+
+
+def test_streaming_document_file_size_too_large(client, streaming_stores):
+    response = client.post(
+        "/services/12345678-1111-1111-1111-123456789012/documents",
+        content_type="multipart/form-data",
+        data={"document": (io.BytesIO(b"%PDF-1.5 " + b"a" * 11 * 1024 * 1024), "file.pdf")},
+    )
+
+    assert response.status_code == 413
+
+
+def test_document_upload_writes_both_buckets_with_the_same_document_id(client, store, scan_files_store):
+    store.put.side_effect = lambda service_id, content, document_id, **kwargs: {
+        "id": document_id,
+        "encryption_key": bytes(32),
+    }
+
+    response = client.post(
+        "/services/00000000-0000-0000-0000-000000000000/documents",
+        content_type="multipart/form-data",
+        data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), "sending_method": "link"},
+    )
+
+    assert response.status_code == 201
+    document_id = response.json["document"]["id"]
+    scan_files_store.put.assert_called_once_with(
+        uuid.UUID("00000000-0000-0000-0000-000000000000"),
+        document_id,
+        b"%PDF-1.4 file contents",
+        sending_method="link",
+        mimetype="application/pdf",
+        content_sha256=hashlib.sha256(b"%PDF-1.4 file contents").hexdigest(),
+    )
+
+
+def test_document_upload_deletes_document_if_scan_files_write_fails(client, store, scan_files_store):
+    store.put.return_value = {
+        "id": "ffffffff-ffff-ffff-ffff-ffffffffffff",
+        "encryption_key": bytes(32),
+    }
+    scan_files_store.put.side_effect = DocumentStoreError("boom")
+
+    with pytest.raises(DocumentStoreError):
+        client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), "sending_method": "link"},
+        )
+
+    document_id = store.put.call_args.kwargs["document_id"]
+    store.delete.assert_called_once_with(uuid.UUID("00000000-0000-0000-0000-000000000000"), document_id, bytes(32), "link")
+    scan_files_store.delete.assert_not_called()
+
+
+def test_document_upload_deletes_scan_file_if_document_write_fails(client, store, scan_files_store):
+    store.put.side_effect = DocumentStoreError("boom")
+
+    with pytest.raises(DocumentStoreError):
+        client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), "sending_method": "attach"},
+        )
+
+    document_id = store.put.call_args.kwargs["document_id"]
+    scan_files_store.delete.assert_called_once_with(uuid.UUID("00000000-0000-0000-0000-000000000000"), document_id, "attach")
+    store.delete.assert_not_called()
+
+
+def test_document_upload_server_side_copy_to_scan_files_bucket(app, client, store, scan_files_store):
+    store.bucket = "documents-bucket"
+    store.put.return_value = {
+        "id": "ffffffff-ffff-ffff-ffff-ffffffffffff",
+        "encryption_key": bytes(32),
+    }
+
+    with set_config(app, SCAN_FILES_SERVER_SIDE_COPY=True):
+        response = client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), "sending_method": "attach"},
+        )
+
+    assert response.status_code == 201
+    scan_files_store.put.assert_not_called()
+    scan_files_store.copy_from.assert_called_once_with(
+        "documents-bucket",
+        uuid.UUID("00000000-0000-0000-0000-000000000000"),
+        "ffffffff-ffff-ffff-ffff-ffffffffffff",
+        "attach",
+        encryption_key=bytes(32),
+    )
+
+
+def test_document_upload_server_side_copy_failure_deletes_document(app, client, store, scan_files_store):
+    store.put.return_value = {
+        "id": "ffffffff-ffff-ffff-ffff-ffffffffffff",
+        "encryption_key": bytes(32),
+    }
+    scan_files_store.copy_from.side_effect = DocumentStoreError("boom")
+
+    with set_config(app, SCAN_FILES_SERVER_SIDE_COPY=True), pytest.raises(DocumentStoreError):
+        client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), "sending_method": "link"},
+        )
+
+    store.delete.assert_called_once_with(
+        uuid.UUID("00000000-0000-0000-0000-000000000000"), "ffffffff-ffff-ffff-ffff-ffffffffffff", bytes(32), "link"
+    )
+    scan_files_store.delete.assert_not_called()
+
+
+def test_streaming_document_upload_server_side_copy(app, client, streaming_stores):
+    store, scan_files_store = streaming_stores
+
+    with set_config(app, SCAN_FILES_SERVER_SIDE_COPY=True):
+        response = client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf")},
+        )
+
+    assert response.status_code == 201
+    store.open_writer.return_value["writer"].close.assert_called_once_with()
+    scan_files_store.open_writer.assert_not_called()
+    scan_files_store.copy_from.assert_called_once()
+
+
+def _put_with_given_id(service_id, content, document_id, **kwargs):
+    return {"id": document_id, "encryption_key": bytes(32)}
+
+
+def test_batch_document_upload(client, store, scan_files_store):
+    store.put.side_effect = _put_with_given_id
+
+    response = client.post(
+        "/services/00000000-0000-0000-0000-000000000000/documents/batch",
+        content_type="multipart/form-data",
+        data={
+            "document": [
+                (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"),
+                (io.BytesIO(b"foo,bar"), "file.csv"),
+            ],
+            "filename": ["file.pdf", "file.csv"],
+            "sending_method": "attach",
+        },
+    )
+
+    assert response.status_code == 201
+    assert response.json["status"] == "ok"
+    documents = response.json["documents"]
+    assert [(d["filename"], d["mime_type"], d["file_size"], d["file_extension"]) for d in documents] == [
+        ("file.pdf", "application/pdf", 22, "pdf"),
+        ("file.csv", "text/csv", 7, "csv"),
+    ]
+    assert all(d["sending_method"] == "attach" for d in documents)
+    assert len({d["id"] for d in documents}) == 2
+    assert store.put.call_count == 2
+    assert scan_files_store.put.call_count == 2
+    assert sorted(c.args[1] for c in scan_files_store.put.call_args_list) == sorted(d["id"] for d in documents)
+
+
+def test_batch_document_upload_without_filenames(client, store, scan_files_store):
+    store.put.side_effect = _put_with_given_id
+
+    response = client.post(
+        "/services/00000000-0000-0000-0000-000000000000/documents/batch",
+        content_type="multipart/form-data",
+        data={"document": [(io.BytesIO(b"Canada"), "a.txt"), (io.BytesIO(b"Canada"), "b.txt")]},
+    )
+
+    assert response.status_code == 201
+    assert [d["filename"] for d in response.json["documents"]] == [None, None]
+
+
+def test_batch_document_upload_no_document(client):
+    response = client.post(
+        "/services/00000000-0000-0000-0000-000000000000/documents/batch",
+        content_type="multipart/form-data",
+        data={"file": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf")},
+    )
+
+    assert response.status_code == 400
+    assert response.json == {"error": "No document upload"}
+
+
+def test_batch_document_upload_too_many_documents(app, client, store):
+    with set_config(app, UPLOAD_BATCH_MAX_DOCUMENTS=1):
+        response = client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents/batch",
+            content_type="multipart/form-data",
+            data={"document": [(io.BytesIO(b"Canada"), "a.txt"), (io.BytesIO(b"Canada"), "b.txt")]},
+        )
+
+    assert response.status_code == 400
+    assert response.json == {"error": "Too many documents, a batch can contain at most 1 documents"}
+    store.put.assert_not_called()
+
+
+def test_batch_document_upload_filename_count_mismatch(client, store):
+    response = client.post(
+        "/services/00000000-0000-0000-0000-000000000000/documents/batch",
+        content_type="multipart/form-data",
+        data={
+            "document": [(io.BytesIO(b"Canada"), "a.txt"), (io.BytesIO(b"Canada"), "b.txt")],
+            "filename": ["a.txt"],
+        },
+    )
+
+    assert response.status_code == 400
+    assert response.json == {"error": "Expected one filename per document"}
+    store.put.assert_not_called()
+
+
+def test_batch_document_upload_rejects_batch_with_unsupported_document(client, store):
+    response = client.post(
+        "/services/12345678-1111-1111-1111-123456789012/documents/batch",
+        content_type="multipart/form-data",
+        data={
+            "document": [
+                (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"),
+                (io.BytesIO(b"\x00pdf file contents\n"), "file.pdf"),
+            ]
+        },
+    )
+
+    assert response.status_code == 400
+    assert response.json["error"].startswith("Unsupported document type 'application/octet-stream'")
+    store.put.assert_not_called()
+
+
+def test_batch_document_upload_deletes_stored_documents_if_one_fails(client, store, scan_files_store):
+    def put(service_id, content, document_id, **kwargs):
+        if content == b"Canada":
+            raise DocumentStoreError("boom")
+        return _put_with_given_id(service_id, content, document_id)
+
+    store.put.side_effect = put
+
+    with pytest.raises(DocumentStoreError):
+        client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents/batch",
+            content_type="multipart/form-data",
+            data={
+                "document": [(io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), (io.BytesIO(b"Canada"), "a.txt")],
+                "sending_method": "link",
+            },
+        )
+
+    stored_id = next(c.kwargs["document_id"] for c in store.put.call_args_list if c.args[1] != b"Canada")
+    failed_id = next(c.kwargs["document_id"] for c in store.put.call_args_list if c.args[1] == b"Canada")
+    store.delete.assert_called_once_with(uuid.UUID("00000000-0000-0000-0000-000000000000"), stored_id, bytes(32), "link")
+    assert sorted(c.args[1] for c in scan_files_store.delete.call_args_list) == sorted([stored_id, failed_id])
+
+
+@pytest.mark.parametrize(
+    "content_age, document_refreshed, scan_file_refreshed",
+    [
+        (None, True, True),
+        (2 * 24 * 60 * 60, True, True),
+        # The content expired after its age was checked
+        (60, False, True),
+        (60, True, False),
+    ],
+)
+def test_template_attach_deduplication_stores_missing_or_old_content(
+    app, client, store, scan_files_store, content_age, document_refreshed, scan_file_refreshed
+):
+    content = b"%PDF-1.4 file contents"
+    content_sha256 = hashlib.sha256(content).hexdigest()
+    store.get_content_age_seconds.return_value = content_age
+    store.refresh_content.return_value = document_refreshed
+    scan_files_store.refresh_content.return_value = scan_file_refreshed
+    store.put.side_effect = lambda service_id, content, document_id, **kwargs: {
+        "id": document_id,
+        "encryption_key": None,
+    }
+    store.put_content_reference.return_value = {"id": "ffffffff-ffff-ffff-ffff-ffffffffffff", "encryption_key": None}
+
+    with set_config(app, TEMPLATE_ATTACH_DEDUPLICATION_ENABLED=True):
+        response = client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(content), "file.pdf"), "sending_method": "template_attach"},
+        )
+
+    service_id = uuid.UUID("00000000-0000-0000-0000-000000000000")
+    assert response.status_code == 201
+    assert response.json["document"]["id"] == "ffffffff-ffff-ffff-ffff-ffffffffffff"
+    store.put.assert_called_once_with(
+        service_id,
+        content,
+        sending_method="template_attach",
+        mimetype="application/pdf",
+        document_id=f"content/{content_sha256}",
+        content_sha256=content_sha256,
+        encryption_key=None,
+    )
+    scan_files_store.put.assert_called_once_with(
+        service_id,
+        f"content/{content_sha256}",
+        content,
+        sending_method="template_attach",
+        mimetype="application/pdf",
+        content_sha256=content_sha256,
+    )
+    store.put_content_reference.assert_called_once_with(service_id, content_sha256, "application/pdf", document_id=None)
+
+
+@pytest.mark.parametrize("server_side_copy", [False, True])
+def test_template_attach_deduplication_keeps_shared_content_if_storing_it_fails(
+    app, client, store, scan_files_store, server_side_copy
+):
+    store.get_content_age_seconds.return_value = 2 * 24 * 60 * 60
+    store.put.side_effect = lambda service_id, content, document_id, **kwargs: {"id": document_id, "encryption_key": None}
+    scan_files_store.put.side_effect = DocumentStoreError("boom")
+    scan_files_store.copy_from.side_effect = DocumentStoreError("boom")
+
+    with (
+        set_config(app, TEMPLATE_ATTACH_DEDUPLICATION_ENABLED=True, SCAN_FILES_SERVER_SIDE_COPY=server_side_copy),
+        pytest.raises(DocumentStoreError),
+    ):
+        client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), "sending_method": "template_attach"},
+        )
+
+    store.delete.assert_not_called()
+    scan_files_store.delete.assert_not_called()
+    store.put_content_reference.assert_not_called()
+
+
+def test_template_attach_deduplication_reuses_stored_content(app, client, store, scan_files_store):
+    store.get_content_age_seconds.return_value = 60
+    store.refresh_content.return_value = True
+    scan_files_store.refresh_content.return_value = True
+    store.put_content_reference.return_value = {"id": "ffffffff-ffff-ffff-ffff-ffffffffffff", "encryption_key": None}
+
+    with set_config(app, TEMPLATE_ATTACH_DEDUPLICATION_ENABLED=True):
+        response = client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), "sending_method": "template_attach"},
+        )
+
+    assert response.status_code == 201
+    assert response.json["document"]["id"] == "ffffffff-ffff-ffff-ffff-ffffffffffff"
+    assert "key" not in response.json["document"]["url"]
+    store.put.assert_not_called()
+    scan_files_store.put.assert_not_called()
+    service_id = uuid.UUID("00000000-0000-0000-0000-000000000000")
+    content_sha256 = hashlib.sha256(b"%PDF-1.4 file contents").hexdigest()
+    store.refresh_content.assert_called_once_with(service_id, content_sha256, "application/pdf")
+    scan_files_store.refresh_content.assert_called_once_with(service_id, content_sha256, "application/pdf")
+    store.put_content_reference.assert_called_once()
+
+
+def test_deduplication_only_applies_to_template_attach(app, client, store, scan_files_store):
+    store.put.return_value = {"id": "ffffffff-ffff-ffff-ffff-ffffffffffff", "encryption_key": bytes(32)}
+
+    with set_config(app, TEMPLATE_ATTACH_DEDUPLICATION_ENABLED=True):
+        response = client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), "sending_method": "attach"},
+        )
+
+    assert response.status_code == 201
+    store.get_content_age_seconds.assert_not_called()
+    store.put_content_reference.assert_not_called()
+
+
+@pytest.fixture
+def spool(mocker, tmp_path):
+    from app import upload_spool
+
+    mocker.patch.object(upload_spool, "directory", str(tmp_path))
+    mocker.patch.object(upload_spool, "retry_delay", 0)
+    return upload_spool
+
+
+def test_async_document_upload_returns_before_document_is_stored(app, client, store, scan_files_store, spool):
+    store.generate_encryption_key.return_value = bytes(32)
+
+    with set_config(app, UPLOAD_ASYNC_ENABLED=True):
+        response = client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), "sending_method": "link"},
+        )
+        spool.join()
+
+    assert response.status_code == 202
+    document_id = response.json["document"]["id"]
+    assert "?key=AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA" in response.json["document"]["url"]
+    service_id = uuid.UUID("00000000-0000-0000-0000-000000000000")
+    store.put.assert_called_once_with(
+        service_id,
+        b"%PDF-1.4 file contents",
+        sending_method="link",
+        mimetype="application/pdf",
+        document_id=document_id,
+        content_sha256=hashlib.sha256(b"%PDF-1.4 file contents").hexdigest(),
+        encryption_key=bytes(32),
+    )
+    scan_files_store.put.assert_called_once_with(
+        service_id,
+        document_id,
+        b"%PDF-1.4 file contents",
+        sending_method="link",
+        mimetype="application/pdf",
+        content_sha256=hashlib.sha256(b"%PDF-1.4 file contents").hexdigest(),
+    )
+
+    response = client.get(f"/services/00000000-0000-0000-0000-000000000000/documents/{document_id}/status")
+
+    assert response.status_code == 200
+    assert response.json == {"status": "ok", "document_id": document_id, "upload_status": "stored"}
+
+
+def test_async_document_upload_status_is_failed_if_document_cannot_be_stored(app, client, store, scan_files_store, spool):
+    store.generate_encryption_key.return_value = bytes(32)
+    store.put.side_effect = _put_with_given_id
+    scan_files_store.put.side_effect = DocumentStoreError("boom")
+
+    with set_config(app, UPLOAD_ASYNC_ENABLED=True):
+        response = client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            content_type="multipart/form-data",
+            data={"document": (io.BytesIO(b"%PDF-1.4 file contents"), "file.pdf"), "sending_method": "link"},
+        )
+        spool.join()
+
+    document_id = response.json["document"]["id"]
+    response = client.get(f"/services/00000000-0000-0000-0000-000000000000/documents/{document_id}/status")
+
+    assert response.json["upload_status"] == "failed"
+    # Each attempt removes what it stored
+    assert (
+        store.delete.call_args_list
+        == [mock.call(uuid.UUID("00000000-0000-0000-0000-000000000000"), document_id, bytes(32), "link")] * spool.store_attempts
+    )
+
+
+def test_document_status_of_unknown_document(client, spool, scan_files_store):
+    scan_files_store.document_exists.return_value = False
+
+    response = client.get("/services/00000000-0000-0000-0000-000000000000/documents/ffffffff-ffff-ffff-ffff-ffffffffffff/status")
+
+    assert response.status_code == 404
+    assert response.json == {"error": "Document not found"}
+
+
+def test_document_status_of_document_spooled_by_another_pod(client, spool, scan_files_store):
+    scan_files_store.document_exists.return_value = True
+
+    response = client.get(
+        "/services/00000000-0000-0000-0000-000000000000/documents/ffffffff-ffff-ffff-ffff-ffffffffffff/status",
+        query_string={"sending_method": "attach"},
+    )
+
+    assert response.status_code == 200
+    assert response.json == {
+        "status": "ok",
+        "document_id": "ffffffff-ffff-ffff-ffff-ffffffffffff",
+        "upload_status": "stored",
+    }
+    scan_files_store.document_exists.assert_called_once_with(
+        uuid.UUID("00000000-0000-0000-0000-000000000000"), uuid.UUID("ffffffff-ffff-ffff-ffff-ffffffffffff"), "attach"
+    )
+
+
+def test_document_status_of_another_service_document(client, spool):
+    spool.add(
+        "ffffffff-ffff-ffff-ffff-ffffffffffff",
+        b"content",
+        {"service_id": "11111111-1111-1111-1111-111111111111", "document_id": "ffffffff-ffff-ffff-ffff-ffffffffffff"},
+    )
+
+    response = client.get("/services/00000000-0000-0000-0000-000000000000/documents/ffffffff-ffff-ffff-ffff-ffffffffffff/status")
+
+    assert response.status_code == 404
+    assert response.json == {"error": "Document not found"}
+
+
+def compressed_upload_body(compress, document, **fields):
+    boundary, body = encode_multipart({"document": FileStorage(io.BytesIO(document), filename="file.csv"), **fields})
+    return {"data": compress(body), "content_type": f"multipart/form-data; boundary={boundary}"}
+
+
+def test_document_upload_with_compressed_body(client, store, scan_files_store):
+    store.put.return_value = {"id": "ffffffff-ffff-ffff-ffff-ffffffffffff", "encryption_key": bytes(32)}
+    content = b"a,b,c\n" * 10000
+
+    response = client.post(
+        "/services/00000000-0000-0000-0000-000000000000/documents",
+        headers={"Content-Encoding": "gzip"},
+        **compressed_upload_body(gzip.compress, content, filename="file.csv", sending_method="link"),
+    )
+
+    assert response.status_code == 201
+    assert response.json["document"]["mime_type"] == "text/csv"
+    assert response.json["document"]["file_size"] == len(content)
+    assert store.put.call_args.args[1] == content
+
+
+@pytest.mark.parametrize("content_encoding", ["br", "zstd"])
+def test_document_upload_with_unsupported_content_encoding(client, store, content_encoding):
+    response = client.post(
+        "/services/00000000-0000-0000-0000-000000000000/documents",
+        headers={"Content-Encoding": content_encoding},
+        **compressed_upload_body(lambda body: body, b"a,b,c\n"),
+    )
+
+    assert response.status_code == 415
+    assert response.json == {"error": f"Unsupported Content-Encoding '{content_encoding}'"}
+    store.put.assert_not_called()
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_document_upload_with_corrupt_compressed_body(app, client, streaming_stores, streaming):
+    store, scan_files_store = streaming_stores
+    with set_config(app, UPLOAD_STREAMING_ENABLED=streaming):
+        response = client.post(
+            "/services/00000000-0000-0000-0000-000000000000/documents",
+            headers={"Content-Encoding": "gzip"},
+            **compressed_upload_body(lambda body: gzip.compress(body)[:-20], b"a,b,c\n"),
+        )
+
+    assert response.status_code == 400
+    assert response.json == {"error": "Invalid gzip request body"}
+    store.put.assert_not_called()
+    store.open_writer.return_value["writer"].close.assert_not_called()
+
+
+def test_document_upload_with_compressed_body_too_large_once_decompressed(app, client, store):
+    response = client.post(
+        "/services/00000000-0000-0000-0000-000000000000/documents",
+        headers={"Content-Encoding": "gzip"},
+        **compressed_upload_body(gzip.compress, b"a" * app.config["MAX_CONTENT_LENGTH"]),
+    )
+
+    assert response.status_code == 413
+    assert response.json == {"error": "Uploaded document exceeds file size limit"}
+    store.put.assert_not_called()
@@ -0,0 +1,49 @@
+import io
+
+import pytest
+from app.utils.buffer import BufferReader
+
+
+def test_buffer_reader_reads_a_slice_of_the_buffer():
+    reader = BufferReader(b"0123456789", 2, 8)
+
+    assert len(reader) == 6
+    assert reader.read(4) == b"2345"
+    assert reader.read() == b"67"
+    assert reader.read() == b""
+
+
+def test_buffer_reader_readinto():
+    reader = BufferReader(bytearray(b"abcdef"))
+    buffer = bytearray(4)
+
+    assert reader.readinto(buffer) == 4
+    assert buffer == b"abcd"
+    assert reader.readinto(buffer) == 2
+    assert buffer[:2] == b"ef"
+
+
+@pytest.mark.parametrize(
+    "offset, whence, expected", [(3, io.SEEK_SET, b"def"), (-2, io.SEEK_END, b"ef"), (1, io.SEEK_CUR, b"cdef")]
+)
+def test_buffer_reader_seek(offset, whence, expected):
+    reader = BufferReader(b"abcdef")
+    reader.read(1)
+
+    reader.seek(offset, whence)
+
+    assert reader.read() == expected
+
+
+def test_buffer_reader_does_not_seek_before_start():
+    with pytest.raises(ValueError):
+        BufferReader(b"abc").seek(-1)
+
+
+def test_buffer_readers_share_the_buffer():
+    content = b"abcdef"
+    first, second = BufferReader(content), BufferReader(content)
+
+    assert first.read(3) == b"abc"
+    assert second.read() == b"abcdef"
+    assert first.read() == b"def"
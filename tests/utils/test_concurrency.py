@@ -0,0 +1,164 @@
+import concurrent.futures
+import threading
+import time
+from unittest import mock
+
+import pytest
+from app.utils.concurrency import Notifier, Prefetch, SingleFlight
+
+
+def test_prefetch_runs_in_background():
+    started = threading.Event()
+    release = threading.Event()
+
+    def fetch(value):
+        started.set()
+        release.wait(timeout=5)
+        return value
+
+    with Prefetch(fetch, "value") as prefetch:
+        assert started.wait(timeout=5)
+        release.set()
+        assert prefetch.result() == "value"
+
+
+def test_prefetch_raises_errors_on_result():
+    with Prefetch(mock.Mock(side_effect=ValueError("boom"))) as prefetch:
+        with pytest.raises(ValueError):
+            prefetch.result()
+
+
+def test_prefetch_discards_result_not_collected():
+    discarded = threading.Event()
+    discard = mock.Mock(side_effect=lambda result: discarded.set())
+
+    with Prefetch(lambda: "value", discard=discard):
+        pass
+
+    assert discarded.wait(timeout=5)
+    discard.assert_called_once_with("value")
+
+
+def test_prefetch_does_not_discard_collected_result():
+    discard = mock.Mock()
+
+    with Prefetch(lambda: "value", discard=discard) as prefetch:
+        prefetch.result()
+
+    discard.assert_not_called()
+
+
+def test_prefetch_does_not_discard_failed_call():
+    discard = mock.Mock()
+
+    with pytest.raises(KeyError):
+        with Prefetch(mock.Mock(side_effect=ValueError("boom")), discard=discard):
+            raise KeyError()
+
+    discard.assert_not_called()
+
+
+def run_concurrently(flights, key, fn, callers):
+    results = [None] * callers
+    errors = [None] * callers
+
+    def call(i):
+        try:
+            results[i] = flights.do(key, fn)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_single_flight_coalesces_concurrent_calls(mocker):
+    waiting = threading.Semaphore(0)
+
+    class Future(concurrent.futures.Future):
+        def result(self, timeout=None):
+            waiting.release()
+            return super().result(timeout)
+
+    mocker.patch("app.utils.concurrency.Future", Future)
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def fetch():
+        started.set()
+        release.wait(timeout=5)
+        return "value"
+
+    fn = mock.Mock(side_effect=fetch)
+    leader, leader_results, _ = run_concurrently(flights, "key", fn, callers=1)
+    assert started.wait(timeout=5)
+    followers, follower_results, _ = run_concurrently(flights, "key", fn, callers=4)
+    for _ in range(4):
+        assert waiting.acquire(timeout=5)
+    release.set()
+    for thread in leader + followers:
+        thread.join()
+
+    fn.assert_called_once_with()
+    assert leader_results == [("value", False)]
+    assert follower_results == [("value", True)] * 4
+
+
+def test_single_flight_shares_exceptions():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait(timeout=5)
+        raise ValueError("boom")
+
+    threads, _, errors = run_concurrently(flights, "key", fail, callers=3)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert flights._calls == {}
+
+
+def test_single_flight_does_not_reuse_finished_calls():
+    flights = SingleFlight()
+    fn = mock.Mock(return_value="value")
+
+    assert flights.do("key", fn) == ("value", False)
+    assert flights.do("key", fn) == ("value", False)
+    assert fn.call_count == 2
+
+
+def test_notifier_wakes_waiters_of_key():
+    notifier = Notifier()
+    results = []
+    waiters = [threading.Thread(target=lambda: results.append(notifier.wait("key", timeout=5))) for _ in range(3)]
+    for waiter in waiters:
+        waiter.start()
+    while notifier._events.get("key", (None, 0))[1] < 3:
+        time.sleep(0.001)
+
+    notifier.notify("other-key")
+    notifier.notify("key")
+    for waiter in waiters:
+        waiter.join()
+
+    assert results == [True] * 3
+    assert notifier._events == {}
+
+
+def test_notifier_wait_times_out():
+    notifier = Notifier()
+
+    assert notifier.wait("key", timeout=0.01) is False
+    assert notifier._events == {}
+
+
+def test_notifier_does_not_remember_notifications_without_waiters():
+    notifier = Notifier()
+    notifier.notify("key")
+
+    assert notifier.wait("key", timeout=0.01) is False
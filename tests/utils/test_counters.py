@@ -0,0 +1,71 @@
+from unittest import mock
+
+import pytest
+from app.utils.counters import CounterReporter
+
+
+@pytest.fixture
+def reporter(app):
+    reporter = CounterReporter()
+    reporter.init_app(app)
+    reporter.register("documents.legacy_key_probe", mock.Mock(return_value={"get_object.new": 3, "get_object.legacy": 1}))
+    reporter.register("empty", mock.Mock(return_value={}))
+    return reporter
+
+
+def test_get_counts(reporter):
+    assert reporter.get_counts() == {
+        "documents.legacy_key_probe.get_object.legacy": 1,
+        "documents.legacy_key_probe.get_object.new": 3,
+    }
+
+
+def test_log_counts(app, reporter, mocker):
+    info = mocker.patch.object(app.logger, "info")
+
+    reporter.log_counts()
+
+    info.assert_called_once_with(
+        "Counters",
+        extra={
+            "pid": mock.ANY,
+            "counters": {
+                "documents.legacy_key_probe.get_object.legacy": 1,
+                "documents.legacy_key_probe.get_object.new": 3,
+            },
+        },
+    )
+
+
+def test_log_counts_without_counts(app, mocker):
+    reporter = CounterReporter()
+    reporter.init_app(app)
+    info = mocker.patch.object(app.logger, "info")
+
+    reporter.log_counts()
+
+    info.assert_not_called()
+
+
+def test_start_logs_counts_periodically(reporter, mocker):
+    reporter.interval = 0.01
+    log_counts = mocker.patch.object(reporter, "log_counts")
+
+    reporter.start()
+    try:
+        for _ in range(500):
+            if log_counts.call_count >= 2:
+                break
+            reporter._stopped.wait(0.01)
+    finally:
+        reporter.stop()
+
+    assert log_counts.call_count >= 2
+
+
+def test_start_does_nothing_without_interval(reporter):
+    reporter.interval = 0
+
+    reporter.start()
+
+    assert reporter._thread is None
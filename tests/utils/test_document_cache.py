@@ -0,0 +1,169 @@
+import io
+import os
+import time
+from datetime import datetime, timezone
+from unittest import mock
+
+import pytest
+from app.utils.document_cache import DocumentCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DocumentCache(str(tmp_path))
+
+
+def fetch_document(content=b"PDF document contents", **kwargs):
+    return mock.Mock(
+        return_value={
+            "body": io.BytesIO(content),
+            "mimetype": "application/pdf",
+            "size": len(content),
+            "etag": '"etag"',
+            "last_modified": datetime(2015, 10, 21, 7, 28, tzinfo=timezone.utc),
+            **kwargs,
+        }
+    )
+
+
+def test_get_fetches_and_caches_document(cache):
+    fetch = fetch_document()
+
+    document = cache.get("service-id/document-id", fetch)
+
+    assert document == {
+        "body": mock.ANY,
+        "mimetype": "application/pdf",
+        "size": 21,
+        "etag": '"etag"',
+        "last_modified": datetime(2015, 10, 21, 7, 28, tzinfo=timezone.utc),
+    }
+    assert document["body"].read() == b"PDF document contents"
+    fetch.assert_called_once_with()
+
+    assert cache.get("service-id/document-id", fetch)["body"].read() == b"PDF document contents"
+    fetch.assert_called_once_with()
+    assert cache.get_counts() == {"misses": 1, "memory_hits": 1}
+
+
+def test_get_serves_disk_hits_from_file(cache):
+    cache.get("service-id/document-id", fetch_document())
+
+    # Another worker, sharing the cache directory
+    other_cache = DocumentCache(cache.directory)
+    fetch = fetch_document()
+    document = other_cache.get("service-id/document-id", fetch)
+
+    fetch.assert_not_called()
+    assert isinstance(document["body"], io.BufferedReader)
+    assert document["body"].read() == b"PDF document contents"
+    assert document["size"] == 21
+    assert document["last_modified"] == datetime(2015, 10, 21, 7, 28, tzinfo=timezone.utc)
+    document["body"].close()
+    assert other_cache.get_counts() == {"disk_hits": 1}
+
+
+def test_get_keeps_large_documents_out_of_memory(cache):
+    cache.memory_max_document_size = 10
+    cache.get("service-id/document-id", fetch_document())
+
+    document = cache.get("service-id/document-id", fetch_document())
+
+    assert isinstance(document["body"], io.BufferedReader)
+    document["body"].close()
+    assert cache.get_counts() == {"misses": 1, "disk_hits": 1}
+
+
+def test_get_does_not_cache_documents_over_max_size(cache):
+    cache.max_document_size = 10
+    body = io.BytesIO(b"PDF document contents")
+
+    document = cache.get("service-id/document-id", fetch_document(body=body))
+
+    assert document["body"] is body
+    assert os.listdir(cache.directory) == []
+
+
+def test_get_evicts_least_recently_used_documents(cache):
+    cache.memory_max_bytes = 50
+    cache.disk_max_bytes = 50
+    cache.get("first", fetch_document())
+    cache.get("second", fetch_document())
+    os.utime(cache._path("first"), (time.time() - 10, time.time() - 10))
+    os.utime(cache._path("second"), (time.time() - 5, time.time() - 5))
+    cache.get("first", fetch_document())
+
+    cache.get("third", fetch_document())
+
+    assert list(cache._memory) == ["first", "third"]
+    assert not os.path.exists(cache._path("first"))
+    assert os.path.exists(cache._path("second"))
+    assert os.path.exists(cache._path("third"))
+
+
+def test_get_expires_documents(cache):
+    cache.ttl = -1
+    cache.get("service-id/document-id", fetch_document())
+    fetch = fetch_document()
+
+    cache.get("service-id/document-id", fetch)
+
+    fetch.assert_called_once_with()
+    assert cache.get_counts() == {"misses": 2}
+
+
+def test_get_serves_document_if_it_cannot_be_cached_on_disk(app, cache):
+    with app.app_context(), mock.patch.object(cache, "_put_in_disk", side_effect=OSError("No space left on device")):
+        document = cache.get("service-id/document-id", fetch_document())
+
+    assert document["body"].read() == b"PDF document contents"
+
+
+def test_delete(cache):
+    cache.get("service-id/document-id", fetch_document())
+
+    cache.delete("service-id/document-id")
+
+    fetch = fetch_document()
+    cache.get("service-id/document-id", fetch)
+    fetch.assert_called_once_with()
+
+
+@pytest.mark.parametrize("memory_max_document_size", [1024, 0])
+def test_get_serves_hits_of_documents_which_still_exist(cache, memory_max_document_size):
+    cache.memory_max_document_size = memory_max_document_size
+    cache.get("service-id/document-id", fetch_document())
+    fetch = fetch_document()
+    exists = mock.Mock(return_value=True)
+
+    document = cache.get("service-id/document-id", fetch, exists=exists)
+
+    assert document["body"].read() == b"PDF document contents"
+    exists.assert_called_once_with()
+    fetch.assert_not_called()
+
+
+@pytest.mark.parametrize("memory_max_document_size", [1024, 0])
+def test_get_drops_documents_deleted_through_another_process(cache, memory_max_document_size):
+    cache.memory_max_document_size = memory_max_document_size
+    cache.get("service-id/document-id", fetch_document())
+    fetch = mock.Mock(side_effect=FileNotFoundError)
+
+    with pytest.raises(FileNotFoundError):
+        cache.get("service-id/document-id", fetch, exists=mock.Mock(return_value=False))
+
+    fetch.assert_called_once_with()
+    assert cache._memory == {}
+    assert not os.path.exists(cache._path("service-id/document-id"))
+    assert cache.get_counts() == {"misses": 2}
+
+
+def test_get_serves_disk_hit_evicted_by_another_process_while_opening_it(cache):
+    cache.memory_max_document_size = 0
+    cache.get("service-id/document-id", fetch_document())
+
+    with mock.patch("app.utils.document_cache.os.utime", side_effect=FileNotFoundError):
+        document = cache.get("service-id/document-id", fetch_document())
+
+    assert document["body"].read() == b"PDF document contents"
+    document["body"].close()
@@ -0,0 +1,46 @@
+import io
+
+import pytest
+from app.utils.multipart import InvalidMultipartError, MultipartField, MultipartFile, iter_multipart
+from werkzeug.http import parse_options_header
+from werkzeug.test import EnvironBuilder
+
+
+def _encode(data):
+    environ = EnvironBuilder(method="POST", data=data).get_environ()
+    boundary = parse_options_header(environ["CONTENT_TYPE"])[1]["boundary"]
+    return environ["wsgi.input"], boundary.encode()
+
+
+def test_iter_multipart_yields_fields_and_files_in_order():
+    stream, boundary = _encode({"sending_method": "link", "document": (io.BytesIO(b"a" * 1000), "file.pdf")})
+
+    parts = []
+    for part in iter_multipart(stream, boundary, chunk_size=64):
+        if isinstance(part, MultipartFile):
+            chunks = list(part.chunks)
+            assert max(len(chunk) for chunk in chunks) <= 64
+            parts.append((part.name, part.filename, b"".join(chunks)))
+        else:
+            parts.append(part)
+
+    assert parts == [
+        MultipartField("sending_method", "link"),
+        ("document", "file.pdf", b"a" * 1000),
+    ]
+
+
+def test_iter_multipart_skips_unconsumed_file_contents():
+    stream, boundary = _encode({"document": (io.BytesIO(b"a" * 1000), "file.pdf"), "other": (io.BytesIO(b"b"), "b.txt")})
+
+    parts = list(iter_multipart(stream, boundary, chunk_size=64))
+
+    assert [part.name for part in parts] == ["document", "other"]
+
+
+def test_iter_multipart_raises_for_truncated_body():
+    stream = io.BytesIO(b'--boundary\r\nContent-Disposition: form-data; name="document"; filename="file.pdf"\r\n\r\nabc')
+
+    with pytest.raises(InvalidMultipartError):
+        for part in iter_multipart(stream, b"boundary", chunk_size=64):
+            list(part.chunks)
@@ -22,6 +22,10 @@ def app():
 def store(app):
     store = ScanFilesDocumentStore()
     store.init_app(app)
+    # Scan durations are sampled from the age of scanned documents
+    store.s3.get_object_attributes = MagicMock(
+        return_value={"ObjectSize": 100, "ResponseMetadata": {"HTTPHeaders": {"last-modified": "Fri, 17 Feb 2023 16:00:00 GMT"}}}
+    )
     return store
 
 
@@ -96,6 +100,36 @@ class TestScanFilesDocumentStoreFallback:
             # Only one call should be made (no fallback)
             assert store.s3.get_object_tagging.call_count == 1
 
+    def test_check_scan_verdict_no_fallback_for_current_key_layout(self, app, store):
+        """Verify check_scan_verdict does not fallback for documents linked with the current key layout"""
+        error_response = {"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}
+        not_found_error = ClientError(error_response, "GetObjectTagging")
+
+        with app.app_context():
+            store.s3.get_object_tagging = MagicMock(side_effect=not_found_error)
+
+            with pytest.raises(DocumentStoreError):
+                store.check_scan_verdict("service-123", "doc-456", "link", key_layout="2")
+
+            assert store.s3.get_object_tagging.call_count == 1
+
+    def test_check_scan_verdict_parallel_probe(self, app, store):
+        """Verify check_scan_verdict can request the new and old paths at once"""
+        store.legacy_key_probe.parallel = True
+        not_found_error = ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObjectTagging")
+
+        def get_object_tagging(Bucket, Key):
+            if Key == "api_link/service-123/doc-456":
+                raise not_found_error
+            return {"TagSet": [{"Key": "GuardDutyMalwareScanStatus", "Value": "NO_THREATS_FOUND"}]}
+
+        with app.app_context():
+            store.s3.get_object_tagging = MagicMock(side_effect=get_object_tagging)
+
+            assert store.check_scan_verdict("service-123", "doc-456", "link") == "NO_THREATS_FOUND"
+            assert store.s3.get_object_tagging.call_count == 2
+            assert store.legacy_key_probe.get_counts()["get_object_tagging.legacy"] == 1
+
     def test_check_scan_verdict_malicious_on_old_path(self, app, store):
         """Verify malicious verdict is properly detected from old path"""
         service_id = "service-123"
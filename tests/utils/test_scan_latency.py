@@ -0,0 +1,93 @@
+import pytest
+from app.utils.scan_latency import ScanLatencyHistogram, get_size_bucket
+
+
+@pytest.fixture
+def histogram():
+    histogram = ScanLatencyHistogram()
+    histogram.min_samples = 3
+    return histogram
+
+
+def record_scans(histogram, durations, size=1000):
+    for duration in durations:
+        histogram.record(("service-id", object()), size, duration)
+
+
+@pytest.mark.parametrize(
+    "size, bucket",
+    [(None, 0), (0, 0), (100 * 1024, 0), (100 * 1024 + 1, 1), (1024 * 1024, 1), (10 * 1024 * 1024 + 1, 3)],
+)
+def test_get_size_bucket(size, bucket):
+    assert get_size_bucket(size) == bucket
+
+
+def test_estimate_remaining_without_enough_scans(histogram):
+    record_scans(histogram, [4, 4])
+
+    assert histogram.estimate_remaining(1000, 0) is None
+
+
+def test_estimate_remaining_is_median_of_longer_scans(histogram):
+    record_scans(histogram, [4, 4, 7, 7, 25, 25, 25])
+
+    # Median of all scans: 7 seconds, in the (5, 8] bin
+    assert histogram.estimate_remaining(1000, 0) == 8
+    # Median of the scans that lasted more than 6 seconds: 25 seconds, in the (20, 30] bin
+    assert histogram.estimate_remaining(1000, 6) == 24
+
+
+def test_estimate_remaining_of_documents_slower_than_any_scan(histogram):
+    record_scans(histogram, [4, 4, 4])
+
+    assert histogram.estimate_remaining(1000, 60) is None
+
+
+def test_estimate_remaining_of_very_slow_scans(histogram):
+    record_scans(histogram, [900, 900, 900])
+
+    assert histogram.estimate_remaining(1000, 0) is None
+
+
+def test_estimate_remaining_per_size(histogram):
+    record_scans(histogram, [4, 4, 4], size=1000)
+    record_scans(histogram, [50, 50, 50], size=20 * 1024 * 1024)
+
+    assert histogram.estimate_remaining(1000, 0) == 5
+    assert histogram.estimate_remaining(20 * 1024 * 1024, 0) == 60
+
+
+def test_estimate_remaining_falls_back_to_all_scans(histogram):
+    record_scans(histogram, [4, 4, 4], size=1000)
+
+    assert histogram.estimate_remaining(2 * 1024 * 1024, 0) == 5
+
+
+def test_histograms_only_count_last_scans(histogram):
+    histogram.window = 3
+    record_scans(histogram, [50, 50, 50, 4, 4, 4])
+
+    assert histogram.estimate_remaining(1000, 0) == 5
+
+
+def test_record_ignores_documents_checked_long_after_they_were_stored(histogram):
+    record_scans(histogram, [16 * 60, 16 * 60, 16 * 60])
+
+    assert histogram._histograms == {}
+
+
+def test_record_counts_documents_once(histogram):
+    for _ in range(3):
+        histogram.record(("service-id", "document-id"), 1000, 4)
+
+    assert histogram.is_recorded(("service-id", "document-id"))
+    assert list(histogram._histograms[None][0]) == [2]
+
+
+def test_record_forgets_oldest_documents(histogram):
+    histogram.max_recorded = 2
+    for document_id in range(3):
+        histogram.record(("service-id", document_id), 1000, 4)
+
+    assert not histogram.is_recorded(("service-id", 0))
+    assert histogram.is_recorded(("service-id", 2))
@@ -0,0 +1,159 @@
+import json
+import queue
+import threading
+import uuid
+from unittest import mock
+
+import pytest
+from app.utils.guardduty import parse_scan_result_event
+from app.utils.scan_results import ScanResultConsumer
+from flask import has_app_context
+
+
+class LocalQueue:
+    """
+    In-process stand-in for an SQS queue, implementing the subset of the SQS client used by
+    `ScanResultConsumer`. Received messages are invisible until deleted, and are never redelivered.
+    """
+
+    def __init__(self):
+        self._messages = queue.Queue()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody):
+        message_id = str(uuid.uuid4())
+        self._messages.put({"MessageId": message_id, "Body": MessageBody})
+        return {"MessageId": message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0):
+        messages = []
+        try:
+            messages.append(self._messages.get(timeout=WaitTimeSeconds) if WaitTimeSeconds else self._messages.get_nowait())
+            while len(messages) < MaxNumberOfMessages:
+                messages.append(self._messages.get_nowait())
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            for message in messages:
+                message["ReceiptHandle"] = str(uuid.uuid4())
+                self._in_flight[message["ReceiptHandle"]] = message
+        return {"Messages": messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self._lock:
+            self._in_flight.pop(ReceiptHandle, None)
+
+    def get_in_flight_count(self):
+        with self._lock:
+            return len(self._in_flight)
+
+
+def scan_result_event(key="api_link/service-id/document-id", verdict="NO_THREATS_FOUND", bucket="scan-files-bucket"):
+    return {
+        "version": "0",
+        "detail-type": "GuardDuty Malware Protection Object Scan Result",
+        "source": "aws.guardduty",
+        "detail": {
+            "schemaVersion": "1.0",
+            "scanStatus": "COMPLETED",
+            "resourceType": "S3_OBJECT",
+            "s3ObjectDetails": {"bucketName": bucket, "objectKey": key, "eTag": "0f0f0f"},
+            "scanResultDetails": {"scanResultStatus": verdict, "threats": None},
+        },
+    }
+
+
+@pytest.fixture
+def local_queue():
+    return LocalQueue()
+
+
+@pytest.fixture
+def consumer(app, local_queue):
+    consumer = ScanResultConsumer(mock.Mock(), queue=local_queue)
+    consumer.init_app(app)
+    consumer.wait_time = 0
+    return consumer
+
+
+def test_parse_scan_result_event():
+    assert parse_scan_result_event(scan_result_event(verdict="THREATS_FOUND")) == (
+        "scan-files-bucket",
+        "api_link/service-id/document-id",
+        "THREATS_FOUND",
+    )
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        None,
+        "not-an-event",
+        {"detail-type": "Object Created", "detail": {}},
+        {"detail-type": "GuardDuty Malware Protection Object Scan Result", "detail": {}},
+    ],
+)
+def test_parse_scan_result_event_ignores_other_events(event):
+    assert parse_scan_result_event(event) is None
+
+
+def test_poll_records_verdicts(consumer, local_queue):
+    local_queue.send_message(QueueUrl=None, MessageBody=json.dumps(scan_result_event(key="api_link/service-id/1")))
+    local_queue.send_message(
+        QueueUrl=None, MessageBody=json.dumps(scan_result_event(key="api_link/service-id/2", verdict="THREATS_FOUND"))
+    )
+
+    assert consumer.poll() == 2
+
+    assert consumer.store.record_scan_verdict.call_args_list == [
+        mock.call("scan-files-bucket", "api_link/service-id/1", "NO_THREATS_FOUND"),
+        mock.call("scan-files-bucket", "api_link/service-id/2", "THREATS_FOUND"),
+    ]
+    assert local_queue.get_in_flight_count() == 0
+
+
+def test_poll_deletes_unexpected_events(consumer, local_queue):
+    local_queue.send_message(QueueUrl=None, MessageBody="not json")
+    local_queue.send_message(QueueUrl=None, MessageBody=json.dumps({"detail-type": "Object Created"}))
+
+    assert consumer.poll() == 0
+
+    consumer.store.record_scan_verdict.assert_not_called()
+    assert local_queue.get_in_flight_count() == 0
+
+
+def test_poll_keeps_events_that_failed_to_be_recorded(consumer, local_queue):
+    consumer.store.record_scan_verdict.side_effect = OSError("boom")
+    local_queue.send_message(QueueUrl=None, MessageBody=json.dumps(scan_result_event()))
+
+    with pytest.raises(OSError):
+        consumer.poll()
+
+    assert local_queue.get_in_flight_count() == 1
+
+
+def test_poll_without_events(consumer):
+    assert consumer.poll() == 0
+
+
+def test_consumer_records_verdicts_in_background(consumer, local_queue):
+    consumer.wait_time = 0.01
+    app_contexts = []
+    consumer.store.record_scan_verdict.side_effect = lambda *args: app_contexts.append(has_app_context())
+    local_queue.send_message(QueueUrl=None, MessageBody=json.dumps(scan_result_event()))
+
+    consumer.start()
+    try:
+        for _ in range(500):
+            if consumer.store.record_scan_verdict.called:
+                break
+            consumer._stopped.wait(0.01)
+    finally:
+        consumer.stop()
+
+    consumer.store.record_scan_verdict.assert_called_once_with(
+        "scan-files-bucket", "api_link/service-id/document-id", "NO_THREATS_FOUND"
+    )
+    assert app_contexts == [True]
@@ -0,0 +1,209 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from unittest import mock
+
+import pytest
+from app.utils.spool import UploadSpool
+
+
+@pytest.fixture
+def spool(tmp_path):
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.config["UPLOAD_SPOOL_DIR"] = str(tmp_path)
+    spool = UploadSpool()
+    spool.init_app(app)
+    spool.retry_delay = 0
+    return spool
+
+
+def read_record(spool, document_id):
+    with open(os.path.join(spool.directory, f"{document_id}.json")) as f:
+        return json.load(f)
+
+
+def test_add_spools_document_as_pending(spool):
+    spool.add("document-id", b"content", {"service_id": "service-id", "encryption_key": "a2V5"})
+
+    with open(os.path.join(spool.directory, "document-id"), "rb") as f:
+        assert f.read() == b"content"
+    assert read_record(spool, "document-id") == {
+        "service_id": "service-id",
+        "encryption_key": "a2V5",
+        "status": "pending",
+        "updated_at": mock.ANY,
+    }
+    assert spool.get_status("document-id") == {"service_id": "service-id", "status": "pending", "updated_at": mock.ANY}
+
+
+def test_submit_stores_document_in_background(spool):
+    handler = mock.Mock()
+    spool.add("document-id", b"content", {"service_id": "service-id", "encryption_key": "a2V5"})
+
+    spool.submit("document-id", handler)
+    spool.join()
+
+    handler.assert_called_once_with(
+        b"content", {"service_id": "service-id", "encryption_key": "a2V5", "status": "pending", "updated_at": mock.ANY}
+    )
+    assert read_record(spool, "document-id") == {"service_id": "service-id", "status": "stored", "updated_at": mock.ANY}
+    assert not os.path.exists(os.path.join(spool.directory, "document-id"))
+
+
+def test_submit_marks_document_failed_if_handler_raises(spool):
+    spool.add("document-id", b"content", {"service_id": "service-id"})
+
+    spool.submit("document-id", mock.Mock(side_effect=ValueError("boom")))
+    spool.join()
+
+    assert spool.get_status("document-id")["status"] == "failed"
+    assert not os.path.exists(os.path.join(spool.directory, "document-id"))
+
+
+def test_submit_retries_storing_document(spool, mocker):
+    handler = mock.Mock(side_effect=[ValueError("boom"), ValueError("boom"), None])
+    statuses = []
+    sleep = mocker.patch(
+        "app.utils.spool.time.sleep", side_effect=lambda delay: statuses.append(spool.get_status("document-id")["status"])
+    )
+    spool.retry_delay = 2
+    spool.add("document-id", b"content", {"service_id": "service-id"})
+
+    spool.submit("document-id", handler)
+    spool.join()
+
+    assert handler.call_count == 3
+    assert sleep.call_args_list == [mock.call(2), mock.call(4)]
+    assert statuses == ["pending", "pending"]
+    assert spool.get_status("document-id")["status"] == "stored"
+
+
+def test_submit_marks_document_failed_after_last_attempt(spool):
+    handler = mock.Mock(side_effect=ValueError("boom"))
+    spool.store_attempts = 3
+    spool.add("document-id", b"content", {"service_id": "service-id"})
+
+    spool.submit("document-id", handler)
+    spool.join()
+
+    assert handler.call_count == 3
+    assert spool.get_status("document-id")["status"] == "failed"
+
+
+def test_submit_recovers_documents_left_pending(spool):
+    handler = mock.Mock()
+    spool.add("left-pending", b"old content", {"service_id": "service-id"})
+    spool.add("document-id", b"content", {"service_id": "service-id"})
+
+    spool.submit("document-id", handler)
+    spool.join()
+
+    assert sorted(call.args[0] for call in handler.call_args_list) == [b"content", b"old content"]
+    assert spool.get_status("left-pending")["status"] == "stored"
+
+
+def test_submit_removes_expired_records(spool):
+    spool.add("expired", b"content", {"service_id": "service-id"})
+    spool.submit("expired", mock.Mock())
+    spool.join()
+    spool._recovered = False
+    spool.record_ttl = 0
+    time.sleep(0.01)
+
+    spool.add("document-id", b"content", {"service_id": "service-id"})
+    spool.submit("document-id", mock.Mock())
+    spool.join()
+
+    assert spool.get_status("expired") is None
+    assert spool.get_status("document-id")["status"] == "stored"
+
+
+def test_submit_prunes_expired_records_periodically(spool):
+    spool.add("expired", b"content", {"service_id": "service-id"})
+    spool.submit("expired", mock.Mock())
+    spool.join()
+    spool.record_ttl = 0.05
+    spool.prune_interval = 0
+    time.sleep(0.1)
+
+    spool.add("document-id", b"content", {"service_id": "service-id"})
+    spool.submit("document-id", mock.Mock())
+    spool.join()
+
+    assert spool.get_status("expired") is None
+
+
+def test_submit_does_not_prune_before_prune_interval(spool):
+    spool.add("expired", b"content", {"service_id": "service-id"})
+    spool.submit("expired", mock.Mock())
+    spool.join()
+    spool.record_ttl = 0
+    time.sleep(0.01)
+
+    spool.add("document-id", b"content", {"service_id": "service-id"})
+    spool.submit("document-id", mock.Mock())
+    spool.join()
+
+    assert spool.get_status("expired")["status"] == "stored"
+
+
+def test_submit_skips_document_locked_by_another_process(spool):
+    handler = mock.Mock()
+    spool.add("document-id", b"content", {"service_id": "service-id"})
+
+    with open(os.path.join(spool.directory, "document-id.json")) as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        spool.submit("document-id", handler)
+        spool.join()
+
+    handler.assert_not_called()
+    assert spool.get_status("document-id")["status"] == "pending"
+
+
+def test_get_status_of_unknown_document(spool):
+    assert spool.get_status("document-id") is None
+
+
+def test_start_recovers_documents_left_pending(spool):
+    spool.add("left-pending", b"old content", {"service_id": "service-id"})
+    handler = mock.Mock()
+
+    spool.start(handler)
+    spool.join()
+
+    handler.assert_called_once_with(b"old content", {"service_id": "service-id", "status": "pending", "updated_at": mock.ANY})
+    assert spool.get_status("left-pending")["status"] == "stored"
+
+
+def test_start_without_spool_directory(tmp_path, spool):
+    spool.directory = str(tmp_path / "missing")
+
+    spool.start(mock.Mock())
+    spool.join()
+
+
+def test_drain_waits_for_documents_being_stored(spool):
+    release = threading.Event()
+    spool.add("document-id", b"content", {"service_id": "service-id"})
+    spool.submit("document-id", lambda content, record: release.wait(timeout=5))
+
+    threading.Timer(0.05, release.set).start()
+    spool.drain(timeout=5)
+
+    assert spool.get_status("document-id")["status"] == "stored"
+
+
+def test_drain_leaves_documents_pending_after_timeout(spool):
+    release = threading.Event()
+    spool.add("document-id", b"content", {"service_id": "service-id"})
+    spool.submit("document-id", lambda content, record: release.wait(timeout=5))
+
+    spool.drain(timeout=0.01)
+
+    assert spool.get_status("document-id")["status"] == "pending"
+    release.set()
+    spool.join()
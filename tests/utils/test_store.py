@@ -1,4 +1,9 @@
+import base64
+import contextlib
+import hashlib
+import tracemalloc
 import uuid
+from datetime import datetime, timezone
 from unittest import mock
 
 import pytest
@@ -6,17 +11,26 @@ from app.utils.store import (
     DocumentStore,
     DocumentStoreError,
     MaliciousContentError,
+    NotModifiedError,
+    RangeNotSatisfiableError,
+    S3MultipartWriter,
     ScanFailedError,
     ScanFilesDocumentStore,
     ScanInProgressError,
     ScanUnsupportedError,
+    get_document_key,
 )
+from app.utils.verdict_cache import SharedMemoryVerdictCache
 from botocore.exceptions import ClientError as BotoClientError
 from freezegun import freeze_time
 
 from tests.conftest import Matcher, set_config
 
 
+def read_body(body):
+    return body if isinstance(body, bytes) else body.read()
+
+
 @pytest.fixture
 def store(mocker):
     mock_boto = mocker.patch("app.utils.store.boto3")
@@ -37,6 +51,10 @@ def scan_files_store(mocker):
         "ContentType": "application/pdf",
         "ContentLength": 100,
     }
+    mock_boto.client.return_value.get_object_attributes.return_value = {
+        "ObjectSize": 100,
+        "ResponseMetadata": {"HTTPHeaders": {"last-modified": "Fri, 17 Feb 2023 16:00:00 GMT"}},
+    }
     store = ScanFilesDocumentStore(bucket="test-bucket")
     return store
 
@@ -98,11 +116,45 @@ def test_put_document_attach_tmp_dir(store):
     )
 
 
+@pytest.mark.parametrize(
+    "sending_method, encryption_params",
+    [
+        ("link", {"SSECustomerKey": mock.ANY, "SSECustomerAlgorithm": "AES256"}),
+        ("template_attach", {"ServerSideEncryption": "AES256"}),
+    ],
+)
+def test_put_document_sends_precomputed_checksum(store, scan_files_store, sending_method, encryption_params):
+    content_sha256 = hashlib.sha256(b"content").hexdigest()
+    checksum = base64.b64encode(hashlib.sha256(b"content").digest()).decode()
+
+    store.put("service-id", b"content", sending_method=sending_method, document_id="document-id", content_sha256=content_sha256)
+    scan_files_store.put("service-id", "document-id", b"content", sending_method=sending_method, content_sha256=content_sha256)
+
+    store.s3.put_object.assert_called_once_with(
+        Body=b"content",
+        Bucket="test-bucket",
+        ContentType="application/pdf",
+        Key=get_document_key("service-id", "document-id", sending_method),
+        ChecksumSHA256=checksum,
+        **encryption_params,
+    )
+    scan_files_store.s3.put_object.assert_called_once_with(
+        Body=b"content",
+        Bucket="test-bucket",
+        ContentType="application/pdf",
+        Key=get_document_key("service-id", "document-id", sending_method),
+        ChecksumSHA256=checksum,
+    )
+
+
 def test_get_document(store):
     assert store.get("service-id", "document-id", bytes(32), sending_method="link") == {
         "body": mock.ANY,
         "mimetype": "application/pdf",
         "size": 100,
+        "content_range": None,
+        "etag": None,
+        "last_modified": None,
     }
 
     store.s3.get_object.assert_called_once_with(
@@ -122,6 +174,9 @@ def test_get_document_attach_tmp_dir(store):
         "body": mock.ANY,
         "mimetype": "application/pdf",
         "size": 100,
+        "content_range": None,
+        "etag": None,
+        "last_modified": None,
     }
 
     store.s3.get_object.assert_called_once_with(
@@ -133,6 +188,87 @@ def test_get_document_attach_tmp_dir(store):
     )
 
 
+def test_get_document_byte_range(store):
+    store.s3.get_object.return_value = {
+        "Body": mock.Mock(),
+        "ContentType": "application/pdf",
+        "ContentLength": 10,
+        "ContentRange": "bytes 0-9/100",
+        "ETag": '"etag"',
+    }
+
+    document = store.get("service-id", "document-id", bytes(32), sending_method="link", key_layout="2", byte_range="bytes=0-9")
+
+    assert document["size"] == 10
+    assert document["content_range"] == "bytes 0-9/100"
+    assert document["etag"] == '"etag"'
+    store.s3.get_object.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="api_link/service-id/document-id",
+        SSECustomerAlgorithm="AES256",
+        SSECustomerKey=bytes(32),
+        Range="bytes=0-9",
+    )
+
+
+def test_get_document_byte_range_not_satisfiable(store):
+    store.s3.get_object.side_effect = BotoClientError(
+        {"Error": {"Code": "InvalidRange", "Message": "Invalid range", "ActualObjectSize": "100"}}, "GetObject"
+    )
+
+    with pytest.raises(RangeNotSatisfiableError) as e:
+        store.get("service-id", "document-id", bytes(32), sending_method="link", byte_range="bytes=200-")
+
+    assert e.value.size == 100
+
+
+def test_get_document_conditional(store):
+    store.get("service-id", "document-id", bytes(32), sending_method="link", key_layout="2", if_none_match='"etag"')
+
+    store.s3.get_object.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="api_link/service-id/document-id",
+        SSECustomerAlgorithm="AES256",
+        SSECustomerKey=bytes(32),
+        IfNoneMatch='"etag"',
+    )
+
+
+@pytest.mark.parametrize("sending_method", ["link", "template_attach"])
+def test_get_document_not_modified(store, sending_method):
+    store.s3.get_object.side_effect = BotoClientError(
+        {
+            "Error": {"Code": "304", "Message": "Not Modified"},
+            "ResponseMetadata": {"HTTPHeaders": {"etag": '"etag"', "last-modified": "Wed, 21 Oct 2015 07:28:00 GMT"}},
+        },
+        "GetObject",
+    )
+    modified_since = datetime(2015, 10, 21, 7, 28, tzinfo=timezone.utc)
+
+    with pytest.raises(NotModifiedError) as e:
+        store.get("service-id", "document-id", bytes(32), sending_method=sending_method, if_modified_since=modified_since)
+
+    assert e.value.etag == '"etag"'
+    assert store.s3.get_object.call_args.kwargs["IfModifiedSince"] == modified_since
+
+
+def test_get_deduplicated_document_byte_range(store):
+    store.s3.get_object.side_effect = [
+        BotoClientError({"Error": {"Code": "InvalidRange", "Message": "Invalid range", "ActualObjectSize": "0"}}, "GetObject"),
+        {"Body": mock.sentinel.content, "ContentType": "text/plain", "ContentLength": 10, "ContentRange": "bytes 0-9/100"},
+    ]
+    store.s3.head_object.return_value = {"ContentType": "text/csv", "Metadata": {"content-sha256": "abc123"}}
+
+    document = store.get("service-id", "document-id", None, sending_method="template_attach", byte_range="bytes=0-9")
+
+    assert document["body"] is mock.sentinel.content
+    assert document["mimetype"] == "text/csv"
+    assert document["content_range"] == "bytes 0-9/100"
+    assert store.s3.get_object.call_args_list[1] == mock.call(
+        Bucket="test-bucket", Key="template_attachments/service-id/content/abc123", Range="bytes=0-9"
+    )
+
+
 def test_get_document_with_boto_error(store):
     store.s3.get_object = mock.Mock(
         side_effect=BotoClientError({"Error": {"Code": "Error code", "Message": "Error message"}}, "GetObject")
@@ -165,6 +301,115 @@ def test_get_document_clean_guardduty(scan_files_store):
     assert result == "NO_THREATS_FOUND"
 
 
+@pytest.fixture
+def verdict_cache(scan_files_store, tmp_path):
+    scan_files_store.verdict_cache = SharedMemoryVerdictCache(str(tmp_path / "verdicts"), max_entries=16, ttl=60)
+    return scan_files_store.verdict_cache
+
+
+def test_check_scan_verdict_uses_cached_verdict(scan_files_store, verdict_cache):
+    verdict_cache.set("api_link/service-id/document-id", "NO_THREATS_FOUND")
+
+    assert scan_files_store.check_scan_verdict("service-id", "document-id", sending_method="link") == "NO_THREATS_FOUND"
+    scan_files_store.s3.get_object_tagging.assert_not_called()
+
+
+def test_check_scan_verdict_raises_for_cached_malicious_verdict(scan_files_store, verdict_cache):
+    verdict_cache.set("api_link/service-id/document-id", "THREATS_FOUND")
+
+    with pytest.raises(MaliciousContentError):
+        scan_files_store.check_scan_verdict("service-id", "document-id", sending_method="link")
+    scan_files_store.s3.get_object_tagging.assert_not_called()
+
+
+def test_check_scan_verdict_does_not_sample_scan_duration_of_cached_verdict(scan_files_store, verdict_cache):
+    verdict_cache.set("api_link/service-id/document-id", "NO_THREATS_FOUND")
+
+    for _ in range(3):
+        scan_files_store.check_scan_verdict("service-id", "document-id", sending_method="link")
+
+    scan_files_store.s3.get_object_attributes.assert_not_called()
+    assert not scan_files_store.scan_latency.is_recorded(("service-id", "document-id"))
+
+
+@pytest.mark.parametrize("verdict", ["NO_THREATS_FOUND", "THREATS_FOUND"])
+@freeze_time("2023-02-17 16:00:03")
+def test_check_scan_verdict_samples_scan_duration_once(scan_files_store, verdict):
+    scan_files_store.s3.get_object_tagging.return_value = {"TagSet": [{"Key": "GuardDutyMalwareScanStatus", "Value": verdict}]}
+
+    for _ in range(3):
+        with contextlib.suppress(MaliciousContentError):
+            scan_files_store.check_scan_verdict("service-id", "document-id", sending_method="link")
+
+    scan_files_store.s3.get_object_attributes.assert_called_once()
+    # 3 seconds, in the (2, 3] bin
+    assert list(scan_files_store.scan_latency._histograms[None][0]) == [1]
+
+
+def test_check_scan_verdict_does_not_sample_scan_duration_while_in_progress(scan_files_store):
+    scan_files_store.s3.get_object_tagging.return_value = {"TagSet": []}
+
+    with pytest.raises(ScanInProgressError):
+        scan_files_store.check_scan_verdict("service-id", "document-id", sending_method="link")
+
+    scan_files_store.s3.get_object_attributes.assert_not_called()
+
+
+def test_check_scan_verdict_without_age_of_scanned_document(scan_files_store):
+    scan_files_store.s3.get_object_tagging.return_value = {
+        "TagSet": [{"Key": "GuardDutyMalwareScanStatus", "Value": "NO_THREATS_FOUND"}]
+    }
+    scan_files_store.s3.get_object_attributes.side_effect = BotoClientError(
+        {"Error": {"Code": "AccessDenied"}}, "GetObjectAttributes"
+    )
+
+    assert scan_files_store.check_scan_verdict("service-id", "document-id", sending_method="link") == "NO_THREATS_FOUND"
+    assert scan_files_store.scan_latency._histograms == {}
+
+
+@pytest.mark.parametrize(
+    "verdict, cached_verdict",
+    [("NO_THREATS_FOUND", "NO_THREATS_FOUND"), ("malicious", "malicious"), ("in_progress", None), ("FAILED", None)],
+)
+def test_check_scan_verdict_caches_terminal_verdicts(scan_files_store, verdict_cache, verdict, cached_verdict):
+    scan_files_store.s3.get_object_tagging.return_value = {"TagSet": [{"Key": "GuardDutyMalwareScanStatus", "Value": verdict}]}
+
+    with contextlib.suppress(MaliciousContentError, ScanInProgressError, ScanFailedError):
+        scan_files_store.check_scan_verdict("service-id", "document-id", sending_method="link")
+
+    assert verdict_cache.get("api_link/service-id/document-id") == cached_verdict
+
+
+@pytest.mark.parametrize(
+    "bucket, verdict, cached_verdict",
+    [
+        ("test-bucket", "NO_THREATS_FOUND", "NO_THREATS_FOUND"),
+        ("test-bucket", "THREATS_FOUND", "THREATS_FOUND"),
+        ("test-bucket", "FAILED", None),
+        ("other-bucket", "NO_THREATS_FOUND", None),
+    ],
+)
+def test_record_scan_verdict(scan_files_store, verdict_cache, bucket, verdict, cached_verdict):
+    scan_files_store.record_scan_verdict(bucket, "api_link/service-id/document-id", verdict)
+
+    assert verdict_cache.get("api_link/service-id/document-id") == cached_verdict
+
+
+def test_record_scan_verdict_notifies_waiters(scan_files_store):
+    scan_files_store.verdict_events = mock.Mock()
+
+    scan_files_store.record_scan_verdict("test-bucket", "api_link/service-id/document-id", "NO_THREATS_FOUND")
+
+    scan_files_store.verdict_events.notify.assert_called_once_with("api_link/service-id/document-id")
+
+
+def test_check_scan_verdict_uses_recorded_verdict(scan_files_store, verdict_cache):
+    scan_files_store.record_scan_verdict("test-bucket", "api_link/service-id/document-id", "NO_THREATS_FOUND")
+
+    assert scan_files_store.check_scan_verdict("service-id", "document-id", sending_method="link") == "NO_THREATS_FOUND"
+    scan_files_store.s3.get_object_tagging.assert_not_called()
+
+
 def test_get_document_scan_unsupported_guardduty(scan_files_store):
     scan_files_store.s3.get_object_tagging = mock.Mock(
         return_value={"TagSet": [{"Key": "GuardDutyMalwareScanStatus", "Value": "UNSUPPORTED"}]}
@@ -247,6 +492,19 @@ def test_guardduty_tag_takes_precedence_over_scanfiles_malicious(scan_files_stor
         scan_files_store.check_scan_verdict("service-id", "document-id", sending_method="link")
 
 
+@pytest.mark.parametrize("error_code, exists", [(None, True), ("NoSuchKey", False)])
+def test_scan_file_exists(scan_files_store, error_code, exists):
+    if error_code:
+        scan_files_store.s3.get_object_attributes.side_effect = BotoClientError(
+            {"Error": {"Code": error_code}}, "GetObjectAttributes"
+        )
+
+    assert scan_files_store.document_exists("service-id", "document-id", "attach") is exists
+    scan_files_store.s3.get_object_attributes.assert_called_once_with(
+        Bucket="test-bucket", Key="api_attachments/service-id/document-id", ObjectAttributes=["ETag"]
+    )
+
+
 @pytest.mark.parametrize(
     "last_modified, expected_age_seconds",
     [
@@ -258,8 +516,509 @@ def test_guardduty_tag_takes_precedence_over_scanfiles_malicious(scan_files_stor
 @freeze_time("2023-02-17 16:01:00.000000")
 def test_get_object_age_seconds(scan_files_store, last_modified, expected_age_seconds):
     scan_files_store.s3.get_object_attributes = mock.Mock(
-        return_value={"ResponseMetadata": {"HTTPHeaders": {"last-modified": last_modified}}}
+        return_value={"ObjectSize": 100, "ResponseMetadata": {"HTTPHeaders": {"last-modified": last_modified}}}
     )
     age_data = scan_files_store.get_object_age_seconds("service-id", "document-id", sending_method="link")
     age_seconds = age_data["age_seconds"]
     assert age_seconds == expected_age_seconds
+    assert age_data["size"] == 100
+    scan_files_store.s3.get_object_attributes.assert_called_once_with(
+        Bucket="test-bucket", Key="api_link/service-id/document-id", ObjectAttributes=["ETag", "ObjectSize"]
+    )
+
+
+def test_open_writer_small_document_uses_put_object(store):
+    ret = store.open_writer("service-id", sending_method="link", mimetype="text/plain")
+    ret["writer"].write(b"some ")
+    ret["writer"].write(b"content")
+    ret["writer"].close()
+
+    store.s3.create_multipart_upload.assert_not_called()
+    store.s3.put_object.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="api_link/service-id/{}".format(ret["id"]),
+        Body=b"some content",
+        ContentType="text/plain",
+        SSECustomerKey=ret["encryption_key"],
+        SSECustomerAlgorithm="AES256",
+    )
+
+
+def test_open_writer_template_attach_uses_sse_s3(store):
+    ret = store.open_writer("service-id", sending_method="template_attach")
+    ret["writer"].write(b"content")
+    ret["writer"].close()
+
+    assert ret["encryption_key"] is None
+    store.s3.put_object.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="template_attachments/service-id/{}".format(ret["id"]),
+        Body=b"content",
+        ContentType="application/pdf",
+        ServerSideEncryption="AES256",
+    )
+
+
+def test_writer_sends_multipart_upload_once_a_part_is_full(store):
+    store.s3.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    store.s3.upload_part.side_effect = lambda **kwargs: {"ETag": "etag-{}".format(kwargs["PartNumber"])}
+
+    writer = S3MultipartWriter(
+        store.s3, "test-bucket", "key", 4, ContentType="text/plain", SSECustomerKey=b"k", SSECustomerAlgorithm="AES256"
+    )
+    writer.write(b"abc")
+    store.s3.create_multipart_upload.assert_not_called()
+    writer.write(b"defghij")
+    writer.close()
+
+    store.s3.create_multipart_upload.assert_called_once_with(
+        Bucket="test-bucket", Key="key", ContentType="text/plain", SSECustomerKey=b"k", SSECustomerAlgorithm="AES256"
+    )
+    assert store.s3.upload_part.call_args_list == [
+        mock.call(
+            Bucket="test-bucket",
+            Key="key",
+            UploadId="upload-id",
+            PartNumber=number,
+            Body=mock.ANY,
+            SSECustomerKey=b"k",
+            SSECustomerAlgorithm="AES256",
+        )
+        for number in (1, 2, 3)
+    ]
+    assert [read_body(c.kwargs["Body"]) for c in store.s3.upload_part.call_args_list] == [b"abcd", b"efgh", b"ij"]
+    store.s3.complete_multipart_upload.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="key",
+        UploadId="upload-id",
+        MultipartUpload={"Parts": [{"PartNumber": n, "ETag": "etag-{}".format(n)} for n in (1, 2, 3)]},
+    )
+    store.s3.put_object.assert_not_called()
+
+
+def test_writer_abort_aborts_multipart_upload(store):
+    store.s3.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    store.s3.upload_part.return_value = {"ETag": "etag"}
+
+    writer = S3MultipartWriter(store.s3, "test-bucket", "key", 4, ContentType="text/plain")
+    writer.write(b"abcdef")
+    writer.abort()
+
+    store.s3.abort_multipart_upload.assert_called_once_with(Bucket="test-bucket", Key="key", UploadId="upload-id")
+    store.s3.complete_multipart_upload.assert_not_called()
+    store.s3.put_object.assert_not_called()
+
+
+def test_writer_wraps_s3_errors(store):
+    store.s3.put_object.side_effect = BotoClientError({"Error": {"Code": "Error code", "Message": "Error message"}}, "PutObject")
+
+    writer = S3MultipartWriter(store.s3, "test-bucket", "key", 4, ContentType="text/plain")
+    writer.write(b"abc")
+
+    with pytest.raises(DocumentStoreError):
+        writer.close()
+
+
+def test_scan_files_open_writer(scan_files_store):
+    writer = scan_files_store.open_writer("service-id", "document-id", sending_method="attach", mimetype="text/plain")
+    writer.write(b"content")
+    writer.close()
+
+    scan_files_store.s3.put_object.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="api_attachments/service-id/document-id",
+        Body=b"content",
+        ContentType="text/plain",
+    )
+
+
+def test_put_document_with_document_id(store):
+    ret = store.put("service-id", mock.Mock(), sending_method="link", document_id="document-id")
+
+    assert ret["id"] == "document-id"
+    assert store.s3.put_object.call_args.kwargs["Key"] == "api_link/service-id/document-id"
+
+
+def test_scan_files_copy_from_uses_copy_source_encryption_key(scan_files_store):
+    scan_files_store.copy_from("documents-bucket", "service-id", "document-id", "link", encryption_key=bytes(32))
+
+    scan_files_store.s3.copy_object.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="api_link/service-id/document-id",
+        CopySource={"Bucket": "documents-bucket", "Key": "api_link/service-id/document-id"},
+        CopySourceSSECustomerKey=bytes(32),
+        CopySourceSSECustomerAlgorithm="AES256",
+    )
+    scan_files_store.s3.put_object.assert_not_called()
+
+
+def test_scan_files_copy_from_template_attach(scan_files_store):
+    scan_files_store.copy_from("documents-bucket", "service-id", "document-id", "template_attach")
+
+    scan_files_store.s3.copy_object.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="template_attachments/service-id/document-id",
+        CopySource={"Bucket": "documents-bucket", "Key": "template_attachments/service-id/document-id"},
+    )
+
+
+@pytest.fixture
+def multipart_store(store):
+    store.part_size = 4
+    store.multipart_threshold = 8
+    store.multipart_concurrency = 2
+    store.part_attempts = 2
+    store.s3.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    store.s3.upload_part.side_effect = lambda **kwargs: {"ETag": "etag-{}".format(kwargs["PartNumber"])}
+    return store
+
+
+def test_put_document_below_multipart_threshold_uses_put_object(multipart_store):
+    multipart_store.put("service-id", b"12345678", sending_method="link")
+
+    multipart_store.s3.put_object.assert_called_once()
+    multipart_store.s3.create_multipart_upload.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "sending_method, encryption_params",
+    [
+        ("link", {"SSECustomerKey": mock.ANY, "SSECustomerAlgorithm": "AES256"}),
+        ("template_attach", {"ServerSideEncryption": "AES256"}),
+    ],
+)
+def test_put_document_above_multipart_threshold_sends_parts(multipart_store, sending_method, encryption_params):
+    ret = multipart_store.put("service-id", b"123456789", sending_method=sending_method, document_id="document-id")
+
+    key = get_document_key("service-id", "document-id", sending_method)
+    multipart_store.s3.put_object.assert_not_called()
+    multipart_store.s3.create_multipart_upload.assert_called_once_with(
+        Bucket="test-bucket", Key=key, ContentType="application/pdf", **encryption_params
+    )
+    part_params = {k: v for k, v in encryption_params.items() if k.startswith("SSECustomer")}
+    calls = sorted(multipart_store.s3.upload_part.call_args_list, key=lambda c: c.kwargs["PartNumber"])
+    assert calls == [
+        mock.call(Bucket="test-bucket", Key=key, UploadId="upload-id", PartNumber=number, Body=mock.ANY, **part_params)
+        for number in (1, 2, 3)
+    ]
+    assert [read_body(c.kwargs["Body"]) for c in calls] == [b"1234", b"5678", b"9"]
+    multipart_store.s3.complete_multipart_upload.assert_called_once_with(
+        Bucket="test-bucket",
+        Key=key,
+        UploadId="upload-id",
+        MultipartUpload={"Parts": [{"PartNumber": n, "ETag": "etag-{}".format(n)} for n in (1, 2, 3)]},
+    )
+    if sending_method == "template_attach":
+        assert ret["encryption_key"] is None
+    else:
+        assert multipart_store.s3.create_multipart_upload.call_args.kwargs["SSECustomerKey"] == ret["encryption_key"]
+
+
+def test_put_document_multipart_retries_failed_part(multipart_store, app):
+    server_error = BotoClientError(
+        {"Error": {"Code": "InternalError", "Message": "oops"}, "ResponseMetadata": {"HTTPStatusCode": 500}}, "UploadPart"
+    )
+    responses = {1: [server_error, {"ETag": "etag-1"}], 2: [{"ETag": "etag-2"}], 3: [{"ETag": "etag-3"}]}
+    multipart_store.s3.upload_part.side_effect = lambda **kwargs: _respond(responses[kwargs["PartNumber"]].pop(0))
+
+    multipart_store.put("service-id", b"123456789", sending_method="link")
+
+    assert multipart_store.s3.upload_part.call_count == 4
+    multipart_store.s3.complete_multipart_upload.assert_called_once()
+    multipart_store.s3.abort_multipart_upload.assert_not_called()
+
+
+def test_put_document_multipart_aborts_when_part_keeps_failing(multipart_store, app):
+    access_denied = BotoClientError(
+        {"Error": {"Code": "AccessDenied", "Message": "no"}, "ResponseMetadata": {"HTTPStatusCode": 403}}, "UploadPart"
+    )
+    multipart_store.s3.upload_part.side_effect = access_denied
+
+    with pytest.raises(DocumentStoreError):
+        multipart_store.put("service-id", b"123456789", sending_method="link")
+
+    multipart_store.s3.complete_multipart_upload.assert_not_called()
+    multipart_store.s3.abort_multipart_upload.assert_called_once_with(Bucket="test-bucket", Key=mock.ANY, UploadId="upload-id")
+
+
+def _respond(response):
+    if isinstance(response, Exception):
+        raise response
+    return response
+
+
+def test_put_content_reference(store):
+    ret = store.put_content_reference("service-id", "abc123", mimetype="text/csv")
+
+    assert ret == {"id": Matcher("UUID length match", lambda x: len(x) == 36), "encryption_key": None}
+    store.s3.put_object.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="template_attachments/service-id/{}".format(ret["id"]),
+        Body=b"",
+        ContentType="text/csv",
+        ServerSideEncryption="AES256",
+        Metadata={"content-sha256": "abc123"},
+    )
+
+
+@freeze_time("2023-02-17 16:01:00")
+def test_get_content_age_seconds(store):
+    store.s3.head_object.return_value = {"LastModified": datetime(2023, 2, 17, 16, 0, tzinfo=timezone.utc)}
+
+    assert store.get_content_age_seconds("service-id", "abc123") == 60
+    store.s3.head_object.assert_called_once_with(Bucket="test-bucket", Key="template_attachments/service-id/content/abc123")
+
+
+def test_get_content_age_seconds_missing_content(store):
+    store.s3.head_object.side_effect = BotoClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+
+    assert store.get_content_age_seconds("service-id", "abc123") is None
+
+
+def test_refresh_content(store):
+    assert store.refresh_content("service-id", "abc123", mimetype="text/csv") is True
+
+    store.s3.copy_object.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="template_attachments/service-id/content/abc123",
+        CopySource={"Bucket": "test-bucket", "Key": "template_attachments/service-id/content/abc123"},
+        MetadataDirective="REPLACE",
+        ContentType="text/csv",
+        ServerSideEncryption="AES256",
+    )
+
+
+def test_refresh_scan_file_of_content(scan_files_store):
+    assert scan_files_store.refresh_content("service-id", "abc123", mimetype="text/csv") is True
+
+    scan_files_store.s3.copy_object.assert_called_once_with(
+        Bucket="test-bucket",
+        Key="template_attachments/service-id/content/abc123",
+        CopySource={"Bucket": "test-bucket", "Key": "template_attachments/service-id/content/abc123"},
+        MetadataDirective="REPLACE",
+        ContentType="text/csv",
+    )
+
+
+@pytest.mark.parametrize("store_fixture", ["store", "scan_files_store"])
+def test_refresh_missing_content(request, store_fixture):
+    store = request.getfixturevalue(store_fixture)
+    store.s3.copy_object.side_effect = BotoClientError({"Error": {"Code": "NoSuchKey"}}, "CopyObject")
+
+    assert store.refresh_content("service-id", "abc123") is False
+
+
+@pytest.mark.parametrize("store_fixture", ["store", "scan_files_store"])
+def test_refresh_content_error(request, store_fixture):
+    store = request.getfixturevalue(store_fixture)
+    store.s3.copy_object.side_effect = BotoClientError({"Error": {"Code": "AccessDenied"}}, "CopyObject")
+
+    with pytest.raises(DocumentStoreError):
+        store.refresh_content("service-id", "abc123")
+
+
+@pytest.mark.parametrize(
+    "head_object, exists",
+    [
+        (mock.Mock(return_value={}), True),
+        (mock.Mock(side_effect=BotoClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")), False),
+    ],
+)
+def test_document_exists(store, head_object, exists):
+    store.s3.head_object = head_object
+
+    assert store.document_exists("service-id", "document-id", "template_attach") is exists
+    head_object.assert_called_once_with(Bucket="test-bucket", Key="template_attachments/service-id/document-id")
+
+
+def test_document_exists_error(store):
+    store.s3.head_object.side_effect = BotoClientError({"Error": {"Code": "403", "Message": "Forbidden"}}, "HeadObject")
+
+    with pytest.raises(DocumentStoreError):
+        store.document_exists("service-id", "document-id", "template_attach")
+
+
+def test_get_deduplicated_document_serves_shared_content(store):
+    reference_body = mock.Mock()
+    store.s3.get_object.side_effect = [
+        {"Body": reference_body, "ContentType": "text/csv", "ContentLength": 0, "Metadata": {"content-sha256": "abc123"}},
+        {"Body": mock.sentinel.content, "ContentType": "text/plain", "ContentLength": 100},
+    ]
+
+    assert store.get("service-id", "document-id", None, sending_method="template_attach") == {
+        "body": mock.sentinel.content,
+        "mimetype": "text/csv",
+        "size": 100,
+        "content_range": None,
+        "etag": None,
+        "last_modified": None,
+    }
+    reference_body.close.assert_called_once_with()
+    assert store.s3.get_object.call_args_list == [
+        mock.call(Bucket="test-bucket", Key="template_attachments/service-id/document-id"),
+        mock.call(Bucket="test-bucket", Key="template_attachments/service-id/content/abc123"),
+    ]
+
+
+def test_check_scan_verdict_of_deduplicated_document_uses_shared_content(scan_files_store):
+    scan_files_store.documents_bucket = "documents-bucket"
+    scan_files_store.s3.get_object_tagging.side_effect = [
+        BotoClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObjectTagging"),
+        {"TagSet": [{"Key": "GuardDutyMalwareScanStatus", "Value": "NO_THREATS_FOUND"}]},
+    ]
+    scan_files_store.s3.head_object.return_value = {"Metadata": {"content-sha256": "abc123"}}
+
+    assert scan_files_store.check_scan_verdict("service-id", "document-id", "template_attach") == "NO_THREATS_FOUND"
+    scan_files_store.s3.head_object.assert_called_once_with(
+        Bucket="documents-bucket", Key="template_attachments/service-id/document-id"
+    )
+    assert scan_files_store.s3.get_object_tagging.call_args_list[1] == mock.call(
+        Bucket="test-bucket", Key="template_attachments/service-id/content/abc123"
+    )
+
+
+def test_check_scan_verdict_of_missing_template_attach_document(scan_files_store):
+    scan_files_store.documents_bucket = "documents-bucket"
+    scan_files_store.s3.get_object_tagging.side_effect = BotoClientError(
+        {"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObjectTagging"
+    )
+    scan_files_store.s3.head_object.return_value = {"Metadata": {}}
+
+    with pytest.raises(DocumentStoreError):
+        scan_files_store.check_scan_verdict("service-id", "document-id", "template_attach")
+    assert scan_files_store.s3.get_object_tagging.call_count == 1
+
+
+def test_put_document_in_both_stores_does_not_copy_the_content(multipart_store, scan_files_store):
+    def consume(**kwargs):
+        body = kwargs["Body"]
+        if not isinstance(body, bytes):
+            while body.read(64 * 1024):
+                pass
+        return {"ETag": "etag-{}".format(kwargs.get("PartNumber"))}
+
+    multipart_store.part_size = 1024 * 1024
+    multipart_store.multipart_threshold = 1024 * 1024
+    multipart_store.multipart_concurrency = 4
+    multipart_store.s3.upload_part.side_effect = consume
+    scan_files_store.s3.put_object.side_effect = consume
+    size = 8 * 1024 * 1024
+
+    tracemalloc.start()
+    try:
+        content = bytes(size)
+        multipart_store.put("service-id", content, sending_method="link", document_id="document-id")
+        scan_files_store.put("service-id", "document-id", content, sending_method="link")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert multipart_store.s3.upload_part.call_count == 8
+    assert peak < size * 1.25
+
+
+def test_get_presigned_url(store):
+    store.s3.head_object.return_value = {"ContentType": "application/pdf", "Metadata": {}}
+    store.s3.generate_presigned_url.return_value = "https://test-bucket.s3.amazonaws.com/key?X-Amz-Signature=abc"
+
+    url = store.get_presigned_url("service-id", "document-id", "template_attach", 'attachment; filename="file.pdf"')
+
+    assert url == "https://test-bucket.s3.amazonaws.com/key?X-Amz-Signature=abc"
+    store.s3.head_object.assert_called_once_with(Bucket="test-bucket", Key="template_attachments/service-id/document-id")
+    store.s3.generate_presigned_url.assert_called_once_with(
+        "get_object",
+        Params={
+            "Bucket": "test-bucket",
+            "Key": "template_attachments/service-id/document-id",
+            "ResponseContentType": "application/pdf",
+            "ResponseContentDisposition": 'attachment; filename="file.pdf"',
+        },
+        ExpiresIn=60,
+    )
+
+
+def test_get_presigned_url_of_deduplicated_document(store):
+    store.s3.head_object.return_value = {"ContentType": "text/csv", "Metadata": {"content-sha256": "abc123"}}
+
+    store.get_presigned_url("service-id", "document-id", "template_attach")
+
+    store.s3.generate_presigned_url.assert_called_once_with(
+        "get_object",
+        Params={
+            "Bucket": "test-bucket",
+            "Key": "template_attachments/service-id/content/abc123",
+            "ResponseContentType": "text/csv",
+        },
+        ExpiresIn=60,
+    )
+
+
+def test_get_presigned_url_with_base_url(store):
+    store.presigned_url_base_url = "https://cdn.example.com"
+    store.s3.head_object.return_value = {"ContentType": "application/pdf"}
+    store.s3.generate_presigned_url.return_value = "https://test-bucket.s3.amazonaws.com/key?X-Amz-Signature=abc"
+
+    assert (
+        store.get_presigned_url("service-id", "document-id", "template_attach")
+        == "https://cdn.example.com/key?X-Amz-Signature=abc"
+    )
+
+
+def test_get_presigned_url_of_missing_document(store):
+    store.s3.head_object.side_effect = BotoClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+
+    with pytest.raises(DocumentStoreError):
+        store.get_presigned_url("service-id", "document-id", "template_attach")
+
+    store.s3.generate_presigned_url.assert_not_called()
+
+
+def test_check_scan_verdict_shares_concurrent_lookups(scan_files_store):
+    scan_files_store.verdict_flights = mock.Mock()
+    scan_files_store.verdict_flights.do.return_value = ("NO_THREATS_FOUND", True)
+
+    assert scan_files_store.check_scan_verdict("service-id", "document-id", "link") == "NO_THREATS_FOUND"
+
+    scan_files_store.verdict_flights.do.assert_called_once_with(
+        ("service-id", "document-id", "link", None),
+        scan_files_store._check_scan_verdict,
+        "service-id",
+        "document-id",
+        "link",
+        None,
+    )
+    scan_files_store.s3.get_object_tagging.assert_not_called()
+
+
+def test_check_scan_verdict_notifies_waiters_of_terminal_verdict(scan_files_store):
+    scan_files_store.verdict_events = mock.Mock()
+    scan_files_store.s3.get_object_tagging = mock.Mock(
+        return_value={"TagSet": [{"Key": "GuardDutyMalwareScanStatus", "Value": "NO_THREATS_FOUND"}]}
+    )
+
+    scan_files_store.check_scan_verdict("service-id", "document-id", "link")
+
+    scan_files_store.verdict_events.notify.assert_called_once_with(
+        scan_files_store.get_document_key("service-id", "document-id", "link")
+    )
+
+
+def test_check_scan_verdict_does_not_notify_waiters_while_scan_in_progress(scan_files_store):
+    scan_files_store.verdict_events = mock.Mock()
+    scan_files_store.s3.get_object_tagging = mock.Mock(return_value={"TagSet": []})
+
+    with pytest.raises(ScanInProgressError):
+        scan_files_store.check_scan_verdict("service-id", "document-id", "link")
+
+    scan_files_store.verdict_events.notify.assert_not_called()
+
+
+def test_wait_for_scan_verdict(scan_files_store):
+    scan_files_store.verdict_events = mock.Mock()
+    scan_files_store.verdict_events.wait.return_value = True
+
+    assert scan_files_store.wait_for_scan_verdict("service-id", "document-id", "link", 5) is True
+
+    scan_files_store.verdict_events.wait.assert_called_once_with(
+        scan_files_store.get_document_key("service-id", "document-id", "link"), 5
+    )
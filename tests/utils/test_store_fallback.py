@@ -157,3 +157,96 @@ def test_fallback_respects_other_error_types(store_with_fallback):
 
     # Should only try new path, not fallback
     assert store.s3.get_object.call_count == 1
+
+
+def test_no_fallback_for_current_key_layout(store_with_fallback):
+    """Test that documents linked with the current key layout are only looked up at their new path"""
+    store = store_with_fallback
+
+    no_such_key_error = BotoClientError({"Error": {"Code": "NoSuchKey", "Message": "Not found"}}, "GetObject")
+
+    store.s3.get_object.side_effect = no_such_key_error
+
+    with pytest.raises(DocumentStoreError):
+        store.get("service-id", "document-id", bytes(32), sending_method="attach", key_layout="2")
+
+    assert store.s3.get_object.call_count == 1
+
+
+@pytest.fixture
+def parallel_store(store_with_fallback):
+    store_with_fallback.legacy_key_probe.parallel = True
+    return store_with_fallback
+
+
+def test_parallel_probe_finds_document_at_old_path(parallel_store, app):
+    store = parallel_store
+    no_such_key_error = BotoClientError({"Error": {"Code": "NoSuchKey", "Message": "Not found"}}, "GetObject")
+
+    def get_object(Key, **kwargs):
+        if Key == "api_link/service-id/document-id":
+            raise no_such_key_error
+        return {"Body": mock.Mock(), "ContentType": "application/pdf", "ContentLength": 100}
+
+    store.s3.get_object.side_effect = get_object
+
+    with app.app_context():
+        result = store.get("service-id", "document-id", bytes(32), sending_method=None)
+
+    assert result["size"] == 100
+    assert sorted(call.kwargs["Key"] for call in store.s3.get_object.call_args_list) == [
+        "api_link/service-id/document-id",
+        "service-id/document-id",
+    ]
+    assert store.legacy_key_probe.get_counts() == {"get_object.legacy": 1}
+
+
+def test_parallel_probe_prefers_new_path_and_closes_old_path_body(parallel_store, app):
+    store = parallel_store
+    new_body, old_body = mock.Mock(), mock.Mock()
+
+    def get_object(Key, **kwargs):
+        body = new_body if Key == "api_link/service-id/document-id" else old_body
+        return {"Body": body, "ContentType": "application/pdf", "ContentLength": 100}
+
+    store.s3.get_object.side_effect = get_object
+
+    with app.app_context():
+        result = store.get("service-id", "document-id", bytes(32), sending_method=None)
+    store.legacy_key_probe._executor.shutdown(wait=True)
+
+    assert result["body"] is new_body
+    new_body.close.assert_not_called()
+    if store.s3.get_object.call_count == 2:
+        old_body.close.assert_called_once_with()
+    assert store.legacy_key_probe.get_counts() == {"get_object.new": 1}
+
+
+def test_parallel_probe_raises_if_both_paths_fail(parallel_store, app):
+    store = parallel_store
+    store.s3.get_object.side_effect = BotoClientError({"Error": {"Code": "NoSuchKey", "Message": "Not found"}}, "GetObject")
+
+    with app.app_context():
+        with pytest.raises(DocumentStoreError):
+            store.get("service-id", "document-id", bytes(32), sending_method="attach")
+
+    assert store.s3.get_object.call_count == 2
+    assert store.legacy_key_probe.get_counts() == {"get_object.missing": 1}
+
+
+def test_parallel_probe_respects_other_error_types(parallel_store, app):
+    store = parallel_store
+    access_denied_error = BotoClientError({"Error": {"Code": "AccessDenied", "Message": "Access Denied"}}, "GetObject")
+
+    def get_object(Key, **kwargs):
+        if Key == "api_link/service-id/document-id":
+            raise access_denied_error
+        return {"Body": mock.Mock(), "ContentType": "application/pdf", "ContentLength": 100}
+
+    store.s3.get_object.side_effect = get_object
+
+    with app.app_context():
+        with pytest.raises(DocumentStoreError):
+            store.get("service-id", "document-id", bytes(32), sending_method=None)
+
+    assert store.legacy_key_probe.get_counts() == {}
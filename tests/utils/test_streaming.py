@@ -0,0 +1,59 @@
+import io
+from unittest import mock
+
+import pytest
+from app.utils.streaming import StreamedBody
+from botocore.response import StreamingBody
+
+
+@pytest.fixture
+def body():
+    return StreamingBody(io.BytesIO(b"PDF document contents"), 21)
+
+
+def test_streamed_body_reads_chunks(app, body):
+    with app.app_context():
+        streamed_body = StreamedBody(body, chunk_size=8)
+
+    assert list(streamed_body) == [b"PDF docu", b"ment con", b"tents"]
+    assert streamed_body.bytes_sent == 21
+    assert streamed_body.completed
+
+
+def test_streamed_body_close_closes_body_and_logs_transfer_rate(app, body, mocker):
+    with app.app_context():
+        logger = mocker.patch.object(app, "logger")
+        streamed_body = StreamedBody(body, chunk_size=8, extra={"document_id": "document-id"})
+
+    list(streamed_body)
+    streamed_body.close()
+    streamed_body.close()
+
+    assert body._raw_stream.closed
+    logger.info.assert_called_once_with(
+        "Streamed document",
+        extra={"document_id": "document-id", "bytes_sent": 21, "duration_seconds": mock.ANY, "bytes_per_second": mock.ANY},
+    )
+
+
+def test_streamed_body_close_on_client_disconnect(app, body, mocker):
+    with app.app_context():
+        logger = mocker.patch.object(app, "logger")
+        streamed_body = StreamedBody(body, chunk_size=8)
+
+    chunks = iter(streamed_body)
+    next(chunks)
+    streamed_body.close()
+
+    assert body._raw_stream.closed
+    assert streamed_body.bytes_sent == 8
+    assert logger.info.call_args.args == ("Client disconnected while streaming document",)
+
+
+def test_streamed_body_close_before_streaming(app, body):
+    with app.app_context():
+        streamed_body = StreamedBody(body, chunk_size=8)
+
+    streamed_body.close()
+
+    assert body._raw_stream.closed
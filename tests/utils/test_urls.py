@@ -10,7 +10,7 @@ SAMPLE_B64 = "AAECAwQFBgcICQoLDA0ODxAREhMUFRYXGBkaGxwdHh8"
 def test_get_api_download_url_returns_url_without_filename(app):
     assert get_api_download_url(
         service_id=UUID(int=0), document_id=UUID(int=1), key=SAMPLE_KEY, filename=None
-    ) == "http://localhost:7000/d/{}/{}?key={}".format("AAAAAAAAAAAAAAAAAAAAAA", "AAAAAAAAAAAAAAAAAAAAAQ", SAMPLE_B64)
+    ) == "http://localhost:7000/d/{}/{}?key={}&v=2".format("AAAAAAAAAAAAAAAAAAAAAA", "AAAAAAAAAAAAAAAAAAAAAQ", SAMPLE_B64)
 
 
 def test_get_api_download_url_returns_url_with_filename(app):
@@ -19,7 +19,7 @@ def test_get_api_download_url_returns_url_with_filename(app):
         document_id=UUID(int=1),
         key=SAMPLE_KEY,
         filename="ça va.pdf",
-    ) == "http://localhost:7000/d/{}/{}?key={}&filename=%C3%A7a%20va.pdf".format(
+    ) == "http://localhost:7000/d/{}/{}?key={}&filename=%C3%A7a%20va.pdf&v=2".format(
         "AAAAAAAAAAAAAAAAAAAAAA", "AAAAAAAAAAAAAAAAAAAAAQ", SAMPLE_B64
     )
 
@@ -30,7 +30,7 @@ def test_get_direct_file_url_gets_local_url_without_compressing_uuids(app):
         document_id=UUID(int=1),
         key=SAMPLE_KEY,
         sending_method="link",
-    ) == "http://document-download.test/services/{}/documents/{}?key={}&sending_method={}".format(
+    ) == "http://document-download.test/services/{}/documents/{}?key={}&sending_method={}&v=2".format(
         "00000000-0000-0000-0000-000000000000",
         "00000000-0000-0000-0000-000000000001",
         SAMPLE_B64,
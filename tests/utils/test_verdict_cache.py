@@ -0,0 +1,231 @@
+import multiprocessing
+import socketserver
+import threading
+import time
+from unittest import mock
+
+import pytest
+from app.utils.verdict_cache import (
+    InMemoryVerdictCache,
+    SharedMemoryVerdictCache,
+    create_verdict_cache,
+)
+from freezegun import freeze_time
+
+from tests.conftest import set_config
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "verdicts")
+
+
+@pytest.fixture
+def cache(cache_path):
+    return SharedMemoryVerdictCache(cache_path, max_entries=16, ttl=60)
+
+
+def test_get_returns_cached_verdict(cache):
+    cache.set("key", "NO_THREATS_FOUND")
+
+    assert cache.get("key") == "NO_THREATS_FOUND"
+    assert cache.get("other-key") is None
+
+
+@pytest.mark.parametrize("verdict", [None, "in_progress", "UNSUPPORTED", "FAILED", "error"])
+def test_set_ignores_non_terminal_verdicts(cache, verdict):
+    cache.set("key", verdict)
+
+    assert cache.get("key") is None
+
+
+def test_cached_verdicts_expire(cache):
+    with freeze_time("2026-01-01 12:00:00"):
+        cache.set("key", "malicious")
+
+    with freeze_time("2026-01-01 12:00:59"):
+        assert cache.get("key") == "malicious"
+
+    with freeze_time("2026-01-01 12:01:00"):
+        assert cache.get("key") is None
+
+
+def test_cache_size_is_bounded(cache_path):
+    cache = SharedMemoryVerdictCache(cache_path, max_entries=8, ttl=60)
+
+    with freeze_time("2026-01-01 12:00:00") as frozen_time:
+        for i in range(9):
+            cache.set(f"key-{i}", "clean")
+            frozen_time.tick()
+
+        # the entry closest to expiring made room for the last one
+        assert cache.get("key-0") is None
+        assert all(cache.get(f"key-{i}") == "clean" for i in range(1, 9))
+
+
+def _set_verdict(cache_path, key, verdict):
+    SharedMemoryVerdictCache(cache_path, max_entries=16, ttl=60).set(key, verdict)
+
+
+def test_cache_is_shared_between_processes(cache, cache_path):
+    process = multiprocessing.get_context("fork").Process(target=_set_verdict, args=(cache_path, "key", "THREATS_FOUND"))
+    process.start()
+    process.join()
+
+    assert cache.get("key") == "THREATS_FOUND"
+
+
+def test_cache_is_reset_if_resized(cache, cache_path):
+    cache.set("key", "clean")
+
+    assert SharedMemoryVerdictCache(cache_path, max_entries=32, ttl=60).get("key") is None
+
+
+def test_in_memory_cache_returns_cached_verdict():
+    cache = InMemoryVerdictCache(max_entries=16, ttl=60)
+    cache.set("key", "clean")
+    cache.set("in-progress-key", "in_progress")
+
+    assert cache.get("key") == "clean"
+    assert cache.get("in-progress-key") is None
+
+
+def test_in_memory_cache_evicts_least_recently_used_verdict():
+    cache = InMemoryVerdictCache(max_entries=2, ttl=60)
+    cache.set("key-1", "clean")
+    cache.set("key-2", "clean")
+    cache.get("key-1")
+
+    cache.set("key-3", "clean")
+
+    assert cache.get("key-1") == "clean"
+    assert cache.get("key-2") is None
+    assert cache.get("key-3") == "clean"
+
+
+def test_in_memory_cached_verdicts_expire():
+    cache = InMemoryVerdictCache(max_entries=16, ttl=60)
+    with freeze_time("2026-01-01 12:00:00"):
+        cache.set("key", "clean")
+
+    with freeze_time("2026-01-01 12:01:00"):
+        assert cache.get("key") is None
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    """
+    Minimal in-process server speaking the Redis protocol, supporting GET and SET (with EX)
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        self.data = {}
+        super().__init__(("127.0.0.1", 0), RedisStandInHandler)
+
+    @property
+    def url(self):
+        return "redis://{}:{}".format(*self.server_address)
+
+
+class RedisStandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while line := self.rfile.readline():
+            args = [self.read_bulk_string() for _ in range(int(line[1:]))]
+            command = args[0].decode().upper()
+            if command == "GET":
+                value, expires_at = self.server.data.get(args[1], (None, None))
+                if value is None or expires_at <= time.time():
+                    self.wfile.write(b"$-1\r\n")
+                else:
+                    self.wfile.write(b"$%d\r\n%s\r\n" % (len(value), value))
+            elif command == "SET":
+                options = [arg.decode().upper() for arg in args[3:]]
+                ttl = int(args[3 + options.index("EX") + 1]) if "EX" in options else float("inf")
+                self.server.data[args[1]] = (args[2], time.time() + ttl)
+                self.wfile.write(b"+OK\r\n")
+            else:
+                self.wfile.write(b"-ERR unknown command\r\n")
+
+    def read_bulk_string(self):
+        length = int(self.rfile.readline()[1:])
+        value = self.rfile.read(length)
+        self.rfile.readline()
+        return value
+
+
+@pytest.fixture
+def redis_stand_in():
+    server = RedisStandIn()
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def create_redis_cache(app, url):
+    with set_config(app, SCAN_VERDICT_CACHE_ENABLED=True, SCAN_VERDICT_CACHE_BACKEND="redis", SCAN_VERDICT_CACHE_REDIS_URL=url):
+        return create_verdict_cache(app.config)
+
+
+@pytest.fixture
+def redis_cache(app, redis_stand_in):
+    return create_redis_cache(app, redis_stand_in.url)
+
+
+def test_redis_cache_returns_cached_verdict(redis_cache, redis_stand_in):
+    redis_cache.set("key", "NO_THREATS_FOUND")
+    redis_cache.set("in-progress-key", "in_progress")
+
+    assert redis_cache.get("key") == "NO_THREATS_FOUND"
+    assert redis_cache.get("in-progress-key") is None
+    assert redis_stand_in.data[b"scan-verdict:key"] == (b"NO_THREATS_FOUND", mock.ANY)
+
+
+def test_redis_cache_is_shared_between_clients(app, redis_cache, redis_stand_in):
+    create_redis_cache(app, redis_stand_in.url).set("key", "malicious")
+
+    assert redis_cache.get("key") == "malicious"
+
+
+def test_redis_cached_verdicts_expire(redis_cache, redis_stand_in):
+    redis_cache.set("key", "clean")
+    redis_stand_in.data[b"scan-verdict:key"] = (b"clean", time.time() - 1)
+
+    assert redis_cache.get("key") is None
+
+
+def test_redis_cache_errors_are_cache_misses(app, redis_stand_in):
+    redis_stand_in.shutdown()
+    redis_stand_in.server_close()
+    cache = create_redis_cache(app, redis_stand_in.url)
+
+    cache.set("key", "clean")
+
+    assert cache.get("key") is None
+
+
+@pytest.mark.parametrize(
+    "backend, expected_class",
+    [("memory", InMemoryVerdictCache), ("shared_memory", SharedMemoryVerdictCache)],
+)
+def test_create_verdict_cache(app, tmp_path, backend, expected_class):
+    with set_config(
+        app,
+        SCAN_VERDICT_CACHE_ENABLED=True,
+        SCAN_VERDICT_CACHE_BACKEND=backend,
+        SCAN_VERDICT_CACHE_PATH=str(tmp_path / "verdicts"),
+    ):
+        assert isinstance(create_verdict_cache(app.config), expected_class)
+
+
+def test_create_verdict_cache_when_disabled(app):
+    with set_config(app, SCAN_VERDICT_CACHE_ENABLED=False):
+        assert create_verdict_cache(app.config) is None
+
+
+def test_create_verdict_cache_with_unknown_backend(app):
+    with set_config(app, SCAN_VERDICT_CACHE_ENABLED=True, SCAN_VERDICT_CACHE_BACKEND="memcached"):
+        with pytest.raises(ValueError):
+            create_verdict_cache(app.config)